@@ -1,12 +1,282 @@
 from datetime import datetime
+from multiprocessing import cpu_count, Pool
 
+import numpy as np
+from django.conf import settings
+from django.db import connection, connections, transaction, OperationalError
+from django.db.models import Count, Max
 from pandas import concat
 from pandas import DataFrame
 from pandas import notnull
 
 from rhizome.models import *
-from rhizome.cache_meta import IndicatorCache
+from rhizome.cache_meta import IndicatorCache, LocationTreeIndex
 from rhizome.models import SourceSubmission
+from rhizome.pg_utils import merge_model_df
+from rhizome.api.custom_cache import bump_data_version
+
+CALC_COLUMNS = ['location_id','indicator_id','value']
+
+def stack_calc_dfs(calc_df_list):
+    '''
+    Stack a list of (location_id, indicator_id, value) frames and keep one
+    row per key.  Frames later in the list take precedence, which is how
+    we make raw data override aggregated or calculated values.
+    '''
+
+    ## empty frames are left out so they dont turn the keys to objects ##
+    calc_df_list = [df[CALC_COLUMNS] for df in calc_df_list if len(df) > 0]
+
+    if len(calc_df_list) == 0:
+        return DataFrame(columns=CALC_COLUMNS)
+
+    stacked_df = concat(calc_df_list, ignore_index=True)
+
+    return stacked_df.drop_duplicates(\
+        subset=['location_id','indicator_id'], take_last=True)
+
+def sum_by_key(df, key_columns):
+    '''
+    Sum the value column of df for each (location, indicator) key in
+    key_columns, returning a (location_id, indicator_id, value) frame.
+    '''
+
+    if len(df) == 0:
+        return DataFrame(columns=CALC_COLUMNS)
+
+    grouped_df = df.groupby(key_columns)['value'].sum().reset_index()
+    grouped_df.columns = CALC_COLUMNS
+
+    return grouped_df
+
+def divide(numerator, denominator):
+    '''
+    Element wise division of two arrays where anything divided by zero
+    is zero.
+    '''
+
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+
+    has_denominator = denominator != 0
+    quotient = np.zeros(len(numerator))
+    quotient[has_denominator] = numerator[has_denominator] / \
+        denominator[has_denominator]
+
+    return quotient
+
+
+class CalculationCycleException(Exception):
+    defaultMessage = "The indicator calculations contain a cycle"
+
+    def __init__(self, indicator_ids):
+        self.indicator_ids = indicator_ids
+        self.message = '%s: %s' % (self.defaultMessage, indicator_ids)
+
+    def __str__(self):
+        return self.message
+
+
+class IndicatorCalcGraph(object):
+    '''
+    The CalculatedIndicatorComponent table compiled in to a dependency graph.
+
+    Calculated indicators are arranged in levels.  An indicator is in level 0
+    if all of its components are raw indicators, and in level n if the
+    deepest calculated indicator among its components is in level n - 1.
+    Evaluating the levels in order means that any depth and any mix of SUM,
+    part over whole and part of difference calculations is done in one pass.
+
+    The graph only changes when a calculation is edited, so it is built and
+    checked for cycles once, then cached per process until the
+    CalculatedIndicatorComponent table changes.
+
+    from rhizome.agg_tasks import IndicatorCalcGraph
+    graph = IndicatorCalcGraph.get_graph()
+    computed_df = graph.evaluate(raw_df)
+    '''
+
+    edge_columns = ['calc_indicator_id','indicator_component_id','calc']
+
+    ## calculation type -> the two components it is made of, in order. ##
+    ## the order of this list defines the priority for an indicator ##
+    ## that is defined with more than one type of calculation ##
+    calc_types = [
+        ('PART_TO_BE_SUMMED', None),
+        ('NUMERATOR', 'DENOMINATOR'),
+        ('WHOLE_OF_DIFFERENCE', 'PART_OF_DIFFERENCE'),
+    ]
+
+    _cache = {}
+
+    def __init__(self, edge_list):
+
+        known_calcs = set()
+        for calc_x, calc_y in self.calc_types:
+            known_calcs.update([calc_x, calc_y])
+
+        edge_df = DataFrame(edge_list, columns=self.edge_columns)
+        self.edge_df = edge_df[edge_df['calc'].isin(list(known_calcs))]
+
+        self.dependents = {}
+        for calc_indicator_id, component_id, calc in self.edge_df.values:
+            self.dependents.setdefault(component_id, set())\
+                .add(calc_indicator_id)
+
+        self.levels = self.build_levels()
+        self.level_edge_dfs = [self.edge_df[self.edge_df['calc_indicator_id']\
+            .isin(level)] for level in self.levels]
+
+    @classmethod
+    def get_graph(cls):
+        '''
+        Return the cached graph, re-building it only if the rows in the
+        CalculatedIndicatorComponent table have changed.
+        '''
+
+        version = tuple(sorted(CalculatedIndicatorComponent.objects\
+            .aggregate(Count('id'), Max('id'), Max('created_at')).items()))
+
+        try:
+            return cls._cache[version]
+        except KeyError:
+            pass
+
+        edge_list = list(CalculatedIndicatorComponent.objects\
+            .values_list('indicator_id','indicator_component_id','calculation'))
+
+        cls._cache.clear()
+        cls._cache[version] = cls(edge_list)
+
+        return cls._cache[version]
+
+    def build_levels(self):
+        '''
+        Kahn's algorithm, taking one whole level of indicators at a time.  If
+        at some point no indicator is ready to be calculated, the remaining
+        indicators depend on each other and we raise an exception.
+        '''
+
+        components = {}
+        for calc_indicator_id, component_id, calc in self.edge_df.values:
+            components.setdefault(calc_indicator_id, set()).add(component_id)
+
+        levels, calculated = [], set()
+        remaining = set(components.keys())
+
+        while remaining:
+
+            ready = [ind_id for ind_id in remaining if all(
+                component_id not in components or component_id in calculated
+                for component_id in components[ind_id])]
+
+            if not ready:
+                raise CalculationCycleException(sorted(remaining))
+
+            levels.append(sorted(ready))
+            calculated.update(ready)
+            remaining.difference_update(ready)
+
+        return levels
+
+    def get_dependent_indicator_ids(self, indicator_ids):
+        '''
+        Walk the graph from component to calculated indicator and return the
+        passed indicator_ids along with every indicator that is
+        ( recursively ) calculated from them.
+        '''
+
+        indicator_scope, to_visit = set(indicator_ids), list(indicator_ids)
+        while to_visit:
+            for calc_indicator_id in self.dependents.get(to_visit.pop(), []):
+                if calc_indicator_id not in indicator_scope:
+                    indicator_scope.add(calc_indicator_id)
+                    to_visit.append(calc_indicator_id)
+
+        return indicator_scope
+
+    def evaluate(self, raw_df):
+        '''
+        Given the stored (location_id, indicator_id, value) data, calculate
+        every calculated indicator level by level.  When evaluating a level,
+        the stored value of a component always takes precedence over the
+        value calculated for it in a previous level.
+
+        Returns the calculated values only.
+        '''
+
+        computed_df = DataFrame(columns=CALC_COLUMNS)
+
+        for level_edge_df in self.level_edge_dfs:
+
+            value_df = stack_calc_dfs([computed_df, raw_df])
+            level_df_list = [computed_df]
+
+            for calc_x, calc_y in self.calc_types:
+
+                calc_edge_df = level_edge_df[level_edge_df['calc']\
+                    .isin([calc_x, calc_y])]
+
+                if len(calc_edge_df) == 0:
+                    continue
+
+                ## add the values of each component to the calculation ##
+                dp_df_with_calc = calc_edge_df.merge(value_df,\
+                    left_on='indicator_component_id', right_on='indicator_id')
+
+                if calc_y is None:
+                    level_df_list.append(self.sum_of_parts(dp_df_with_calc))
+                else:
+                    level_df_list.append(self.calc_two_components(\
+                        dp_df_with_calc, calc_x, calc_y))
+
+            computed_df = stack_calc_dfs(level_df_list)
+
+        return computed_df
+
+    def sum_of_parts(self, dp_df_with_calc):
+        '''
+        For more info on this see:
+        https://github.com/unicef/rhizome/blob/master/docs/spec.rst#aggregation-and-calculation
+        '''
+
+        return sum_by_key(dp_df_with_calc, ['location_id','calc_indicator_id'])
+
+    def calc_two_components(self, dp_df_with_calc, calc_x, calc_y):
+        '''
+        Line up the value of the two components of a calculation side by side
+        for each location and calculated indicator, then do the calculation
+        on the two columns at once:
+
+            NUMERATOR / DENOMINATOR
+            (WHOLE_OF_DIFFERENCE - PART_OF_DIFFERENCE) / WHOLE_OF_DIFFERENCE
+        '''
+
+        key_columns = ['location_id','calc_indicator_id']
+
+        x_df = dp_df_with_calc[dp_df_with_calc['calc'] == calc_x]\
+            [key_columns + ['value']]
+        y_df = dp_df_with_calc[dp_df_with_calc['calc'] == calc_y]\
+            [key_columns + ['value']]
+        prepped_for_calc_df = x_df.merge(y_df, on=key_columns)
+
+        value_x = prepped_for_calc_df['value_x'].values
+        value_y = prepped_for_calc_df['value_y'].values
+
+        ## this is where the calculation happens ##
+        if calc_x == 'NUMERATOR':
+            calculated_values = divide(value_x, value_y)
+        else:
+            calculated_values = divide(value_x - value_y, value_x)
+
+        calc_df = DataFrame({
+            'location_id': prepped_for_calc_df['location_id'].values,
+            'indicator_id': prepped_for_calc_df['calc_indicator_id'].values,
+            'value': calculated_values,
+        }, columns = CALC_COLUMNS)
+
+        return calc_df[notnull(calc_df['value'])]
+
 
 class AggRefresh(object):
     '''
@@ -23,45 +293,95 @@ class AggRefresh(object):
           processed.
         - Executes stored pSQL stored procedures to first aggregate, then
           calculate information.
+
+    When ``incremental`` is True, only the (location, indicator) keys in the
+    AggRefreshQueue for the campaign ( see queue_changed_datapoints ) are
+    refreshed, along with every ancestor of those locations in the
+    LocationTree and every calculated indicator that depends on the changed
+    indicators.  Otherwise the whole campaign is deleted and rebuilt.
     '''
 
 
-    def __init__(self,campaign_id = None):
+    def __init__(self,campaign_id = None, incremental = False):
         '''
-        If there is a job running, return to with a status code of
-        "cache_running".
+        If another job is refreshing this campaign, return with a status of
+        "ANOTHER_AGG_IN_PROCESS".  Jobs for different campaigns do not block
+        each other, see lock_campaign().
 
-        If passed an explicit list of datapoints ids, then we process those
-        other wise the datapoint IDs to process are handled in the set_up()
-        method.
+        If no campaign_id is passed, the first campaign with datapoints that
+        need processing is refreshed.  Use AggRefreshScheduler in order to
+        refresh all of them.
         '''
 
+        ## in its own short transaction, so that the DataPoint rows are not
+        ## locked for the length of the refresh ##
+        if incremental:
+            queue_changed_datapoints()
+
         if not campaign_id:
-            campaign_id_list = self.get_campaign_ids_to_process()
-            campaign_id = campaign_id_list[0]
+            campaign_id_list = get_campaign_ids_to_process()
+            campaign_id = campaign_id_list[0] if campaign_id_list else None
 
         self.cache_job = None
+        self.response_msg = 'NO_CAMPAIGN_TO_PROCESS'
 
         self.dp_columns =['location_id','indicator_id',\
             'value','cache_job_id']
 
-        self.dwc_batch, self.dwc_tuple_dict = [],{}
+        self.computed_df = DataFrame(columns=CALC_COLUMNS)
 
-        if CacheJob.objects.filter(response_msg = 'PENDING'):
+        ## None means "the whole campaign", see set_incremental_scope ##
+        self.incremental = incremental
+        self.location_scope, self.indicator_scope = None, None
+        self.changed_indicator_ids = None
+
+        if not campaign_id:
             return
 
-        self.campaign = Campaign.objects.get(id = campaign_id)
-        self.cache_job = CacheJob.objects.create(
-            is_error = False,
-            response_msg = 'PENDING'
-        )
+        ## the campaign row stays locked until this transaction commits ##
+        with transaction.atomic():
+
+            self.campaign = self.lock_campaign(campaign_id)
+            if not self.campaign:
+                self.response_msg = 'ANOTHER_AGG_IN_PROCESS'
+                return
+
+            self.cache_job = CacheJob.objects.create(
+                is_error = False,
+                response_msg = 'PENDING'
+            )
 
-        dp_ids_to_process = self.campaign.get_raw_datapoint_ids()
+            self.refresh()
+
+        ## the cached api responses are out of date now.  This is done once
+        ## the refresh has committed, so that the version is not locked for
+        ## the length of the refresh, and so that no response is cached from
+        ## the data as it was before the commit under the new version ##
+        bump_data_version()
+
+    def refresh(self):
+        '''
+        Mark the datapoints that we are processing with this cache_job_id,
+        run the aggregation and calculations and close out the cache job.
+
+        An incremental refresh does not update any DataPoint rows, as those
+        can be shared with other campaigns that are being refreshed at the
+        same time.  They were marked when they were queued.
+        '''
+
+        self.campaign_dp_ids = self.campaign.get_raw_datapoint_ids()
         top_lvl_location_id = self.campaign.top_lvl_location_id
 
-        ## update the datapoint table with this cache_job_id
-        DataPoint.objects.filter(id__in = dp_ids_to_process)\
-            .update(cache_job_id = self.cache_job.id)
+        if self.incremental:
+            self.set_incremental_scope()
+        else:
+            ## update the datapoint table with this cache_job_id
+            DataPoint.objects.filter(id__in = self.campaign_dp_ids)\
+                .update(cache_job_id = self.cache_job.id)
+
+            ## a full refresh covers anything queued for the campaign ##
+            AggRefreshQueue.objects.filter(campaign_id = self.campaign.id)\
+                .delete()
 
         self.document_id = SourceSubmission.objects.all()[0].document_id
         ## this is sketchy -- for aggregation we need to figure out how to
@@ -74,13 +394,32 @@ class AggRefresh(object):
         ## due until we bring back the aggregation / cacluclation framework.
 
 
-        response_msg = self.main()
+        self.response_msg = self.main()
 
         ## mark job as completed and save
         self.cache_job.date_completed = datetime.now()
-        self.cache_job.response_msg = response_msg
+        self.cache_job.response_msg = self.response_msg
         self.cache_job.save()
 
+    def lock_campaign(self, campaign_id):
+        '''
+        Take a row level lock on the campaign for the rest of the transaction.
+        This replaces the old check for *any* PENDING cache job, so that a
+        job only waits for jobs that are refreshing the same campaign.
+
+        NOWAIT makes postgres raise instead of blocking when the row is
+        already locked, in which case we return None and leave the campaign
+        for the job that holds the lock.  The savepoint keeps the outer
+        transaction usable after the error.
+        '''
+
+        try:
+            with transaction.atomic():
+                return Campaign.objects.select_for_update(nowait=True)\
+                    .get(id = campaign_id)
+        except OperationalError:
+            return None
+
     def main(self):
         '''
         '''
@@ -88,9 +427,19 @@ class AggRefresh(object):
         if not self.cache_job:
             return 'ANOTHER_AGG_IN_PROCESS'
 
+        if self.incremental and not self.changed_indicator_ids:
+            return 'NO_CHANGES'
+
         try:
-            self.agg_datapoints()
-            self.calc_datapoints()
+            ## savepoint, so that the cache job can be saved on error ##
+            with transaction.atomic():
+                self.calc_graph = IndicatorCalcGraph.get_graph()
+                if self.incremental:
+                    self.indicator_scope = self.calc_graph\
+                        .get_dependent_indicator_ids(self.changed_indicator_ids)
+
+                self.agg_datapoints()
+                self.calc_datapoints()
         except Exception as err:
             self.cache_job.is_error = True
             self.cache_job.response_msg = err
@@ -103,26 +452,64 @@ class AggRefresh(object):
 
         return 'SUCCESS'
 
-    def get_campaign_ids_to_process(self):
+    def set_incremental_scope(self):
+        '''
+        Take the keys queued for this campaign in the AggRefreshQueue ( from
+        changed and deleted datapoints ) and from those build the set of
+        keys that need to be refreshed:
+
+            - location_scope: the changed locations and all of their parents.
+              Any aggregate for these locations may have moved.
+            - changed_indicator_ids: the indicators that were changed.  These
+              are the only indicators that need to be re-aggregated.
+
+        The indicator_scope, that is the changed indicators plus every
+        calculated indicator that depends on them, is set in main() from the
+        IndicatorCalcGraph.
+        '''
 
-        try:
-            one_dp_that_needs_agg = DataPoint.objects\
-                .filter(cache_job_id = -1, value__gte = 0)[0]
-        except IndexError:
-            return
+        ## the queued keys are removed in this transaction, so they are only
+        ## gone from the queue once the refresh commits ##
+        queued_key_list = list(AggRefreshQueue.objects\
+            .filter(campaign_id = self.campaign.id)\
+            .values_list('id','location_id','indicator_id'))
 
-        location_id = one_dp_that_needs_agg.location_id
-        data_date = one_dp_that_needs_agg.data_date
+        AggRefreshQueue.objects.filter(id__in = [k[0] for k in \
+            queued_key_list]).delete()
 
-        date_no_datetime = data_date.date()
-        campaigns_in_date_range = Campaign.objects.filter(
-            start_date__lte = date_no_datetime, end_date__gte = data_date)
+        changed_location_ids = set([k[1] for k in queued_key_list])
+        self.changed_indicator_ids = set([k[2] for k in queued_key_list])
 
-        parent_location_list = LocationTree.objects\
-            .filter(location_id = location_id)\
-            .values_list('parent_location_id',flat=True)
+        parent_location_ids = LocationTreeIndex.get_index()\
+            .get_ancestor_ids(changed_location_ids)
+
+        self.location_scope = changed_location_ids.union(parent_location_ids)
+
+    def filter_to_scope(self, qs, indicator_scope):
+        '''
+        Limit a queryset of AggDataPoint or DataPointComputed rows for this
+        campaign to the keys that this job refreshes.
+        '''
+
+        if not self.incremental:
+            return qs
+
+        return qs.filter(location_id__in = self.location_scope,\
+            indicator_id__in = indicator_scope)
+
+    def filter_df_to_scope(self, df, indicator_scope):
+        '''
+        The DataFrame equivalent of filter_to_scope, used to drop the
+        calculated keys that this job is not responsible for writing.
+        '''
 
-        return [c.id for c in campaigns_in_date_range]
+        if not self.incremental:
+            return df
+
+        in_scope = df['location_id'].isin(list(self.location_scope)) & \
+            df['indicator_id'].isin(list(indicator_scope))
+
+        return df[in_scope]
 
     def agg_datapoints(self):
         '''
@@ -134,32 +521,38 @@ class AggRefresh(object):
         if the indicator is an integer ( summing percents and booleans
         regionally doesnt make sense.)
 
-        Here, we create a tuple_dict in which the unique key of (locaiton,
-        indicator, campaign) represents the key, and the cooresponding value
-        is the value.  This way we add to the dict the aggregated values, then
-        iterrate through the raw values, adding or updating the data in the
-        tuple dict before bulk inserting the data.
-
-        The tuple looks like:  {(1, 201, 164): 12, (2, 101, 168): .24}
+        Here, we build one frame of aggregated values and one of raw values,
+        keyed by (location_id, indicator_id).  The raw frame is stacked on top
+        of the aggregate frame so that when the keys are de-duplicated the raw
+        value wins, and the result is handed to the bulk insert as is.
         '''
 
-        agg_dp_batch, tuple_dict = [],{}
-        location_tree_columns = ['location_id','parent_location_id','lvl']
+        ## every location is needed here, not just the ones in scope, as
+        ## the aggregate of a parent is built from all of its children ##
+        dp_qs = DataPoint.objects.filter(id__in = self.campaign_dp_ids)
+        if self.incremental:
+            dp_qs = dp_qs.filter(indicator_id__in = self.changed_indicator_ids)
 
-        dp_df = DataFrame(list(DataPoint.objects\
-            .filter(cache_job_id = self.cache_job.id)\
-            .values_list(*self.dp_columns)),columns=self.dp_columns)
+        dp_df = DataFrame(list(dp_qs.values_list(*self.dp_columns)),\
+            columns=self.dp_columns)
 
-        ## NaN to None
-        no_nan_dp_df = dp_df.where((notnull(dp_df)), None)
+        ## null values ( None or NaN ) never make it in to the aggregate ##
+        dp_df = dp_df[notnull(dp_df['value'])].copy()
+        dp_df['value'] = dp_df['value'].astype(float)
+
+        ## i.e. every datapoint for the changed indicators was deleted, in
+        ## which case the aggregated rows in scope are removed ##
+        if len(dp_df) == 0:
+            self.merge_calc_df(AggDataPoint, DataFrame(columns=CALC_COLUMNS),\
+                self.changed_indicator_ids)
+            return
 
         ## represents the location heirarchy as a cache from the location table
-        location_tree_df = DataFrame(list(LocationTree.objects\
-            .filter(location_id__in=list(dp_df['location_id'].unique()))
-            .values_list(*location_tree_columns)),columns=location_tree_columns)
+        location_tree_df = LocationTreeIndex.get_index()\
+            .get_ancestor_df(dp_df['location_id'].unique())
 
         ## join the location tree to the datapoints
-        joined_location_df = no_nan_dp_df.merge(location_tree_df)
+        joined_location_df = dp_df.merge(location_tree_df)
 
         ## filter the joined dataframe so that we aggregate at the highest
         ## level for which there is stored data.  If we do not do this, then
@@ -172,286 +565,335 @@ class AggRefresh(object):
 
         integer_indicators = list(Indicator.objects.filter(
             data_format = 'int',
-            id__in = max_location_lvl_for_indicator_df['indicator_id']
+            id__in = list(max_location_lvl_for_indicator_df['indicator_id'])
         ).values_list('id', flat=True))
 
-        ## filter df to keep the data for the highest level per indicator ##
+        ## only aggregate integers ( not boolean or pct ) ##
         prepped_for_sum_df = joined_location_df\
             .merge(max_location_lvl_for_indicator_df,on=['indicator_id','lvl'])
+        prepped_for_sum_df = prepped_for_sum_df[prepped_for_sum_df\
+            ['indicator_id'].isin(integer_indicators)]
 
         ## group by parent_location_id and take the sum ##
-        grouped_df = DataFrame(prepped_for_sum_df\
-            .groupby(['parent_location_id', 'indicator_id'])\
-            ['value'].sum())
-
-        for ix, dp in grouped_df.iterrows():
-            ## only aggregate integers ( not boolean or pct )
-            if ix[1] in integer_indicators:
-                tuple_dict[ix] = dp.value
-
-        ## now add the raw data to the dict ( overriding agregate if exists )
-        for ix, dp in no_nan_dp_df.iterrows():
+        grouped_df = sum_by_key(prepped_for_sum_df,\
+            ['parent_location_id', 'indicator_id'])
 
-            if dp.value and dp.value != 'NaN' :
-                ## dont override null value from parent if sum exists for children
-                tuple_dict[(dp.location_id, dp.indicator_id)] = dp.value
+        ## the raw data goes last so that it overrides the aggregate ##
+        agg_df = stack_calc_dfs([grouped_df, \
+            dp_df[CALC_COLUMNS]])
+        agg_df = self.filter_df_to_scope(agg_df, self.changed_indicator_ids)
 
-            if dp.value == 0:
-                # pandas treats NaN as zero it seems so do this explicity
-                tuple_dict[(dp.location_id, dp.indicator_id)] = dp.value
+        self.merge_calc_df(AggDataPoint, agg_df, self.changed_indicator_ids)
 
+    def merge_calc_df(self, model, calc_df, indicator_scope):
+        '''
+        Upsert the (location_id, indicator_id, value) rows of calc_df for this
+        campaign and cache_job into either the AggDataPoint or
+        DataPointComputed table.  Rows in scope that are not in calc_df
+        anymore are deleted, see pg_utils.merge_model_df.
+        '''
 
-        ## now prep the batch for the bulk insert ##
-        for dp_unique_key, value in tuple_dict.iteritems():
-
-            dp_dict =  dict(zip(('location_id','indicator_id')\
-                ,dp_unique_key))
+        insert_df = calc_df[CALC_COLUMNS].copy()
+        insert_df['campaign_id'] = self.campaign.id
+        insert_df['cache_job_id'] = self.cache_job.id
 
-            dp_dict['campaign_id'] = self.campaign.id
-            dp_dict['value'] = value
-            dp_dict['cache_job_id'] = self.cache_job.id
+        if model == DataPointComputed:
+            insert_df['document_id'] = self.document_id
 
-            agg_dp_batch.append(AggDataPoint(**dp_dict))
+        replace_qs = self.filter_to_scope(model.objects\
+            .filter(campaign_id = self.campaign.id), indicator_scope)
 
-        AggDataPoint.objects.filter(campaign_id = self.campaign.id).delete()
-        AggDataPoint.objects.bulk_create(agg_dp_batch)
+        merge_model_df(model, insert_df, replace_qs = replace_qs)
 
     def calc_datapoints(self):
         '''
-        When the agg_datapoint method runs, it will leave the agg_datapoint table
-        in a state that all of the rows that were altered, and need to be cached
-        thats is the ``calc_refreshed`` column will = 'f' for all of the rows
-        that this task effected.
+        Read the aggregated and raw data for the campaign once, then hand it
+        to the IndicatorCalcGraph which calculates every calculated indicator
+        in dependency order.  The stored data goes in last, so the raw
+        indicator data will always override the calculated.
+        '''
 
-        To find out more about how calculation works, take a look at the
-        fn_calc_datapoint stored procedures
+        ## a calculation may use a component that did not change, so all ##
+        ## of the indicators are needed for the locations in scope ##
+        adp_qs = AggDataPoint.objects.filter(campaign_id = self.campaign.id)
+        if self.incremental:
+            adp_qs = adp_qs.filter(location_id__in = self.location_scope)
 
-        '''
+        raw_df = DataFrame(list(adp_qs.values_list(*CALC_COLUMNS)),\
+            columns = CALC_COLUMNS)
 
-        ## the order of these calculations defines their priority, meaning
-        ## since raw data is the last calculation, this will override all else
-        self.sum_of_parts()
-        self.part_over_whole()
-        self.part_of_difference()
-        self.raw_data()
+        self.computed_df = stack_calc_dfs([self.calc_graph.evaluate(raw_df),\
+            raw_df])
 
         self.upsert_computed()
 
         return []
 
-    def build_calc_df(self,calc_list):
-
-        calc_df = DataFrame(list(CalculatedIndicatorComponent.objects\
-            .filter(calculation__in= calc_list)\
-            .values_list('indicator_id','indicator_component_id','calculation'))\
-            ,columns=['calc_indicator_id','indicator_component_id','calc'])
-
-        return calc_df
-
-    def build_dp_df(self,indicator_id_list):
-
-        dp_df = DataFrame(list(AggDataPoint.objects.all()\
-            .filter(indicator_id__in = indicator_id_list\
-                .unique(),campaign_id = self.campaign.id)\
-            .values_list(*self.dp_columns)),columns=self.dp_columns)
-
-        return dp_df
-
-    def join_dp_to_calc(self, calc_df, dp_df):
-        '''
+    def upsert_computed(self):
         '''
-
-        ## join the above two dataframes in order to determine ##
-            ## which indicators require which caluclations ##
-        dp_df_with_calc = dp_df.merge(calc_df,left_on='indicator_id',right_on=\
-            'indicator_component_id')
-
-        return dp_df_with_calc
-
-    def build_recursive_sum_calc_df(self, initial_calc_df):
+        Using the computed_df that holds the unique key and associated value
+        for the various calculations, replace the existing campaign data with
+        the calculated frame.
         '''
-        TO DO -- handle test_recursive_sum test case
-        This only handles one level of recursion.. i.e. the following calc will
-        roll up properly.
 
-        "odk missed due to refusal" >> "odk missed total"
+        computed_df = self.filter_df_to_scope(self.computed_df,\
+            self.indicator_scope)
 
-        but this one below.. will not:
+        self.merge_calc_df(DataPointComputed, computed_df, self.indicator_scope)
 
-        "odk missed due to refusal -- male" >> "odk missed due to refusal" >>
-        "odk missed total"
+        refresh_datapoint_abstracted(self.campaign.id, self.location_scope,\
+            self.cache_job.id)
 
+    def get_datapoints_to_agg(self,limit=None):
+        '''
+        Since there are complicated dependencies for location aggregation, as
+        well as the interrationship between indicators, processing one campaign
+        at a time makes our code much simpler.
         '''
 
-        lvl_1_calc_df =  initial_calc_df.merge(initial_calc_df,\
-            left_on='calc_indicator_id',right_on='indicator_component_id')
-
-        lvl_1_df =  lvl_1_calc_df[['calc_indicator_id_y',\
-            'indicator_component_id_x']]
-
-        lvl_1_df.columns = ['calc_indicator_id', 'indicator_component_id']
+        dp_ids = DataPoint.objects.filter(campaign_id = self.campaign_id)\
+            .values_list('id',flat=True)
 
-        lvl_1_df['calc'] = 'PART_TO_BE_SUMMED'
-        lvl_1_df['lvl'] = 1
-        initial_calc_df['lvl'] = 0
+        return dp_ids
 
-        final_df = concat([initial_calc_df,lvl_1_df])
 
-        return final_df
+def refresh_datapoint_abstracted(campaign_id, location_ids = None,\
+    cache_job_id = -1):
+    '''
+    Re-build the DataPointAbstracted rows for a campaign ( and optionally
+    only for some of its locations ) from the DataPointComputed table.
 
-    def raw_data(self):
-        '''
-        Add the raw indicator data to the tuple dict.  This happens last so
-        the raw indicator data will always override the calculated.
-        '''
+    The indicator_json is put together in SQL, so the pivot costs one
+    grouped query per refresh instead of a pandas pivot per API request.
+    The delete and insert happen in one transaction, so readers see either
+    the old or the new rows.
 
-        for adp in AggDataPoint.objects.filter(campaign_id = self.campaign.id):
-            adp_tuple = (adp.location_id, adp.indicator_id)
-            self.dwc_tuple_dict[adp_tuple] = adp.value
+    The datapoint endpoint only reads the campaigns that have been built for
+    every location ( see DataPointAbstractedCampaign ), so refreshing some
+    locations of a campaign that has not been built yet builds all of them.
+    '''
 
-    def sum_of_parts(self):
-        '''
-        For more info on this see:
-        https://github.com/unicef/rhizome/blob/master/docs/spec.rst#aggregation-and-calculation
+    params = {'campaign_id': campaign_id, 'cache_job_id': cache_job_id}
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+
+        ## one refresh of a campaign at a time ##
+        list(Campaign.objects.select_for_update()\
+            .filter(id = campaign_id).values_list('id'))
+
+        is_built = DataPointAbstractedCampaign.objects\
+            .filter(campaign_id = campaign_id).exists()
+
+        location_sql = ''
+        if location_ids is not None and is_built:
+            location_sql = 'AND location_id = ANY(%(location_ids)s)'
+            params['location_ids'] = [int(l_id) for l_id in location_ids]
+
+        ## print the values with full precision ##
+        cursor.execute('SET LOCAL extra_float_digits = 3')
+
+        cursor.execute('''
+            DELETE FROM datapoint_abstracted
+            WHERE campaign_id = %%(campaign_id)s
+            %(location_sql)s;
+
+            INSERT INTO datapoint_abstracted
+            (location_id, campaign_id, indicator_json, cache_job_id)
+            SELECT
+                location_id
+                , campaign_id
+                , '{' || string_agg(
+                    '"' || indicator_id || '":[' ||
+                    CASE WHEN value IN ('NaN', 'Infinity', '-Infinity')
+                        THEN 'null' ELSE value::text END
+                    || ',' || id || ']'
+                , ',') || '}'
+                , %%(cache_job_id)s
+            FROM datapoint_with_computed
+            WHERE campaign_id = %%(campaign_id)s
+            %(location_sql)s
+            GROUP BY location_id, campaign_id;
+        ''' % {'location_sql': location_sql}, params)
+
+        if not is_built:
+            DataPointAbstractedCampaign.objects.create(\
+                campaign_id = campaign_id, cache_job_id = cache_job_id)
+
+
+def get_campaign_keys(dp_qs, dp_columns = ('location_id', 'indicator_id')):
+    '''
+    The distinct (campaign_id, *dp_columns) of every campaign that the
+    datapoints in dp_qs fall in to.  The datapoints are joined to the date
+    range of the campaigns in one query, and the rows whose location is not
+    in the tree of the campaign are then dropped with the LocationTreeIndex
+    ( see Campaign.get_raw_datapoint_ids ).
+    '''
 
-        '''
+    dp_sql, dp_params = dp_qs.values_list('id').query.sql_with_params()
 
-        ## get the indicator_ids we need to make the calculation ##
-        initial_calc_df = self.build_calc_df(['PART_TO_BE_SUMMED'])
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT DISTINCT c.id, c.top_lvl_location_id, d.location_id%(columns)s
+        FROM datapoint d
+        INNER JOIN campaign c
+            ON d.data_date >= c.start_date
+            AND d.data_date < c.end_date
+        WHERE d.id IN (%(dp_sql)s);
+    ''' % {'dp_sql': dp_sql, 'columns': ''.join([', d.%s' % c for c in \
+        dp_columns])}, dp_params)
 
-        ## handle recursive calculations ( see spec.rst link above ) ##
-        calc_df = self.build_recursive_sum_calc_df(initial_calc_df)
+    lti = LocationTreeIndex.get_index()
 
-        self_join_calc_df = calc_df.merge(calc_df, left_on =\
-            'indicator_component_id',right_on='calc_indicator_id',how='left')
+    return [(row[0],) + tuple(row[3:]) for row in cursor.fetchall() \
+        if lti.is_in_tree(row[1], row[2])]
 
-        ## get the datapoints for the above indicator_ids ##
-        dp_df = self.build_dp_df(calc_df['indicator_component_id'])
 
-        ## now join the above dataframe on itself to set up the calculation ##
-        dp_df_with_calc = self.join_dp_to_calc(calc_df, dp_df)
+def queue_datapoint_keys(dp_qs):
+    '''
+    Queue the keys of the datapoints in dp_qs for the incremental refresh of
+    every campaign that they fall in to.  This is called before datapoints
+    are deleted, so that the aggregated and calculated rows that were built
+    from them are removed by the next refresh.
 
-        ## take the sum of all of the component indicators ##
-        grouped_df = DataFrame(dp_df_with_calc.merge(dp_df_with_calc)\
-            .groupby(['location_id','calc_indicator_id'])\
-            ['value'].sum())
+    from rhizome.agg_tasks import queue_datapoint_keys
+    queue_datapoint_keys(DataPoint.objects.filter(id__in = dp_ids_to_delete))
+    '''
 
-        for ix, row_data in grouped_df.iterrows():
-            self.dwc_tuple_dict[ix] = row_data.value
+    queue_keys(get_campaign_keys(dp_qs))
 
-    def part_over_whole(self):
-        '''
-        This calculation is dependent on the "sum_of_parts" calculation, so in
-        addition to the datapoint_df, we need to get the newly computed
-        datapoints from the previous calculation ( dependent_calculation_dp_df )
-        '''
 
-        calc_df = self.build_calc_df(['NUMERATOR','DENOMINATOR'])
+def queue_keys(key_list):
+    '''
+    Add a list of (campaign_id, location_id, indicator_id) to the
+    AggRefreshQueue.
+    '''
 
-        ## get the datapoints for the above indicator_ids ##
-        dp_df = self.build_dp_df(calc_df['indicator_component_id'])
+    AggRefreshQueue.objects.bulk_create([AggRefreshQueue(campaign_id = c_id,\
+        location_id = l_id, indicator_id = i_id) for c_id, l_id, i_id in \
+            key_list])
 
-        ## now get a dataframe (dependent_calculation_dp_df) that represents ##
-        ## the newly calculated data.  This is necessary because the ##
-        ## denominator for the part/whole calculation is often a SUM ##
 
-        dwc_list_of_list = [[k[0],k[1],v,self.cache_job.id] for k,v in\
-            self.dwc_tuple_dict.iteritems()]
-        dependent_calculation_dp_df = DataFrame(dwc_list_of_list,columns=\
-            self.dp_columns)
-        unioned_dp_df = concat([dp_df,dependent_calculation_dp_df])
+def queue_changed_datapoints():
+    '''
+    Queue the keys of the datapoints that changed since the last refresh
+    ( cache_job_id = -1 ) for every campaign that they fall in to, and mark
+    the datapoints with a QUEUED cache job.
+
+    This runs in one short transaction before the campaigns are refreshed,
+    so that:
+        - a change is seen by every campaign that the datapoint is in, and
+          not only by the first one to be refreshed.
+        - the refreshes of campaigns that share datapoints ( overlapping
+          dates and locations ) never update the same DataPoint rows, and
+          so do not wait on or deadlock with each other.
+
+    Datapoints that are not in any campaign keep cache_job_id = -1.
+    '''
 
-        ## add the calculation metadata to the df
-        dp_df_with_calc = self.join_dp_to_calc(calc_df, unioned_dp_df)
+    with transaction.atomic():
 
-        ## now join the above dataframe on itself to set up the calculation ##
-        prepped_for_calc_df = dp_df_with_calc.merge(dp_df_with_calc,\
-            on=['location_id','calc_indicator_id'])
+        campaign_key_list = get_campaign_keys(DataPoint.objects\
+            .filter(cache_job_id = -1), ('id', 'location_id', 'indicator_id'))
 
-        ## iterate through the dataframe, perform the calculation and add
-        ## to the dwc_tuple_dict.  ( this could use some clean up )
-        for ix, row_data in prepped_for_calc_df.iterrows():
+        if len(campaign_key_list) == 0:
+            return
 
-            if row_data.calc_x == 'NUMERATOR' \
-                and row_data.calc_y == 'DENOMINATOR':
+        queue_job = CacheJob.objects.create(
+            is_error = False,
+            response_msg = 'QUEUED',
+            date_completed = datetime.now()
+        )
 
-                row_tuple = (row_data.location_id, row_data.calc_indicator_id)
+        queue_keys(set([(c_id, l_id, i_id) for c_id, dp_id, l_id, i_id \
+            in campaign_key_list]))
 
-                ## this one line is where the calculation happens ##
-                try:
-                    calculated_value = (row_data.value_x / row_data.value_y)
-                except ZeroDivisionError:
-                    calculated_value = 0
+        DataPoint.objects.filter(cache_job_id = -1, id__in = list(set(\
+            [k[1] for k in campaign_key_list])))\
+            .update(cache_job_id = queue_job.id)
 
-                self.dwc_tuple_dict[row_tuple] = calculated_value
 
+def get_campaign_ids_to_process():
+    '''
+    Return the ids of every campaign that has keys waiting in the
+    AggRefreshQueue, or a datapoint with a value that changed since the last
+    refresh ( cache_job_id = -1 and value >= 0 ).  The changed datapoints
+    are joined to the date range of every campaign in one query, see
+    get_campaign_keys.
+    '''
 
-    def part_of_difference(self):
-        '''
-        (x - y) / x
-        '''
+    campaign_ids = set(AggRefreshQueue.objects\
+        .values_list('campaign_id', flat=True).distinct())
 
-        calc_list = ['WHOLE_OF_DIFFERENCE','PART_OF_DIFFERENCE']
+    campaign_ids.update([k[0] for k in get_campaign_keys(DataPoint.objects\
+        .filter(cache_job_id = -1, value__gte = 0), ())])
 
-        ## get the indicator_ids we need to make the calculation ##
-        calc_df = self.build_calc_df(calc_list)
+    return sorted(campaign_ids)
 
-        ## get the datapoints for the above indicator_ids and join with dps ##
-        dp_df = self.build_dp_df(calc_df['indicator_component_id'])
-        dp_df_with_calc = self.join_dp_to_calc(calc_df, dp_df)
 
-        ## now join the above dataframe on itself to set up the calculation ##
-        prepped_for_calc_df = dp_df_with_calc.merge(dp_df_with_calc,\
-            on=['location_id','calc_indicator_id'])
+def refresh_campaign(campaign_id, incremental = True):
+    '''
+    Worker for the AggRefreshScheduler pool.  This needs to be a module level
+    function so that multiprocessing can pickle it.
+    '''
 
-        ## iterrate through the dataframe above, determine the calculated value
-        ## and finally, create the tuple dict calue for the - calculated data
-        for ix, row_data in prepped_for_calc_df.iterrows():
+    ar = AggRefresh(campaign_id, incremental = incremental)
 
-            if row_data.calc_x == 'WHOLE_OF_DIFFERENCE' \
-                and row_data.calc_y == 'PART_OF_DIFFERENCE':
+    return campaign_id, unicode(ar.response_msg)
 
-                row_tuple = (row_data.location_id, row_data.calc_indicator_id)
 
-                ## this one line is where the calculation happens ##
-                try:
-                    calculated_value = (row_data.value_x - row_data.value_y) / \
-                        row_data.value_x
-                except ZeroDivisionError:
-                    calculated_value = 0
+class AggRefreshScheduler(object):
+    '''
+    Refresh every campaign that has datapoints waiting to be processed,
+    instead of one campaign per run of the cron job.
+
+    The changed datapoints are first queued for every campaign that they
+    are in ( see queue_changed_datapoints ).  Each campaign is then
+    refreshed by an AggRefresh in a pool of worker processes, with its own
+    CacheJob.  An incremental refresh only writes the AggDataPoint,
+    DataPointComputed and AggRefreshQueue rows of its own campaign, so the
+    campaigns can run concurrently even when they share datapoints, and the
+    row lock that each AggRefresh takes on its campaign keeps two workers
+    ( or two cron runs ) from refreshing the same one.
+
+    A full refresh marks every datapoint of the campaign, so when
+    incremental is False the campaigns are refreshed one after another.
+
+    from rhizome.agg_tasks import AggRefreshScheduler
+    results = AggRefreshScheduler().main()
+    '''
 
-                self.dwc_tuple_dict[row_tuple] = calculated_value
+    def __init__(self, processes = None, incremental = True):
 
+        self.processes = processes or getattr(settings,\
+            'AGG_REFRESH_PROCESSES', None) or cpu_count()
+        self.incremental = incremental
 
-    def upsert_computed(self):
+    def main(self):
         '''
-        Using the tuple dict that defined the unique key and associated value
-        for the various calculations, prepare this bulk insert, delete the
-        existing campaign data then perform the bulk insert.
+        Returns a dictionary of campaign_id -> response message.
         '''
-        for uq_tuple, val in self.dwc_tuple_dict.iteritems():
-
-            dwc_dict = {'location_id': uq_tuple[0],
-                'indicator_id': uq_tuple[1],
-                'campaign_id': self.campaign.id,
-                'value': val,
-                'cache_job_id': self.cache_job.id,
-                'document_id': self.document_id
-            }
 
-            self.dwc_batch.append(DataPointComputed(**dwc_dict))
+        if self.incremental:
+            queue_changed_datapoints()
 
-        DataPointComputed.objects.filter(campaign_id=self.campaign.id).delete()
-        DataPointComputed.objects.bulk_create(self.dwc_batch)
+        campaign_ids = get_campaign_ids_to_process()
+        processes = min(self.processes, len(campaign_ids)) \
+            if self.incremental else 1
 
-    def get_datapoints_to_agg(self,limit=None):
-        '''
-        Since there are complicated dependencies for location aggregation, as
-        well as the interrationship between indicators, processing one campaign
-        at a time makes our code much simpler.
-        '''
+        if processes <= 1:
+            return dict([refresh_campaign(c_id, self.incremental)\
+                for c_id in campaign_ids])
 
-        dp_ids = DataPoint.objects.filter(campaign_id = self.campaign_id)\
-            .values_list('id',flat=True)
+        ## forked workers can not share the parent's database connection.
+        ## close it so that every process opens its own ##
+        connections.close_all()
 
-        return dp_ids
+        pool = Pool(processes = processes)
+        try:
+            results = [pool.apply_async(refresh_campaign,\
+                (c_id, self.incremental)) for c_id in campaign_ids]
+            return dict([r.get() for r in results])
+        finally:
+            pool.close()
+            pool.join()
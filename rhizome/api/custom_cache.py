@@ -1,5 +1,49 @@
+import hashlib
+import urllib
+
+from django.conf import settings
+from django.core.cache import caches
 from tastypie.cache import SimpleCache
 
+from rhizome.models import DataVersion
+
+## where the current data version is kept for a few seconds, so that most
+## requests do not have to read it from the database ##
+DATA_VERSION_CACHE_KEY = 'rhizome_data_version'
+
+## query params that do not change the response ( jquery's cache buster ) ##
+IGNORED_PARAMS = ['_']
+
+
+def get_data_version():
+    '''
+    The current DataVersion.  It is read from the database at most once
+    every DATA_VERSION_CACHE_SECONDS.
+    '''
+
+    cache = caches['default']
+    version = cache.get(DATA_VERSION_CACHE_KEY)
+
+    if version is None:
+        version = DataVersion.get_version()
+        cache.set(DATA_VERSION_CACHE_KEY, version, getattr(settings,\
+            'DATA_VERSION_CACHE_SECONDS', 5))
+
+    return version
+
+
+def bump_data_version():
+    '''
+    Invalidate every cached API response.  Called when the data behind the
+    API changes.
+
+    from rhizome.api.custom_cache import bump_data_version
+    bump_data_version()
+    '''
+
+    DataVersion.bump()
+    caches['default'].delete(DATA_VERSION_CACHE_KEY)
+
 class CustomCache(SimpleCache):
     '''
     Set up to override the simple cache method in order to customize the
@@ -35,3 +79,47 @@ class CustomCache(SimpleCache):
         else:
             self.response['Cache-Control'] = cache_control
             return {}
+
+    def caches_responses(self):
+        '''
+        The response cache is off unless API_RESPONSE_CACHE_SECONDS is set.
+        '''
+
+        return getattr(settings, 'API_RESPONSE_CACHE_SECONDS', 0) > 0
+
+    def get_response_key(self, request, top_lvl_location_id):
+        '''
+        The key of the cached response for a request.  The query params are
+        sorted so that the same request always gets the same key, and the
+        data version is part of the key, so bumping it invalidates every
+        cached response.
+        '''
+
+        params = sorted([(k, v) for k, values in request.GET.lists() \
+            for v in values if k not in IGNORED_PARAMS])
+
+        request_hash = hashlib.md5('|'.join([
+            request.path.encode('utf-8'),
+            urllib.urlencode([(k.encode('utf-8'), v.encode('utf-8'))\
+                for k, v in params]),
+            request.META.get('HTTP_ACCEPT', ''),
+            str(top_lvl_location_id),
+        ])).hexdigest()
+
+        return 'api_response:%s:%s' % (get_data_version(), request_hash)
+
+    def get_etag(self, response_key):
+
+        return '"%s"' % hashlib.md5(response_key).hexdigest()
+
+    def get_response(self, response_key):
+        '''
+        The ( content, content_type ) cached for response_key, or None.
+        '''
+
+        return self.get(response_key)
+
+    def set_response(self, response_key, response):
+
+        self.set(response_key, (response.content, response['Content-Type']),\
+            settings.API_RESPONSE_CACHE_SECONDS)
@@ -0,0 +1,74 @@
+import time
+
+from django.conf import settings
+
+from rhizome.models import LocationPermission, Location, DataVersion
+from rhizome.api.custom_cache import get_data_version, bump_data_version
+from rhizome.cache_meta import LocationTreeIndex
+
+## user_id -> (versions, expires_at, permission_context), local to the
+## process, like the LocationTreeIndex ##
+_permission_contexts = {}
+
+
+def get_context_versions():
+    '''
+    The data version and the LOCATION_TREE version that a permission context
+    was built at.  Both are kept in the local cache for a few seconds, so
+    most requests do not query the database for them.
+    '''
+
+    return (get_data_version(),\
+        DataVersion.get_cached_version_key(DataVersion.LOCATION_TREE))
+
+
+def get_permission_context(user_id):
+    '''
+    The top_lvl_location_id of a user, and the location_ids they are allowed
+    to see ( the top level location and everything under it ).  This is
+    built once and kept in the process until the data version or the
+    location tree changes, or for PERMISSION_CONTEXT_SECONDS at the most.
+
+    from rhizome.api.permission_context import get_permission_context
+    permission_context = get_permission_context(request.user.id)
+    '''
+
+    versions = get_context_versions()
+
+    try:
+        cached_versions, expires_at, permission_context = \
+            _permission_contexts[user_id]
+        if cached_versions == versions and expires_at > time.time():
+            return permission_context
+    except KeyError:
+        pass
+
+    try:
+        top_lvl_location_id = LocationPermission.objects.get(
+            user_id = user_id).top_lvl_location_id
+    except LocationPermission.DoesNotExist:
+        top_lvl_location_id = Location.objects\
+            .filter(parent_location_id = None)[0].id
+
+    permission_context = {
+        'top_lvl_location_id': top_lvl_location_id,
+        'location_ids': LocationTreeIndex.get_index()\
+            .get_descendant_ids([top_lvl_location_id]),
+    }
+
+    _permission_contexts[user_id] = (versions, time.time() + \
+        getattr(settings, 'PERMISSION_CONTEXT_SECONDS', 300),\
+        permission_context)
+
+    return permission_context
+
+
+def clear_permission_context(user_id):
+    '''
+    Called when the LocationPermission of a user changes.  Bumping the data
+    version makes every other process build the context again, and drops
+    the api responses that were cached for the old top level location.
+    '''
+
+    _permission_contexts.pop(user_id, None)
+    bump_data_version()
@@ -17,6 +17,9 @@ class AggRefreshResource(BaseModelResource):
 
        cache_job_id = -1 --> NEEDS PROCESSING
        cache_job_id = -2 --> NEEDS CAMPAIGN ASSOCIATED
+
+       Passing a campaign_id rebuilds that whole campaign, otherwise only
+       the datapoints that changed since the last refresh are processed.
        '''
 
        try:
@@ -24,6 +27,6 @@ class AggRefreshResource(BaseModelResource):
            ar = AggRefresh(campaign_id)
            return Campaign.objects.filter(id=campaign_id).values()
        except KeyError:
-           ar = AggRefresh()
+           ar = AggRefresh(incremental=True)
            return Office.objects.all().values()
 
@@ -9,11 +9,13 @@ from tastypie.resources import Resource
 
 from rhizome.api.serialize import CustomSerializer
 from rhizome.api.custom_session_authentication import CustomSessionAuthentication
-from rhizome.api.custom_cache import CustomCache
+from rhizome.api.custom_cache import CustomCache, bump_data_version
 from rhizome.api.exceptions import DatapointsException
+from rhizome.api.permission_context import get_permission_context
 
-from rhizome.models import LocationPermission, Location, LocationTree
-from django.http import HttpResponse
+from rhizome.cache_meta import LocationTreeIndex
+from django.http import HttpResponse, HttpResponseNotModified
+from django.http.response import HttpResponseBase
 
 class BaseResource(Resource):
     '''
@@ -33,10 +35,10 @@ class BaseResource(Resource):
         to fulfill the request based on the four rules below.
 
         1. location_id__in =
-        2. parent_location_id__in =
-
-        right now -- this only filters if there is no param.. i should get the
-        permitted locations first then do an intersection with the params..
+        2. parent_location_id__in = , limited to the user's
+           top_lvl_location_id and the locations under it.
+        3. otherwise, the locations under the user's top_lvl_location_id,
+           which are kept in their permission context.
         '''
 
         try:
@@ -48,37 +50,22 @@ class BaseResource(Resource):
         try:
             pl_id_list = request.GET['parent_location_id__in'].split(',')
 
-            location_ids = list(LocationTree.objects\
-                        .filter(parent_location_id__in=pl_id_list)
-                        .values_list('location_id',flat=True))
-
-            ## provinces ##
-            prov_and_country_ids = Location.objects\
-                .filter(location_type__name__in=['Province','Country'])\
-                .values_list('id',flat=True)
-
-            ## districts ##
-            dist_ids = Location.objects.filter(lpd_status__in=[1,2])\
-                .values_list('id',flat=True)
-
-            prov_country_and_district_ids = list(prov_and_country_ids) \
-                + list(dist_ids)
+            lti = LocationTreeIndex.get_index()
 
-            filtered_location_ids = list(set(location_ids)\
-                .intersection(set(prov_country_and_district_ids)))
+            ## provinces and countries, and the lpd districts, that the
+            ## user is allowed to see ##
+            prov_country_and_district_mask = (lti.get_mask(\
+                location_type_names = ['Province','Country']) | \
+                lti.get_mask(lpd_statuses = [1,2])) & \
+                lti.get_tree_mask(self.top_lvl_location_id)
 
-            return filtered_location_ids
+            return lti.get_descendant_ids(pl_id_list,\
+                mask = prov_country_and_district_mask)
 
         except KeyError:
             pass
 
-        location_qs = (
-            LocationTree.objects
-            .filter(parent_location_id=self.top_lvl_location_id)
-            .values_list('location_id', flat=True)
-        )
-
-        return location_qs
+        return self.location_ids_for_user
 
 
     def dispatch(self, request_type, request, **kwargs):
@@ -86,12 +73,9 @@ class BaseResource(Resource):
         Overrides Tastypie and calls get_list.
         """
 
-        try:
-            self.top_lvl_location_id = LocationPermission.objects.get(
-                user_id = request.user.id).top_lvl_location_id
-        except LocationPermission.DoesNotExist:
-            self.top_lvl_location_id = Location.objects\
-                .filter(parent_location_id = None)[0].id
+        permission_context = get_permission_context(request.user.id)
+        self.top_lvl_location_id = permission_context['top_lvl_location_id']
+        self.location_ids_for_user = permission_context['location_ids']
 
         allowed_methods = getattr(self._meta, "%s_allowed_methods" % request_type, None)
         #
@@ -106,6 +90,32 @@ class BaseResource(Resource):
 
         self.is_authenticated(request)
         self.throttle_check(request)
+
+        ## resources with cache_responses = True in their Meta serve GETs
+        ## from the response cache, which is invalidated by bumping the data
+        ## version.  see api/custom_cache.py ##
+        cache_responses = request.method == 'GET' and \
+            getattr(self._meta, 'cache_responses', False) and \
+            self._meta.cache.caches_responses()
+
+        if cache_responses:
+            response_key = self._meta.cache.get_response_key(request,\
+                self.top_lvl_location_id)
+            etag = self._meta.cache.get_etag(response_key)
+
+            if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+
+            cached_response = self._meta.cache.get_response(response_key)
+
+            if cached_response is not None:
+                content, content_type = cached_response
+                response = HttpResponse(content, content_type = content_type)
+                response['ETag'] = etag
+                return response
+
         # All clear. Process the request.
 
         # If what comes back isn't a ``HttpResponse``, assume that the
@@ -137,7 +147,16 @@ class BaseResource(Resource):
                 response_class=http.HttpApplicationError
             )
 
-        if not isinstance(response, HttpResponse):
-            return http.HttpNoContent()
+        if not isinstance(response, HttpResponseBase):
+            response = http.HttpNoContent()
+
+        if cache_responses and isinstance(response, HttpResponse) and \
+            response.status_code == 200:
+            response['ETag'] = etag
+            self._meta.cache.set_response(response_key, response)
+
+        elif request.method in ['POST', 'PUT', 'PATCH', 'DELETE'] and \
+            response.status_code < 400:
+            bump_data_version()
 
         return response
@@ -1,13 +1,15 @@
 import json
+from itertools import chain
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 
 from tastypie.authorization import Authorization
 from tastypie.authentication import ApiKeyAuthentication, MultiAuthentication
 from tastypie.resources import ModelResource
 from tastypie import http
 
-from rhizome.api.serialize import CustomSerializer
+from rhizome.api.serialize import CustomSerializer, RawJSON, iter_json_list
 from rhizome.api.custom_session_authentication import CustomSessionAuthentication
 from rhizome.api.custom_cache import CustomCache
 from rhizome.api.exceptions import DatapointsException
@@ -128,22 +130,22 @@ class BaseModelResource(ModelResource, BaseResource):
         if self.Meta.resource_name == 'datapointentry':
             return super(ModelResource, self).get_list(request, **kwargs)
 
+        page_limit = self.get_page_limit(request)
+
+        if page_limit is not None and hasattr(objects, 'query') and \
+            objects.query.can_filter():
+            return self.get_page_response(request, objects, page_limit)
+
         if len(objects) > 0:
             # find json_fields ( should be explicit here and check data type)
             # of the field, but for this works..
             json_obj_keys = [k for k, v in objects[0].items() if 'json' in k]
 
-        for obj in objects:
-
-            # serialize json fields ##
-            for json_key in json_obj_keys:
-                obj[json_key] = json.loads(obj[json_key])
+        raw_json = self.determine_format(request) == 'application/json'
 
-            # hack lvl attribute
-            if 'location_type_id' in obj:
-                obj['lvl'] = obj['location_type_id'] - 1
+        for obj in objects:
 
-            bundles.append(obj)
+            bundles.append(self.prepare_object(obj, json_obj_keys, raw_json))
 
         response_meta = self.get_response_meta(len(objects))
 
@@ -155,6 +157,111 @@ class BaseModelResource(ModelResource, BaseResource):
 
         return self.create_response(request, response_data)
 
+    def prepare_object(self, obj, json_obj_keys, raw_json = False):
+        '''
+        With raw_json the text of the json fields is passed through to the
+        serializer as RawJSON, and is written in to the response as is.
+        Otherwise ( i.e. for csv ) it is decoded so the serializer can use it.
+        '''
+
+        # serialize json fields ##
+        for json_key in json_obj_keys:
+            if obj[json_key] is None:
+                continue
+
+            if raw_json:
+                obj[json_key] = RawJSON(obj[json_key])
+            else:
+                obj[json_key] = json.loads(obj[json_key])
+
+        # hack lvl attribute
+        if 'location_type_id' in obj:
+            obj['lvl'] = obj['location_type_id'] - 1
+
+        return obj
+
+    def get_page_limit(self, request):
+        '''
+        Pagination is opt in: if the request has a cursor or a limit param,
+        return the page size, bounded by API_MAX_PAGE_SIZE.  Otherwise None,
+        and the whole list is returned as before.  As in tastypie, limit=0
+        means no pagination.
+        '''
+
+        if 'cursor' not in request.GET and 'limit' not in request.GET:
+            return None
+
+        max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+
+        try:
+            limit = int(request.GET.get('limit', max_page_size))
+        except ValueError:
+            raise DatapointsException('limit must be an integer')
+
+        if limit < 0:
+            raise DatapointsException('limit must not be negative')
+
+        if limit == 0:
+            return None
+
+        return min(limit, max_page_size)
+
+    def get_page_response(self, request, objects, page_limit):
+        '''
+        Keyset pagination: return the first page_limit objects with an id
+        greater than the cursor param, in order of id.  The meta has the
+        next_cursor to pass to get the next page, which is None on the last
+        page.  Unlike an offset, the cost of a page does not grow with how
+        far in to the list it is.
+
+        The meta is written before the objects, so the next_cursor ( the id
+        of the last object of a full page ) is looked up on its own, whether
+        or not the id is one of the values returned.  total_count is the
+        length of the whole list, as when it is not paginated.
+
+        JSON responses are streamed one object at a time, as the page is
+        read from the database.
+        '''
+
+        try:
+            cursor = int(request.GET.get('cursor', 0))
+        except ValueError:
+            raise DatapointsException('cursor must be an integer')
+
+        page_qs = objects.filter(id__gt = cursor).order_by('id')
+
+        next_cursor = None
+        last_id_list = list(page_qs.values_list('id', flat=True)\
+            [page_limit - 1:page_limit])
+        if last_id_list:
+            next_cursor = last_id_list[0]
+
+        response_meta = self.get_response_meta(objects.count())
+        response_meta.update({'limit': page_limit, 'next_cursor': next_cursor})
+
+        ## the json keys are found from the first object ##
+        page = page_qs[:page_limit].iterator()
+        first_obj = next(page, None)
+
+        json_obj_keys, page_objects = [], []
+        if first_obj is not None:
+            json_obj_keys = [k for k in first_obj.keys() if 'json' in k]
+            page_objects = chain([first_obj], page)
+
+        if self.determine_format(request) != 'application/json':
+            return self.create_response(request, {
+                'objects': [self.prepare_object(obj, json_obj_keys) \
+                    for obj in page_objects],
+                'meta': response_meta,
+                'error': None,
+            })
+
+        objects_to_stream = (self.prepare_object(obj, json_obj_keys, True) \
+            for obj in page_objects)
+
+        return StreamingHttpResponse(iter_json_list(self._meta.serializer,\
+            objects_to_stream, response_meta), content_type = 'application/json')
+
     def get_response_meta(self, object_len):
 
         meta_dict = {
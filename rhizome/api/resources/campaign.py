@@ -6,6 +6,7 @@ from rhizome.models import Campaign
 class CampaignResource(BaseModelResource):
     class Meta(BaseModelResource.Meta):
         resource_name = 'campaign'
+        cache_responses = True
 
     def get_detail(self, request, **kwargs):
         bundle = self.build_bundle(request=request)
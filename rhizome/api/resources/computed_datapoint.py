@@ -1,6 +1,7 @@
 from rhizome.api.resources.base_model import BaseModelResource
 from rhizome.models import DataPointComputed
 from rhizome.models import SourceObjectMap, DocumentSourceObjectMap
+from rhizome.agg_tasks import refresh_datapoint_abstracted
 
 class ComputedDataPointResource(BaseModelResource):
     class Meta(BaseModelResource.Meta):
@@ -21,6 +22,28 @@ class ComputedDataPointResource(BaseModelResource):
 
         return self.save(bundle)
 
+    def save(self, bundle, skip_errors=False):
+        '''
+        Creating or updating a computed datapoint changes what the datapoint
+        endpoint returns, so the pivoted row for it is refreshed as well.
+        '''
+
+        bundle = super(ComputedDataPointResource, self).save(bundle,\
+            skip_errors)
+
+        refresh_datapoint_abstracted(bundle.obj.campaign_id,\
+            [bundle.obj.location_id])
+
+        return bundle
+
+    def obj_delete(self, bundle, **kwargs):
+
+        dwc = self.obj_get(bundle=bundle, **kwargs)
+
+        super(ComputedDataPointResource, self).obj_delete(bundle, **kwargs)
+
+        refresh_datapoint_abstracted(dwc.campaign_id, [dwc.location_id])
+
     def get_object_list(self, request):
 
         try:
@@ -1,10 +1,12 @@
-import numpy as np
+import csv
+import json
 import sys
-from pandas import DataFrame, pivot_table, notnull
+from itertools import groupby
+from operator import itemgetter
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 
-from tastypie import fields
+from tastypie import fields, http
 from tastypie.utils.mime import build_content_type
 from tastypie.exceptions import NotFound
 
@@ -12,7 +14,52 @@ from rhizome.api.serialize import CustomSerializer
 from rhizome.api.resources.base_non_model import BaseNonModelResource
 
 from rhizome.models import DataPointComputed, Campaign, Location,\
-    LocationPermission, LocationTree
+    LocationPermission, DataPointAbstracted, DataPointAbstractedCampaign,\
+    Indicator
+from rhizome.cache_meta import LocationTreeIndex
+from rhizome.pg_utils import iter_queryset
+
+
+class Echo(object):
+    '''
+    A file like object for the csv writer that hands back each row that it
+    is given, instead of buffering it, so the rows can be streamed.
+    '''
+
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    '''
+    Empty cells for missing data, and floats written in full precision.
+    '''
+
+    if value is None or value != value:
+        return ''
+
+    return repr(value)
+
+
+def has_value(value):
+    '''
+    Null, NaN and infinite values are all stored as null in the
+    datapoint_abstracted table, as they have no JSON representation.
+    '''
+
+    return value is not None and value == value and \
+        value not in (float('inf'), float('-inf'))
+
+
+def encode_csv(value):
+    '''
+    The python 2 csv module does not handle unicode.
+    '''
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
 
 
 class ResultObject(object):
@@ -26,6 +73,60 @@ class ResultObject(object):
     indicators = list()
 
 
+class ResultObjectList(object):
+    '''
+    The ResultObjects for the (location_id, campaign_id) -> indicator_dict
+    mapping in row_data, built only when they are accessed.  Tastypie needs
+    the length of the result and a slice of it for the page it returns, so
+    the rows that are not on the page are never built.
+
+    Each ResultObject has an entry for every requested indicator, the ones
+    that have data first, then the missing ones.
+    '''
+
+    def __init__(self, row_data, indicator_ids):
+
+        self.row_data = row_data
+        self.keys = sorted(row_data.keys())
+        self.indicator_ids = sorted(set(indicator_ids))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for row in self.keys:
+            yield self.build_result_object(row)
+
+    def __getitem__(self, ix):
+
+        if isinstance(ix, slice):
+            return [self.build_result_object(row) for row in self.keys[ix]]
+
+        return self.build_result_object(self.keys[ix])
+
+    def build_result_object(self, row):
+
+        indicator_dict = self.row_data[row]
+
+        indicator_objects = [{
+            'indicator': unicode(ind),
+            'computed': indicator_dict[ind][1],
+            'value': indicator_dict[ind][0]
+        } for ind in self.indicator_ids if ind in indicator_dict]
+
+        missing_indicators = set(self.indicator_ids)\
+            .difference(indicator_dict)
+        indicator_objects.extend([{'indicator': ind, 'value': None,\
+            'computed_id': None} for ind in sorted(missing_indicators)])
+
+        r = ResultObject()
+        r.location = row[0]
+        r.campaign = row[1]
+        r.indicators = indicator_objects
+
+        return r
+
+
 class DatapointResource(BaseNonModelResource):
     '''
     This is the class that coincides with the /api/v1/datapoint endpoint.
@@ -53,6 +154,7 @@ class DatapointResource(BaseNonModelResource):
 
         object_class = ResultObject  # use the class above to define response
         resource_name = 'datapoint'  # cooresponds to the URL of the resource
+        cache_responses = True
         max_limit = None  # return all rows by default ( limit defaults to 20 )
         serializer = CustomSerializer()
 
@@ -86,27 +188,18 @@ class DatapointResource(BaseNonModelResource):
 
         return response
 
-    def get_object_list(self, request):
+    def set_up_request(self, request):
         '''
-        This is where the action happens in this resource.  AFter passing the
-        url paremeters, get the list of locations based on the parameters passed
-        in the url as well as the permissions granted to the user responsible
-        for the request.
-        Using the location_ids from the get_locations_to_return_from_url method
-        we query the datapoint abstracted table, then iterate through these
-        values cleaning the indicator_json based in the indicator_ids passed
-        in the url parameters, and creating a ResultObject for each row in the
-        response.
+        Parse the url parameters and find the locations for the request.
+        Returns an error message if the parameters are not valid.
         '''
-        self.error = None
 
-        results = []
+        self.error = None
 
         err = self.parse_url_params(request.GET)
 
         if err:
-            self.error = err
-            return []
+            return err
 
         self.location_ids = self.get_locations_to_return_from_url(request)
 
@@ -119,80 +212,201 @@ class DatapointResource(BaseNonModelResource):
 
         if chart_type == 'TableChart':
 
-            sub_location_ids = list(LocationTree.objects\
-                .filter(
-                    parent_location_id__in = self.location_ids,
-                    location__location_type_id = 3,
-                    location__lpd_status__in=[1,2])\
-                .values_list('location_id',flat=True))
+            lti = LocationTreeIndex.get_index()
 
-            self.location_ids = sub_location_ids
+            self.location_ids = lti.get_descendant_ids(self.location_ids,\
+                mask = lti.get_mask(location_type_ids = [3],\
+                    lpd_statuses = [1,2]))
 
+    def get_list(self, request, **kwargs):
+        '''
+        CSV downloads are streamed straight from the database, everything
+        else goes through tastypie.
+        '''
 
-        # Pivot the data on request instead of caching ##
-        # in the datapoint_abstracted table ##
-        df_columns = ['id', 'indicator_id', 'campaign_id', 'location_id',\
-            'value']
+        if self.determine_format(request) == 'text/csv':
+            return self.get_csv_response(request)
 
-        computed_datapoints = DataPointComputed.objects.filter(
-                campaign__in=self.parsed_params['campaign__in'],
-                location__in=self.location_ids,
-                indicator__in=self.parsed_params['indicator__in'])
+        return super(DatapointResource, self).get_list(request, **kwargs)
 
-        dwc_df = DataFrame(list(computed_datapoints.values_list(*df_columns)),\
-            columns=df_columns)
+    def get_csv_response(self, request):
+        '''
+        Write one csv row per location and campaign as the datapoints come
+        off of a server side cursor, so that memory stays flat no matter how
+        many locations and campaigns are in the download.  The columns are the
+        campaign, the location and then one per indicator, as in the csv that
+        the serializer used to build ( POLIO-200 ).  If there is no data for a
+        single campaign, there is an empty row for each location, as before.
+        '''
 
-        try:
-            p_table = pivot_table(
-                dwc_df, values='value', index=['indicator_id'],\
-                    columns=['location_id', 'campaign_id'], aggfunc=np.sum)
+        err = self.set_up_request(request)
+        if err:
+            err_msg, _ = err
+            return http.HttpBadRequest(err_msg)
+
+        indicator_ids = self.parsed_params['indicator__in']
+        campaign_ids = self.parsed_params['campaign__in']
+
+        location_names = dict(Location.objects\
+            .filter(id__in = self.location_ids).values_list('id', 'name'))
+        campaign_names = dict((c.id, c.__unicode__()) for c in \
+            Campaign.objects.filter(id__in = campaign_ids))
+        indicator_names = dict((ind.id, ind.__unicode__()) for ind in \
+            Indicator.objects.filter(id__in = indicator_ids))
+
+        ## indicator columns are sorted by name, as in the json download ##
+        csv_indicator_ids = sorted(indicator_names.keys(),\
+            key = lambda ind_id: indicator_names[ind_id])
+
+        dwc_qs = DataPointComputed.objects.filter(
+                campaign__in = campaign_ids,
+                location__in = self.location_ids,
+                indicator__in = indicator_ids)\
+            .order_by('location_id', 'campaign_id')\
+            .values_list('location_id', 'campaign_id', 'indicator_id', 'value')
+
+        def csv_rows():
+
+            yield ['campaign', 'location'] + [indicator_names[ind_id] for \
+                ind_id in csv_indicator_ids]
+
+            has_data = False
+            for (location_id, campaign_id), dwc_rows in \
+                groupby(iter_queryset(dwc_qs), itemgetter(0, 1)):
+
+                has_data = True
+                values = dict((row[2], row[3]) for row in dwc_rows)
+                yield [campaign_names.get(campaign_id, campaign_id),
+                    location_names.get(location_id, location_id)] + \
+                    [csv_value(values.get(ind_id)) for ind_id in \
+                    csv_indicator_ids]
+
+            ## no data for one campaign ( data entry ), one row per location ##
+            if not has_data and len(campaign_ids) == 1:
+                for location_id in self.location_ids:
+                    yield [campaign_names.get(campaign_ids[0], campaign_ids[0]),
+                        location_names.get(location_id, location_id)] + \
+                        [csv_value(None) for ind_id in csv_indicator_ids]
+
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse((writer.writerow([encode_csv(v) \
+            for v in row]) for row in csv_rows()),
+            content_type = build_content_type('text/csv'))
+
+        response['Content-Disposition'] = 'attachment; filename=polio_data.csv'
+        response.set_cookie('dataBrowserCsvDownload', 'true')
 
-            no_nan_pivoted_df = p_table.where((notnull(p_table)), None)
-            pivoted_data = no_nan_pivoted_df.to_dict()
+        return response
 
-            ## we need two dictionaries, one that has the value of the
-            ## datapoint_computed object and one with the id ##
+    def get_object_list(self, request):
+        '''
+        This is where the action happens in this resource.  AFter passing the
+        url paremeters, get the list of locations based on the parameters passed
+        in the url as well as the permissions granted to the user responsible
+        for the request.
+        Using the location_ids from the get_locations_to_return_from_url method
+        we query the datapoint abstracted table, then iterate through these
+        values cleaning the indicator_json based in the indicator_ids passed
+        in the url parameters, and creating a ResultObject for each row in the
+        response.
+        '''
+        err = self.set_up_request(request)
 
-            p_table_for_id = pivot_table(
-                dwc_df, values='id', index=['indicator_id'],\
-                    columns=['location_id', 'campaign_id'], aggfunc=np.sum)
-            no_nan_pivoted_df_for_id = p_table_for_id.where((notnull(p_table)), \
-                None)
-            pivoted_data_for_id = no_nan_pivoted_df_for_id.to_dict()
+        if err:
+            self.error = err
+            return []
 
-        except KeyError: ## there is no data
-            if len(self.parsed_params['campaign__in']) > 1:
+        ## campaigns whose pivoted rows have been built for every location
+        ## are read from the pivoted table, any others are pivoted on
+        ## request ##
+        campaign_ids = self.parsed_params['campaign__in']
+        abstracted_campaign_ids = set(DataPointAbstractedCampaign.objects\
+            .filter(campaign_id__in = campaign_ids)\
+            .values_list('campaign_id', flat=True))
+        live_campaign_ids = [c_id for c_id in campaign_ids \
+            if c_id not in abstracted_campaign_ids]
+
+        ## (location_id, campaign_id) -> {indicator_id: (value, computed_id)}
+        row_data = self.get_abstracted_data(list(abstracted_campaign_ids))
+        if live_campaign_ids:
+            row_data.update(self.get_pivoted_data(live_campaign_ids))
+
+        if not row_data: ## there is no data
+            if len(campaign_ids) > 1:
                 ## implicit way to only do this for data entry - i.e. a hack.
                 return
 
-            pivoted_data, pivoted_data_for_id = {}, {}
             for location_id in self.location_ids:
-                tupl = (location_id, self.parsed_params['campaign__in'][0])
-                pivoted_data[tupl] = {}
-                pivoted_data_for_id[tupl] = {}
-
-        for row, indicator_dict in pivoted_data.iteritems():
-
-            indicator_objects = [{
-                'indicator': unicode(k),
-                'computed': pivoted_data_for_id[row][k],
-                'value': v
-            } for k, v in indicator_dict.iteritems()]
-
-            # avail_indicators = set([x for x,y in indicator_dict.keys()])
-            missing_indicators = list(set(self.parsed_params['indicator__in']))
-            for ind in missing_indicators:
-                if ind not in indicator_dict.keys():
-                    indicator_objects.append({'indicator': ind, 'value': None,\
-                    'computed_id': None})
-
-            r = ResultObject()
-            r.location = row[0]
-            r.campaign = row[1]
-            r.indicators = indicator_objects
-            results.append(r)
-
-        return results
+                row_data[(location_id, campaign_ids[0])] = {}
+
+        return ResultObjectList(row_data, self.parsed_params['indicator__in'])
+
+    def get_abstracted_data(self, campaign_ids):
+        '''
+        Read the pivoted rows for the requested locations and campaigns.  The
+        indicator_json is not deserialized by the ORM when using
+        values_list, so it is loaded here, and only the requested indicators
+        are kept.  Indicators without a value are left out, as they are when
+        the data is pivoted on request.
+        '''
+
+        row_data = {}
+
+        if not campaign_ids:
+            return row_data
+
+        abstracted_qs = DataPointAbstracted.objects.filter(
+            campaign_id__in = campaign_ids,
+            location_id__in = self.location_ids)\
+            .values_list('location_id', 'campaign_id', 'indicator_json')
+
+        indicator_keys = [(unicode(ind), ind) for ind in \
+            set(self.parsed_params['indicator__in'])]
+
+        for location_id, campaign_id, indicator_json in abstracted_qs:
+
+            all_indicator_dict = json.loads(indicator_json)
+            indicator_dict = dict((ind, tuple(all_indicator_dict[key]))\
+                for key, ind in indicator_keys if key in all_indicator_dict \
+                and all_indicator_dict[key][0] is not None)
+
+            if indicator_dict:
+                row_data[(location_id, campaign_id)] = indicator_dict
+
+        return row_data
+
+    def get_pivoted_data(self, campaign_ids):
+        '''
+        Pivot the DataPointComputed rows on request, for campaigns that are
+        not built in the datapoint_abstracted table.  The (location, campaign)
+        key is unique for an indicator, so there is nothing to aggregate.
+        Missing values ( see has_value ) are left out, and so are the rows with
+        no values at all, as in the datapoint_abstracted table.
+        '''
+
+        df_columns = ['location_id', 'campaign_id', 'indicator_id', 'value',\
+            'id']
+
+        computed_datapoints = DataPointComputed.objects.filter(
+                campaign__in=campaign_ids,
+                location__in=self.location_ids,
+                indicator__in=self.parsed_params['indicator__in'])\
+            .order_by('location_id', 'campaign_id')\
+            .values_list(*df_columns)
+
+        ## the rows come back sorted by key, so one pass groups them, and
+        ## the value and id of each datapoint are kept together ##
+        row_data = {}
+        for row, dwc_rows in groupby(computed_datapoints.iterator(),\
+            itemgetter(0, 1)):
+            indicator_dict = dict((indicator_id, (value, computed_id)) for \
+                location_id, campaign_id, indicator_id, value, computed_id \
+                in dwc_rows if has_value(value))
+
+            if indicator_dict:
+                row_data[row] = indicator_dict
+
+        return row_data
 
     def obj_get_list(self, bundle, **kwargs):
         '''
@@ -183,6 +183,7 @@ class DatapointEntryResource(BaseModelResource):
 
         dp = DataPoint.objects.get(id=kwargs['id'])
         dp.value = value_to_update
+        dp.cache_job_id = -1 # to process
         dp.save()
 
         dp.campaign_id = bundle.data['campaign_id']
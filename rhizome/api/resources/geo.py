@@ -28,6 +28,7 @@ class GeoResource(BaseNonModelResource):
     class Meta(BaseNonModelResource.Meta):
         object_class = GeoJsonResult
         resource_name = 'geo'
+        cache_responses = True
         filtering = {
             "location_id": ALL,
         }
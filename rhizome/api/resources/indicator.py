@@ -14,6 +14,7 @@ class IndicatorResource(BaseModelResource):
 
     class Meta(BaseModelResource.Meta):
         resource_name = 'indicator'
+        cache_responses = True
         filtering = {
             "id": ALL,
         }
@@ -5,6 +5,7 @@ class LocationResource(BaseModelResource):
     class Meta(BaseModelResource.Meta):
         queryset = Location.objects.all().values()
         resource_name = 'location'
+        cache_responses = True
 
     def get_object_list(self, request):
 
@@ -1,5 +1,6 @@
 from rhizome.api.resources.base_model import BaseModelResource
 from rhizome.models import LocationPermission
+from rhizome.api.permission_context import clear_permission_context
 
 class LocationPermissionResource(BaseModelResource):
     class Meta(BaseModelResource.Meta):
@@ -23,6 +24,8 @@ class LocationPermissionResource(BaseModelResource):
             lp_obj.top_lvl_location_id = bundle.data['location_id']
             lp_obj.save()
 
+        clear_permission_context(lp_obj.user_id)
+
         bundle.obj = lp_obj
         bundle.data['id'] = lp_obj.id
 
@@ -1,6 +1,8 @@
 import json
+import re
 import StringIO
 import urlparse
+import uuid
 
 from django.core.serializers import json as djangojson
 from pandas import DataFrame
@@ -8,6 +10,24 @@ from tastypie.serializers import Serializer
 
 from rhizome.models import Campaign, Indicator, Location
 
+def iter_json_list(serializer, objects, meta):
+    '''
+    Yield the json for {'error': None, 'meta': meta, 'objects': objects} one
+    object at a time, so that the whole response is never held in memory as
+    one string.
+
+    return StreamingHttpResponse(iter_json_list(self._meta.serializer,
+        objects, meta), content_type = 'application/json')
+    '''
+
+    yield '{"error": null, "meta": %s, "objects": [' % serializer.to_json(meta)
+
+    for i, obj in enumerate(objects):
+        yield (', ' if i > 0 else '') + serializer.to_json(obj)
+
+    yield ']}'
+
+
 class CustomJSONSerializer(Serializer):
     """Does not allow out of range float values
     (in strict compliance with the JSON specification).
@@ -28,17 +48,19 @@ class CustomJSONSerializer(Serializer):
     def to_urlencode(self,content):
         pass
 
+    def to_simple(self, data, options):
+
+        if isinstance(data, RawJSON):
+            return data
+
+        return super(CustomJSONSerializer, self).to_simple(data, options)
+
     def to_json(self, data, options=None):
 
         options = options or {}
         data = self.to_simple(data, options)
 
-        return djangojson.json.dumps(
-            data,
-            allow_nan=True,
-            cls=NanEncoder,
-            sort_keys=True,
-            ensure_ascii=False)
+        return dumps_json(data)
 
 class NanEncoder(djangojson.DjangoJSONEncoder):
 
@@ -106,6 +128,77 @@ class NanEncoder(djangojson.DjangoJSONEncoder):
         return _iterencode(o, 0)
 
 
+class RawJSON(object):
+    '''
+    The text of a JSONField, as it is stored in the database.  It is written
+    in to the response as is, rather than being decoded with json.loads only
+    to be encoded again by the serializer.
+    '''
+
+    def __init__(self, json_text):
+
+        self.json_text = json_text
+
+
+class RawJSONEncoder(djangojson.DjangoJSONEncoder):
+    '''
+    Encodes each RawJSON as a placeholder string, and keeps its text in
+    raw_json_list so that dumps_json can splice it in to the output.
+    '''
+
+    def __init__(self, *args, **kwargs):
+
+        self.raw_json_list = kwargs.pop('raw_json_list')
+        self.placeholder = kwargs.pop('placeholder')
+
+        super(RawJSONEncoder, self).__init__(*args, **kwargs)
+
+    def default(self, o):
+
+        if isinstance(o, RawJSON):
+            self.raw_json_list.append(o.json_text)
+            return self.placeholder % (len(self.raw_json_list) - 1)
+
+        return super(RawJSONEncoder, self).default(o)
+
+
+class NanRawJSONEncoder(RawJSONEncoder, NanEncoder):
+    pass
+
+
+def dumps_json(data):
+    '''
+    Encode data with the C encoder of the json module, which is only used
+    when the keys are not sorted.  The C encoder writes NaN and Infinity as
+    is, which is not valid json, so with allow_nan = False it raises on
+    them and we fall back to the python encoder of NanEncoder, which writes
+    them as null.
+
+    The text of each RawJSON in data is spliced in to the output in place of
+    its placeholder.
+    '''
+
+    raw_json_list = []
+    placeholder = '__raw_json_%s_%%s__' % uuid.uuid4().hex
+
+    try:
+        json_str = djangojson.json.dumps(data, cls=RawJSONEncoder,
+            allow_nan=False, ensure_ascii=False,
+            raw_json_list=raw_json_list, placeholder=placeholder)
+    except ValueError:
+        del raw_json_list[:]
+        ## sort_keys keeps NanEncoder off of the C encoder ##
+        json_str = djangojson.json.dumps(data, cls=NanRawJSONEncoder,
+            allow_nan=True, sort_keys=True, ensure_ascii=False,
+            raw_json_list=raw_json_list, placeholder=placeholder)
+
+    if len(raw_json_list) == 0:
+        return json_str
+
+    return re.sub('"%s"' % (placeholder % r'(\d+)'),
+        lambda m: raw_json_list[int(m.group(1))], json_str)
+
+
 class CustomSerializer(Serializer):
     formats = ['json', 'csv','urlencode']
     content_types = {
@@ -123,6 +216,20 @@ class CustomSerializer(Serializer):
     def to_urlencode(self,content):
         pass
 
+    def to_simple(self, data, options):
+
+        if isinstance(data, RawJSON):
+            return data
+
+        return super(CustomSerializer, self).to_simple(data, options)
+
+    def to_json(self, data, options=None):
+
+        options = options or {}
+        data = self.to_simple(data, options)
+
+        return dumps_json(data)
+
     def to_csv(self, data, options=None):
         '''
         First lookup the metadata (campaign, location, indicator) and build a map
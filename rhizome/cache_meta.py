@@ -1,10 +1,14 @@
 import json
 
+import numpy as np
+from django.db import connection, transaction
 from pandas import read_csv, notnull, DataFrame, concat
 from numpy import sqrt, log
 
 from rhizome.models import *
 from rhizome.models import SourceObjectMap
+from rhizome.pg_utils import copy_df
+from rhizome.api.custom_cache import bump_data_version
 
 
 
@@ -30,9 +34,11 @@ class IndicatorCache(object):
 
         Find the bounds for each indicator
 
+        Only the indicators whose bounds or tags changed are saved.  Returns
+        True if there were any.
         '''
 
-        indicator_batch = []
+        changed = False
         qs,  bound_df, tag_df = self.build_related_objects()
 
         for ind in qs:
@@ -41,21 +47,34 @@ class IndicatorCache(object):
             filtered_tag_df = tag_df[tag_df['indicator_id'] == ind.id]
             filtered_bound_df = bound_df[bound_df['indicator_id'] == ind.id]
 
-            ind.bound_json = [row.to_dict() for ix, row in filtered_bound_df.iterrows()]
-            ind.tag_json = list(filtered_tag_df['indicator_tag_id'].unique())
+            bound_json = [row.to_dict() for ix, row in filtered_bound_df.iterrows()]
+            tag_json = list(filtered_tag_df['indicator_tag_id'].unique())
 
+            ## compared as json, as a missing bound is NaN ( NaN != NaN ) ##
+            if json.dumps([bound_json, tag_json], sort_keys=True) == \
+                json.dumps([ind.bound_json, ind.tag_json], sort_keys=True):
+                continue
+
+            ind.bound_json = bound_json
+            ind.tag_json = tag_json
             ind.save()
+            changed = True
+
+        return changed
 
     def build_related_objects(self):
         tag_cols = ['indicator_id', 'indicator_tag_id']
         bound_cols = ['indicator_id', 'bound_name', 'mn_val', 'mx_val']
         ind_to_office_cols = ['indicator_id', 'office_id']
 
+        ## ordered, so that unchanged bounds and tags compare equal ##
         tag_df = DataFrame(list(IndicatorToTag.objects.filter(
-            indicator_id__in=self.indicator_id_list).values_list(*tag_cols)), columns=tag_cols)
+            indicator_id__in=self.indicator_id_list).order_by('indicator_tag_id')\
+            .values_list(*tag_cols)), columns=tag_cols)
 
         bound_df = DataFrame(list(
-            IndicatorBound.objects.filter(indicator_id__in=self.indicator_id_list).values_list(*bound_cols)
+            IndicatorBound.objects.filter(indicator_id__in=self.indicator_id_list).order_by('id')\
+            .values_list(*bound_cols)
         ), columns=bound_cols)
 
         qs = Indicator.objects.filter(id__in=self.indicator_id_list)
@@ -68,75 +87,344 @@ class IndicatorCache(object):
 
 
 class LocationTreeCache(object):
+    '''
+    Re-build the location_tree table from the location table.  Every
+    location gets a row for each of its ( recursive ) parents, and lvl is
+    the depth of the location in the tree, with 0 for the ultimate parents.
+    The ultimate parents are also stored as their own parent.
+
+    The closure is built in one pass by the LocationTreeIndex, and then
+    swapped in for the old rows with a COPY inside of one transaction, so
+    that readers never see an empty or half written tree.
+    '''
 
     def __init__(self):
 
-        self.location_tree_columns = ['location_id','parent_location_id']
+        self.location_tree_columns = ['location_id','parent_location_id','lvl']
         self.location_tree_df = DataFrame(columns=self.location_tree_columns)
 
     def main(self):
         '''
         Any and all parents attributed any and all children.  See the test
         case for an abstracted example.
+
+        The table is only re-written when the closure is different from the
+        one that is stored.  Returns True if it was.
         '''
 
-        ## now iterate from bottom to bottom to top ##
-        location_type_loop_order = LocationType.objects.all()\
-            .values_list('id',flat=True).order_by('-admin_level')
+        location_list = list(Location.objects\
+            .values_list('id','parent_location_id'))
+
+        lti = LocationTreeIndex(location_list)
+        self.location_tree_df = lti.get_ancestor_df(lti.location_ids)
 
-        for lt_id in location_type_loop_order:
-            self.process_location_tree_lvl(lt_id)
+        stored_rows = set(LocationTree.objects\
+            .values_list(*self.location_tree_columns))
+        new_rows = set(tuple(int(v) for v in row) for row in \
+            self.location_tree_df[self.location_tree_columns].values)
+
+        if new_rows == stored_rows:
+            return False
 
         self.upsert_location_tree()
 
-    def process_location_tree_lvl(self, location_type_id):
+        ## locations changed with bulk_create, .update() or raw SQL do not
+        ## bump the version when they are saved, so the LocationTreeIndex
+        ## is rebuilt when the table changes at the latest ##
+        DataVersion.bump(DataVersion.LOCATION_TREE)
 
-        lt_batch = []
+        return True
 
-        location_df = DataFrame(list(Location.objects\
-            .filter(location_type_id = location_type_id)\
-            .values_list('id','parent_location_id')),columns=self.location_tree_columns)
+    def upsert_location_tree(self):
 
-        merged_df = location_df.merge(self.location_tree_df
-            ,left_on='location_id',right_on='parent_location_id')
+        with transaction.atomic():
+            LocationTree.objects.all().delete()
+            copy_df(LocationTree._meta.db_table, self.location_tree_df,\
+                self.location_tree_columns)
 
-        cleaned_merge_df = merged_df[['location_id_y','parent_location_id_x']]
-        cleaned_merge_df.columns = self.location_tree_columns
 
-        self.location_tree_df = concat([self.location_tree_df,location_df,\
-            cleaned_merge_df])
+class LocationTreeIndex(object):
+    '''
+    An in memory version of the LocationTree table, built from the location
+    table and shared by everything that runs in the same process.
+
+    The locations are laid out in the order of a depth first walk of the
+    tree ( an Euler tour ) so that the descendants of a location are the
+    contiguous slice of that order between its entry and its exit position.
+    That means that "is x an ancestor of y" is two comparisons, and the
+    descendants of a location are a slice of an array instead of a
+    location_id__in sub query against the location_tree table.
+
+    The lookups mirror the LocationTree table: a location is a descendant
+    of every one of its ( recursive ) parents, and the ultimate parents are
+    also their own parent.  Locations that can not be reached from a top
+    level location ( i.e. a cycle in parent_location_id ) are not indexed.
+
+    The index is rebuilt only when the LOCATION_TREE DataVersion is bumped,
+    which happens when a location is saved through the ORM and every time
+    the LocationTreeCache runs ( so that changes made with .update() or raw
+    SQL are picked up by cache_all_meta as well ).
+
+    from rhizome.cache_meta import LocationTreeIndex
+    lti = LocationTreeIndex.get_index()
+    lti.get_descendant_ids([12907])
+    '''
 
-        self.location_tree_df.drop_duplicates()
+    tree_columns = ['location_id', 'parent_location_id', 'lvl']
 
-    def upsert_location_tree(self):
+    _cache = {}
+
+    def __init__(self, location_list, location_attributes = None):
+        '''
+        location_list is a list of ( location_id, parent_location_id ) tuples.
+
+        location_attributes is an optional dictionary of location_id ->
+        ( location_type_id, location_type_name, lpd_status ), which is used
+        to build the masks in get_mask.
+        '''
+
+        children = {}
+        for location_id, parent_location_id in sorted(location_list):
+            children.setdefault(parent_location_id, []).append(location_id)
+
+        location_ids = set([l[0] for l in location_list])
+        root_ids = [l_id for l_id, p_id in sorted(location_list)\
+            if p_id is None or p_id not in location_ids]
+
+        ## iterative depth first walk, recording the position of each
+        ## location and the position of the last of its descendants ##
+        order, end, depth, parent_position = [], [], [], []
+        stack = [(root_id, -1, 0) for root_id in reversed(root_ids)]
+        open_positions = []
+
+        while stack:
+            location_id, parent_pos, lvl = stack.pop()
+
+            ## close out the locations whose subtree we have left ##
+            while open_positions and depth[open_positions[-1]] >= lvl:
+                end[open_positions.pop()] = len(order)
+
+            position = len(order)
+            order.append(location_id)
+            end.append(None)
+            depth.append(lvl)
+            parent_position.append(parent_pos)
+            open_positions.append(position)
+
+            for child_id in reversed(children.get(location_id, [])):
+                stack.append((child_id, position, lvl + 1))
+
+        for position in open_positions:
+            end[position] = len(order)
+
+        self.location_ids = np.array(order, dtype=np.int64)
+        self.end = np.array(end, dtype=np.int64)
+        self.depth = np.array(depth, dtype=np.int64)
+        self.parent_position = np.array(parent_position, dtype=np.int64)
+        self.position = dict(zip(order, range(len(order))))
+
+        ## the attributes of the location at each position, for get_mask ##
+        location_attributes = location_attributes or {}
+        attribute_list = [location_attributes.get(l_id, (-1, None, None)) \
+            for l_id in order]
+
+        self.location_type_id = np.array([a[0] for a in attribute_list],\
+            dtype=np.int64)
+        self.location_type_name = np.array([a[1] for a in attribute_list],\
+            dtype=object)
+        self.lpd_status = np.array([a[2] if a[2] is not None else -1 \
+            for a in attribute_list], dtype=np.int64)
+
+    @classmethod
+    def get_index(cls):
+        '''
+        Return the cached index, re-building it only if the LOCATION_TREE
+        DataVersion has been bumped since it was built.  The version is read
+        through the local cache, so most calls do not query the database.
+        '''
+
+        version = DataVersion.get_cached_version_key(DataVersion.LOCATION_TREE)
+
+        try:
+            return cls._cache[version]
+        except KeyError:
+            pass
+
+        location_list, location_attributes = [], {}
+
+        for location_id, parent_location_id, location_type_id, \
+            location_type_name, lpd_status in Location.objects.values_list(\
+                'id', 'parent_location_id', 'location_type_id',\
+                'location_type__name', 'lpd_status'):
+
+            location_list.append((location_id, parent_location_id))
+            location_attributes[location_id] = (location_type_id,\
+                location_type_name, lpd_status)
+
+        cls._cache.clear()
+        cls._cache[version] = cls(location_list, location_attributes)
+
+        return cls._cache[version]
+
+    def get_positions(self, location_ids):
+        '''
+        The position in the walk of each of the location_ids.  Ids that are
+        not in the index are ignored.
+        '''
+
+        positions = [self.position.get(int(l_id)) for l_id in location_ids]
+
+        return np.array([p for p in positions if p is not None],dtype=np.int64)
+
+    def is_ancestor(self, parent_location_id, location_id):
+        '''
+        True if parent_location_id is a ( recursive ) parent of location_id.
+        '''
+
+        try:
+            parent_pos = self.position[int(parent_location_id)]
+            location_pos = self.position[int(location_id)]
+        except KeyError:
+            return False
+
+        return parent_pos < location_pos < self.end[parent_pos]
+
+    def is_in_tree(self, parent_location_id, location_id):
+        '''
+        True if location_id is in get_descendant_ids([parent_location_id]),
+        that is if it is a descendant of parent_location_id, or it is
+        parent_location_id and that is an ultimate parent.
+        '''
+
+        if self.is_ancestor(parent_location_id, location_id):
+            return True
+
+        position = self.position.get(int(location_id))
+
+        return position is not None and \
+            int(parent_location_id) == int(location_id) and \
+            self.parent_position[position] == -1
+
+    def get_mask(self, location_type_ids = None, location_type_names = None,
+        lpd_statuses = None):
+        '''
+        A boolean array, in the order of the walk, that is True for the
+        locations that match all of the criteria passed.  Masks can be
+        combined with & and | and passed to get_descendant_ids.
+
+        ex: the districts with an lpd_status of 1 or 2
+            lti.get_mask(location_type_ids = [3], lpd_statuses = [1, 2])
+        '''
+
+        mask = np.ones(len(self.location_ids), dtype=bool)
+
+        if location_type_ids is not None:
+            mask &= np.in1d(self.location_type_id, location_type_ids)
+
+        if location_type_names is not None:
+            mask &= np.in1d(self.location_type_name, location_type_names)
+
+        if lpd_statuses is not None:
+            mask &= np.in1d(self.lpd_status, lpd_statuses)
+
+        return mask
+
+    def get_tree_mask(self, location_id):
+        '''
+        A mask, as from get_mask, that is True for location_id and every one
+        of its descendants.
+        '''
+
+        mask = np.zeros(len(self.location_ids), dtype=bool)
+        position = self.position.get(int(location_id))
+
+        if position is not None:
+            mask[position:self.end[position]] = True
+
+        return mask
+
+    def get_descendant_ids(self, parent_location_ids, mask = None):
+        '''
+        Equivalent to:
+
+            LocationTree.objects\\
+                .filter(parent_location_id__in = parent_location_ids)\\
+                .values_list('location_id', flat=True)
+
+        If a mask from get_mask is passed, only the descendants for which it
+        is True are returned.
+        '''
+
+        parent_positions = self.get_positions(parent_location_ids)
+
+        slices = [np.arange(pos + 1, self.end[pos]) for pos in \
+            parent_positions]
+
+        ## the ultimate parents are in the tree of themselves ##
+        slices.append(np.array([pos for pos in parent_positions \
+            if self.parent_position[pos] == -1], dtype=np.int64))
+
+        positions = np.concatenate(slices)
+
+        if mask is not None:
+            positions = positions[mask[positions]]
 
-        lt_batch = []
+        return np.unique(self.location_ids[positions]).tolist()
 
-        ## only the ultimate parent should have itself as a parent ##
-        ## drop all NA values, then create the ultimate parents ##
-        self.location_tree_df.dropna(inplace=True)
-        for loc in Location.objects.filter(parent_location_id__isnull=True):
-            lt_batch.append(LocationTree(**{
-                'location_id':loc.id,
-                'parent_location_id':loc.id,
-                'lvl':0,
-            }))
+    def get_ancestor_df(self, location_ids):
+        '''
+        Equivalent to the rows of the LocationTree table for location_ids, as
+        a DataFrame of location_id, parent_location_id, lvl, where lvl is the
+        depth of the location ( 0 for the ultimate parents ).
+
+        The parents are found by walking up the tree one level at a time for
+        all of the locations at once.
+        '''
+
+        positions = self.get_positions(location_ids)
+
+        ## the ultimate parents are their own parent ##
+        root_positions = positions[self.parent_position[positions] == -1]
+        location_pos_list, parent_pos_list = [root_positions], [root_positions]
+
+        location_pos, parent_pos = positions, self.parent_position[positions]
+        while len(location_pos) > 0:
+            has_parent = parent_pos != -1
+            location_pos, parent_pos = location_pos[has_parent], \
+                parent_pos[has_parent]
 
-        ## iterate through the location tree df created above ##
-        for ix,loc in self.location_tree_df.iterrows():
-            lt_batch.append(LocationTree(**{
-                'location_id':loc.location_id,
-                'parent_location_id':loc.parent_location_id,
-                'lvl':0,
-            }))
+            location_pos_list.append(location_pos)
+            parent_pos_list.append(parent_pos)
+
+            parent_pos = self.parent_position[parent_pos]
+
+        location_pos = np.concatenate(location_pos_list)
+        parent_pos = np.concatenate(parent_pos_list)
+
+        return DataFrame({
+            'location_id': self.location_ids[location_pos],
+            'parent_location_id': self.location_ids[parent_pos],
+            'lvl': self.depth[location_pos],
+        }, columns = self.tree_columns)
+
+    def get_ancestor_ids(self, location_ids):
+        '''
+        The set of every ( recursive ) parent of location_ids.
+        '''
 
-        LocationTree.objects.all().delete()
-        LocationTree.objects.bulk_create(lt_batch)
+        return set(self.get_ancestor_df(location_ids)['parent_location_id']\
+            .tolist())
 
 
 def update_source_object_names():
+    '''
+    Set the master_object_name of the source_object_maps whose name is not
+    the one of their indicator or location.  Returns True if any were.
+    '''
 
-    som_raw = SourceObjectMap.objects.raw(
+    cursor = connection.cursor()
+
+    cursor.execute(
     '''
         DROP TABLE IF EXISTS _tmp_object_names;
         CREATE TEMP TABLE _tmp_object_names
@@ -155,19 +443,19 @@ def update_source_object_names():
         INNER JOIN location r
             ON som.master_object_id = r.id
             AND som.content_type = 'location';
+    ''')
 
+    cursor.execute(
+    '''
         UPDATE source_object_map som
         set master_object_name = t.master_object_name
         FROM _tmp_object_names t
         WHERE t.master_object_id = som.master_object_id
-        AND t.content_type = som.content_type;
-
-        SELECT * FROM source_object_map limit 1;
-
+        AND t.content_type = som.content_type
+        AND som.master_object_name IS DISTINCT FROM t.master_object_name;
     ''')
 
-    for row in som_raw:
-        print row.id
+    return cursor.rowcount > 0
 
 def minify_geo_json():
     '''
@@ -228,13 +516,20 @@ def minify_polygon(polygon):
 
 
 def cache_all_meta():
+    '''
+    Runs every minute, so the cached api responses are only invalidated if
+    one of the caches actually changed.
+    '''
 
     location_tree_cache_data = LocationTreeCache()
-    location_tree_cache_data.main()
+    location_tree_changed = location_tree_cache_data.main()
 
     indicator_cache_data = IndicatorCache()
-    indicator_cache_data.main()
+    indicator_changed = indicator_cache_data.main()
+
+    source_object_changed = update_source_object_names()
 
-    source_object_cache = update_source_object_names()
+    if location_tree_changed or indicator_changed or source_object_changed:
+        bump_data_version()
 
     # minify_geo_json()
@@ -1,10 +1,11 @@
 from django_cron import CronJobBase, Schedule
+from django.conf import settings
 from django.contrib.auth.models import User
 
-from rhizome.agg_tasks import AggRefresh
+from rhizome.agg_tasks import AggRefreshScheduler
+from rhizome.cache_meta import cache_all_meta
 
-from rhizome.etl_tasks.refresh_master import MasterRefresh
-from rhizome.models import SourceSubmission
+from rhizome.etl_tasks.refresh_master import MasterRefreshScheduler
 
 class AggAndComputeDataPoint(CronJobBase):
     RUN_EVERY_MINS = 1
@@ -13,7 +14,7 @@ class AggAndComputeDataPoint(CronJobBase):
     code = 'rhizome.agg_and_compute_datapoint'    # a unique code
 
     def do(self):
-        cr = AggRefresh()
+        results = AggRefreshScheduler().main()
 
 class MasterRefreshJob(CronJobBase):
     RUN_EVERY_MINS = 1
@@ -23,12 +24,9 @@ class MasterRefreshJob(CronJobBase):
 
     def do(self):
         user_id = User.objects.get(username = 'cron').id
-        document_id = SourceSubmission.objects.\
-            filter(process_status='TO_PROCESS').\
-            values_list('document_id',flat=True)[0]
 
-        mr = MasterRefresh(user_id, document_id)
-        mr.main()
+        results = MasterRefreshScheduler(user_id,\
+            max_seconds = settings.MASTER_REFRESH_MAX_SECONDS).main()
 
 class MetaRefreshJob(CronJobBase):
     RUN_EVERY_MINS = 1 ## 1400 # one day
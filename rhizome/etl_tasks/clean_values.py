@@ -0,0 +1,71 @@
+import numpy as np
+from pandas import Series
+
+## a number with an optional sign, commas between the thousands and an
+## optional decimal part.  ex: 100 , -1,000,000 , 12.5 , .5 ##
+NUMBER_PATTERN = r'^[-+]?((\d{1,3}(,\d{3})+|\d+)(\.\d*)?|\.\d+)$'
+
+BOOLEAN_VALUES = {'yes': 1.0, 'no': 0.0}
+
+
+def clean_values(raw_values):
+    '''
+    Parse a column of raw submission cells in to floats all at once, rather
+    than one cell at a time.  Returns a float array and a boolean array that
+    is True for the cells that were rejected.
+
+        - numbers are accepted as is.
+        - strings can be numbers with commas between the thousands
+          ( "100,000" -> 100000.0 ) or yes / no ( -> 1.0 / 0.0 ).
+        - None ( or NaN ) is kept as a null value and is not rejected.
+        - anything else, including a blank string, is rejected.
+
+    The values of rejected cells are NaN.
+
+    from rhizome.etl_tasks.clean_values import clean_values
+    values, rejected = clean_values(['1,000', 'yes', 'n/a', None])
+    '''
+
+    cells = Series(list(raw_values), dtype = object)
+
+    values = np.empty(len(cells))
+    values.fill(np.nan)
+    rejected = np.zeros(len(cells), dtype = bool)
+
+    if len(cells) == 0:
+        return values, rejected
+
+    ## .str methods give NaN for anything that is not a string ##
+    str_cells = cells.str.strip().str.lower()
+    is_str = str_cells.notnull().values
+    is_other = ~is_str & cells.notnull().values
+
+    if is_str.any():
+        str_cells = str_cells[is_str]
+
+        is_bool = str_cells.isin(list(BOOLEAN_VALUES)).values
+        is_number = str_cells.str.contains(NUMBER_PATTERN).values.astype(bool)
+
+        str_values = np.empty(len(str_cells))
+        str_values.fill(np.nan)
+        str_values[is_bool] = str_cells[is_bool].map(BOOLEAN_VALUES).values
+        str_values[is_number] = str_cells[is_number].str.replace(',', '')\
+            .astype(float).values
+
+        values[is_str] = str_values
+        rejected[is_str] = ~(is_bool | is_number)
+
+    ## values that are already numbers ( from json or read_csv ) are
+    ## converted all at once, falling back to one at a time if some of them
+    ## are not numbers ##
+    if is_other.any():
+        try:
+            values[is_other] = cells[is_other].astype(float).values
+        except (TypeError, ValueError):
+            for ix in np.flatnonzero(is_other):
+                try:
+                    values[ix] = float(cells.iat[ix])
+                except (TypeError, ValueError):
+                    rejected[ix] = True
+
+    return values, rejected
@@ -1,12 +1,36 @@
-import locale
+import time
 
 from collections import defaultdict
+from datetime import datetime, timedelta
 import json
 
-from pandas import DataFrame, concat
-from bulk_update.helper import bulk_update
+import numpy as np
+from pandas import DataFrame, concat, to_datetime
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
 
 from rhizome.models import *
+from rhizome.pg_utils import copy_model_df, copy_rows
+from rhizome.etl_tasks.clean_values import clean_values
+from rhizome.api.custom_cache import bump_data_version
+from rhizome.agg_tasks import queue_datapoint_keys
+
+## the order of the values in the doc datapoint rows that are buffered ##
+## in submissions_to_doc_datapoints and loaded with COPY ##
+DOC_DP_COLUMNS = ['indicator_id', 'value', 'location_id', 'data_date',
+    'document_id', 'source_submission_id', 'agg_on_location']
+
+def to_utc_datetime(date_value):
+    '''
+    Midnight UTC of a date, to filter the data_date of datapoints on.  The
+    dates that are compared to campaigns are the UTC dates of the data_date
+    ( as in mark_datapoints_with_needs_campaign ).
+    '''
+
+    return datetime.combine(date_value, datetime.min.time())\
+        .replace(tzinfo = timezone.utc)
+
 
 class MasterRefresh(object):
     '''
@@ -14,31 +38,37 @@ class MasterRefresh(object):
     based on mapping and audits from the doc_review app.
     '''
 
-    def __init__(self,user_id,document_id):
+    def __init__(self,user_id,document_id,ss_location_code_batch_size = 50):
         '''
         Batches run based on locations becasue some configurations low for regional
         aggregation and for that reaso, all locations within a document must be processed
         in the same batch.
         In order to grab the batch of data to process, we first find all of the location
         codes that have not been proessed yet, and take onlyt the first 'n' values.
-        We then query submissions with this list of location_ids and create the
-        self.submission_data variable with these list of ids.
+        We then query submissions with this list of location_ids and keep the
+        ids of the ones to process.  The submission_json of the batch is only
+        read chunk by chunk, in submissions_to_doc_datapoints.
         '''
 
-        self.ss_location_code_batch_size = 50
+        self.ss_location_code_batch_size = ss_location_code_batch_size
+        ## how many submissions are read, and how many doc datapoints are
+        ## buffered, at a time in submissions_to_doc_datapoints ##
+        self.ss_chunk_size = 1000
+        self.doc_dp_chunk_size = 10000
         self.document_id = document_id
         self.user_id = user_id
 
         self.db_doc_deets = self.get_document_config()
         self.source_map_dict = self.get_document_meta_mappings()
 
-        self.to_process_ss_ids = SourceSubmission.objects\
-                .filter(document_id = self.document_id,\
-                    process_status='TO_PROCESS')
-
-        self.location_codes_to_process = SourceSubmission\
-            .objects.filter(id__in = self.to_process_ss_ids)\
-            .values_list('location_code',flat = True).distinct()\
+        ## only location codes that are mapped can be processed, so leave the
+        ## others out of the batch.  Otherwise a document with more than
+        ## ss_location_code_batch_size unmapped codes would never move on ##
+        self.location_codes_to_process = [code for code in SourceSubmission\
+            .objects.filter(document_id = self.document_id,\
+                process_status = 'TO_PROCESS')\
+            .values_list('location_code',flat = True).distinct()
+            if ('location', code) in self.source_map_dict]\
             [:self.ss_location_code_batch_size]
 
         self.file_header = Document.objects.get(id=self.document_id).file_header
@@ -46,9 +76,6 @@ class MasterRefresh(object):
         self.ss_ids_to_process, self.all_ss_ids =\
             self.refresh_submission_details()
 
-        self.submission_data = dict(SourceSubmission.objects.filter(id__in = \
-            self.ss_ids_to_process).values_list('id','submission_json'))
-
     ## __init__ HELPER METHOD ##
 
     def get_document_config(self):
@@ -91,24 +118,30 @@ class MasterRefresh(object):
         ## during the DocTransform process we associate new AND existing mappings between
         ## the metadata assoicated with this doucment.
 
+        # create a tuple dict ex: {('location': "PAK") : 3 , ('indicator': "VAC") : 7}
+        ## this is done in one query so that the codes for every row in the
+        ## batch can be looked up in memory ( see get_master_object_id ).
+        source_map_dict = {}
 
-        sm_ids = DocumentSourceObjectMap.objects.filter(document_id =\
-            self.document_id).values_list('source_object_map_id',flat=True)
+        for content_type, source_object_code, master_object_id in \
+            SourceObjectMap.objects.filter(master_object_id__gt = 0)\
+            .values_list('content_type', 'source_object_code',\
+                'master_object_id'):
 
-        # create a tuple dict ex: {('location': "PAK") : 3 , ('location': "PAK") : 3}
-        source_map_dict =  DataFrame(list(SourceObjectMap.objects\
-            .filter(
-                master_object_id__gt=0)\
-                # id__in = sm_ids)\
-            .values_list(*['master_object_id']))
-            ,columns = ['master_object_id']\
-            ,index= SourceObjectMap.objects.filter(master_object_id__gt=0)
-                # ,id__in = sm_ids)\
-                .values_list(*['content_type','source_object_code']))\
-                .to_dict()['master_object_id']
+            source_map_dict[(content_type, source_object_code)] = \
+                master_object_id
 
         return source_map_dict
 
+    def get_master_object_id(self, content_type, source_object_code):
+        '''
+        The master_object_id that a location, campaign or indicator code is
+        mapped to, or None if the code is not mapped.  This replaces the
+        SourceSubmission.get_location_id lookup, which ran one query per row.
+        '''
+
+        return self.source_map_dict.get((content_type, source_object_code))
+
     def main(self):
 
         if len(self.ss_ids_to_process) == 0:
@@ -129,6 +162,9 @@ class MasterRefresh(object):
             .filter(source_submission_id__in = \
                 self.ss_ids_to_process).values()))
 
+        if len(new_dp_df) == 0:
+            return
+
         date_series = new_dp_df['data_date']
         mn_date, mx_date = min(date_series).date(), max(date_series).date()
 
@@ -182,20 +218,18 @@ class MasterRefresh(object):
         for content_type,master_object_id in som_data:
             som_lookup[content_type].append(master_object_id)
 
-        ## delete bad_indicator_data ##
-        DataPoint.objects.filter(
-            source_submission_id__in = self.ss_ids_to_process,
-        ).exclude(indicator_id__in=som_lookup['indicator']).delete()
+        batch_dp_qs = DataPoint.objects.filter(
+            source_submission_id__in = self.ss_ids_to_process)
 
-        ## delete bad_location_data ##
-        DataPoint.objects.filter(
-            source_submission_id__in = self.ss_ids_to_process,
-        ).exclude(location_id__in=som_lookup['location']).delete()
-
-        ## delete bad_campaign_data ##
-        DataPoint.objects.filter(
-            source_submission_id__in = self.ss_ids_to_process,
-        ).exclude(location_id__in=som_lookup['campaign']).delete()
+        ## bad_indicator_data, bad_location_data and bad_campaign_data ##
+        for unmapped_dp_qs in [
+            batch_dp_qs.exclude(indicator_id__in=som_lookup['indicator']),
+            batch_dp_qs.exclude(location_id__in=som_lookup['location']),
+            batch_dp_qs.exclude(location_id__in=som_lookup['campaign']),
+        ]:
+            ## the aggregates built from these need to be refreshed ##
+            queue_datapoint_keys(unmapped_dp_qs)
+            unmapped_dp_qs.delete()
 
 
     def refresh_submission_details(self):
@@ -219,96 +253,222 @@ class MasterRefresh(object):
                 location_code__in = self.location_codes_to_process,
                 process_status = 'TO_PROCESS')
 
-        for submission in submission_qs:
-            all_ss_ids.append(submission.id)
+        for ss_id, location_code in submission_qs\
+            .values_list('id', 'location_code'):
 
-            ## need to remove this! shoudl not have a FK between the two
-            ## apps.. source_data and datapoint
+            all_ss_ids.append(ss_id)
 
-            location_id = submission.get_location_id()
+            location_id = self.get_master_object_id('location', location_code)
 
             if location_id > 0:
-                ss_id_list_to_process.append(submission.id)
-                submission.location_id = location_id
-
-        if len(submission_qs) > 0:
-            bulk_update(submission_qs)
+                ss_id_list_to_process.append(ss_id)
 
         return ss_id_list_to_process,all_ss_ids
 
     def submissions_to_doc_datapoints(self):
         '''
-        Send all rows queued for processing to the process_source_submission method.
+        Turn all rows queued for processing in to DocDataPoints.  The doc
+        datapoints for the batch are replaced all at once: one delete over
+        the submission ids in the batch, then the new rows are buffered and
+        cleaned and loaded every doc_dp_chunk_size rows.  Submissions are
+        read ss_chunk_size at a time, so memory stays bounded for big
+        documents.
         '''
 
-        ss_ids_in_batch = self.submission_data.keys()
+        ss_ids_in_batch = sorted(self.ss_ids_to_process)
 
-        for row in SourceSubmission.objects.filter(id__in = ss_ids_in_batch):
-            row.location_id = row.get_location_id()
+        with transaction.atomic():
 
-            doc_dps = self.process_source_submission(row)
+            DocDataPoint.objects\
+                .filter(source_submission_id__in = ss_ids_in_batch).delete()
 
-    def sync_datapoint(self, ss_id_list = None):
+            doc_dp_batch = []
+
+            for i in range(0, len(ss_ids_in_batch), self.ss_chunk_size):
+
+                ss_id_chunk = ss_ids_in_batch[i:i + self.ss_chunk_size]
+
+                for row in SourceSubmission.objects\
+                    .filter(id__in = ss_id_chunk)\
+                    .only('id', 'location_code', 'data_date', 'submission_json'):
+                    row.location_id = self.get_master_object_id('location',\
+                        row.location_code)
+
+                    doc_dp_batch.extend(self.process_source_submission(row))
 
-        dp_batch = []
+                    if len(doc_dp_batch) >= self.doc_dp_chunk_size:
+                        self.load_doc_datapoints(doc_dp_batch)
+                        doc_dp_batch = []
+
+            self.load_doc_datapoints(doc_dp_batch)
+
+    def load_doc_datapoints(self, doc_dp_batch):
+        '''
+        Clean the raw values of a list of doc datapoint rows ( in the order of
+        DOC_DP_COLUMNS ) in one pass, and COPY the rows whose value was not
+        rejected in to the doc_datapoint table.
+        '''
+
+        if len(doc_dp_batch) == 0:
+            return
+
+        value_ix = DOC_DP_COLUMNS.index('value')
+        values, rejected = clean_values([r[value_ix] for r in doc_dp_batch])
+
+        clean_batch = [r[:value_ix] + (v,) + r[value_ix + 1:] for r, v, is_rejected\
+            in zip(doc_dp_batch, values.tolist(), rejected) if not is_rejected]
+
+        copy_rows(DocDataPoint._meta.db_table, DOC_DP_COLUMNS, clean_batch)
+
+    def sync_datapoint(self, ss_id_list = None):
+        '''
+        Move the DocDataPoints for the submissions in ss_id_list to the
+        DataPoint table.  When there is more than one value for a location
+        and indicator in the same campaign the latest submission wins,
+        whether the other values are in this batch or already in the
+        DataPoint table.  Aggregation adds up every datapoint of a campaign,
+        so two values for one location and indicator in a campaign would be
+        counted twice ( see set_campaign_window ).
+
+        The doc datapoints and the existing datapoints that they compete with
+        are put in to one frame, sorted by the created_at of their submission
+        and de-duplicated on the key keeping the last row, which gives the
+        winners in one pass.  From there:
+
+            - insert: the winners that are not in the DataPoint table yet.
+            - delete: the existing datapoints that lost, and any datapoint
+              for the submissions being synced, as those are replaced.
+        '''
 
         if not ss_id_list:
-            ss_id_list = self.submission_data.keys()
+            ss_id_list = self.ss_ids_to_process
+
+        key_columns = ['location_id', 'indicator_id', 'campaign_window']
+        dp_columns = ['location_id', 'indicator_id', 'data_date', 'value',\
+            'source_submission_id']
+
+        doc_dp_df = DataFrame(list(DocDataPoint.objects\
+            .filter(source_submission_id__in = ss_id_list)\
+            .values_list(*dp_columns)), columns = dp_columns)
+
+        if len(doc_dp_df) == 0:
+            return
 
+        location_ids = doc_dp_df['location_id'].unique().tolist()
+        min_date, max_date = doc_dp_df['data_date'].min().date(),\
+            doc_dp_df['data_date'].max().date()
 
-        doc_dp_df = DataFrame(list(DocDataPoint.objects.filter(
-            source_submission_id__in = ss_id_list).values()))
+        location_campaign_df = self.get_location_campaigns(location_ids,\
+            min_date, max_date)
 
-        location_ids = doc_dp_df['location_id'].unique()
-        indicator_ids = doc_dp_df['indicator_id'].unique()
-        min_date, max_date = doc_dp_df['data_date'].min(),\
-            doc_dp_df['data_date'].max()
+        ## the existing datapoints in any campaign of the doc datapoints ##
+        if len(location_campaign_df) > 0:
+            min_date = min(min_date, location_campaign_df['start_date'].min())
+            max_date = max(max_date, location_campaign_df['end_date'].max())
 
-        pontential_conflict_doc_dp_df = DataFrame(list(DocDataPoint\
-            .objects.filter(
-                indicator_id__in = indicator_ids,
+        existing_dp_df = DataFrame(list(DataPoint.objects.filter(
                 location_id__in = location_ids,
-                data_date__gte = min_date,
-                data_date__lte = max_date,
-            ).values()))
+                indicator_id__in = doc_dp_df['indicator_id'].unique().tolist(),
+                data_date__gte = to_utc_datetime(min_date),
+                data_date__lt = to_utc_datetime(max_date + timedelta(days=1)),
+            ).values_list(*['id'] + dp_columns)), columns = ['id'] + dp_columns)
+
+        is_resynced = existing_dp_df['source_submission_id'].isin(ss_id_list)
+        competing_dp_df = existing_dp_df[~is_resynced]
+
+        ss_created_at = dict(SourceSubmission.objects.filter(id__in = \
+            set(ss_id_list).union(competing_dp_df['source_submission_id']\
+                .tolist()))\
+            .values_list('id', 'created_at'))
+
+        ## existing rows go first, so a doc datapoint wins a tie ##
+        candidate_df = concat([competing_dp_df, doc_dp_df],\
+            ignore_index = True)
+        candidate_df['created_at'] = candidate_df['source_submission_id']\
+            .map(ss_created_at)
+        self.set_campaign_window(candidate_df, location_campaign_df)
+
+        latest_df = candidate_df.sort(columns = ['created_at'],\
+            kind = 'mergesort')\
+            .drop_duplicates(subset = key_columns, take_last = True)
+
+        insert_df = latest_df[latest_df['id'].isnull()]
+        dp_ids_to_delete = np.concatenate([
+            existing_dp_df[is_resynced]['id'].values,
+            competing_dp_df[~competing_dp_df['id']\
+                .isin(latest_df['id'].dropna())]['id'].values
+        ]).astype(int).tolist()
+
+        dp_qs_to_delete = DataPoint.objects.filter(id__in = dp_ids_to_delete)
+        queue_datapoint_keys(dp_qs_to_delete)
+        dp_qs_to_delete.delete()
+
+        copy_model_df(DataPoint, insert_df[dp_columns])
+
+    def get_location_campaigns(self, location_ids, min_date, max_date):
+        '''
+        A frame of location_id, campaign_id, start_date and end_date for the
+        campaigns of the office of each location that overlap min_date to
+        max_date.
+        '''
 
-        full_dp_df = concat([doc_dp_df,pontential_conflict_doc_dp_df])
-        dp_df = full_dp_df.drop_duplicates()
+        campaign_columns = ['office_id', 'campaign_id', 'start_date',\
+            'end_date']
 
-        ss_columns = ['id','created_at']
-        ss_dp_df = DataFrame(list(SourceSubmission.objects.filter(
-            id__in = ss_id_list).values(*ss_columns)),columns=ss_columns)
+        location_df = DataFrame(list(Location.objects\
+            .filter(id__in = location_ids).values_list('id', 'office_id')),\
+            columns = ['location_id', 'office_id'])
 
-        merged_df = dp_df.merge(ss_dp_df, left_on = 'source_submission_id', \
-            right_on = 'id')
+        campaign_df = DataFrame(list(Campaign.objects\
+            .filter(office_id__in = location_df['office_id'].unique().tolist(),\
+                start_date__lte = max_date, end_date__gt = min_date)\
+            .values_list('office_id', 'id', 'start_date', 'end_date')),\
+            columns = campaign_columns)
 
-        ready_for_sync_tuple_dict = DataFrame(merged_df\
-            .groupby(['location_id', 'indicator_id']).max())['created_at'].to_dict()
+        return location_df.merge(campaign_df, on = 'office_id')\
+            [['location_id', 'campaign_id', 'start_date', 'end_date']]
+
+    def set_campaign_window(self, candidate_df, location_campaign_df):
+        '''
+        The id of the campaign that each datapoint falls in ( the latest one
+        to start if the campaigns of the office overlap ), which is what
+        values for the same location and indicator compete on.  Data that is
+        not in any campaign is not aggregated, so it only competes with data
+        for the same data_date.
+
+        The datapoints are merged with the campaigns of their location and
+        the ones where start_date <= the UTC date of data_date < end_date are
+        kept, instead of looking through the campaigns row by row.
+        '''
 
-        dp_batch, dp_ids_to_delete = [],[]
-        for ix, row in merged_df.iterrows():
-            max_created_at = ready_for_sync_tuple_dict[(row.location_id, \
-                row.indicator_id)]
+        window_df = DataFrame({
+            'row_id': candidate_df.index.values,
+            'location_id': candidate_df['location_id'].values,
+            'dp_date': to_datetime(candidate_df['data_date'], utc = True)\
+                .values.astype('datetime64[D]'),
+        }).merge(location_campaign_df, on = 'location_id')
 
-            row_created_at = row.created_at.replace(tzinfo=None)
+        in_campaign = (window_df['start_date'].values\
+                .astype('datetime64[D]') <= window_df['dp_date'].values) & \
+            (window_df['dp_date'].values < window_df['end_date'].values\
+                .astype('datetime64[D]'))
 
-            if row_created_at == max_created_at:
-                dp_batch.append(DataPoint(**{
-                    'indicator_id' : row.indicator_id,
-                    'location_id' : row.location_id,
-                    'data_date' : row.data_date,
-                    'value' : row.value,
-                    'source_submission_id' : row.source_submission_id,
-                }))
+        window_df = window_df[in_campaign]\
+            .sort(columns = ['start_date'], ascending = False)\
+            .drop_duplicates(subset = ['row_id'])
 
-            else:
-                dp_ids_to_delete.append(row.id_x)
+        campaign_window = candidate_df['data_date'].astype(object)
+        campaign_window.loc[window_df['row_id'].values] = \
+            window_df['campaign_id'].values
 
-        DataPoint.objects.filter(id__in = dp_ids_to_delete).delete()
-        DataPoint.objects.bulk_create(dp_batch)
+        candidate_df['campaign_window'] = campaign_window
 
 
     def process_source_submission(self,row):
+        '''
+        The doc datapoint rows for one submission.  Nothing is written here,
+        the rows for the whole batch are loaded in submissions_to_doc_datapoints.
+        '''
 
         doc_dp_batch = []
         submission  = row.submission_json
@@ -320,66 +480,151 @@ class MasterRefresh(object):
             if doc_dp:
                 doc_dp_batch.append(doc_dp)
 
-        DocDataPoint.objects.filter(source_submission_id=row.id).delete()
-        DocDataPoint.objects.bulk_create(doc_dp_batch)
+        return doc_dp_batch
 
     def source_submission_row_to_doc_datapoints(self, ind_str, val, location_id, \
         data_date, ss_id):
         '''
-        This method prepares a batch insert into docdatapoint by creating a list of
-        DocDataPoint objects.  The Database handles all docdatapoitns in a submission
-        row at once in process_source_submission.
+        This method prepares a batch insert into docdatapoint by returning one
+        row of values in the order of DOC_DP_COLUMNS, or None if the indicator
+        is not mapped.  The value is still the raw value of the cell, it is
+        cleaned along with the rest of the batch in load_doc_datapoints.
         '''
 
-        try:
-            cleaned_val = self.clean_val(val)
-        except ValueError:
-            return None
+        indicator_id = self.get_master_object_id('indicator', ind_str)
 
-        try:
-            indicator_id = self.source_map_dict[('indicator',ind_str)]
-        except KeyError:
+        if indicator_id is None:
             return None
 
-        doc_dp = DocDataPoint(**{
-                'indicator_id':  indicator_id,
-                'value': cleaned_val,
-                'location_id': location_id,
-                'data_date': data_date,
-                'document_id': self.document_id,
-                'source_submission_id': ss_id,
-                'agg_on_location': True,
-            })
-
-        return doc_dp
+        return (indicator_id, val, location_id, data_date,
+            self.document_id, ss_id, True)
 
 
     def clean_val(self, val):
         '''
-        This needs alot of work but basically determines if a particular submission
-        cell is alllowed.
-        Big point of future controversy... what do we do with zero values?  In order to
-        keep the size of the database manageable, we only accept non zero values.
+        Determines if a particular submission cell is alllowed, and returns its
+        value.  Raises a ValueError if it is not.  This cleans one cell, the
+        batch is cleaned all at once with clean_values.
         '''
-        str_lookup = {'yes':1,'no':0}
 
+        values, rejected = clean_values([val])
+
+        if rejected[0]:
+            raise ValueError('Bad Value!')
 
-        if val is None:
+        if np.isnan(values[0]):
             return None
 
-        ## clean!  i am on a deadline rn :-/  ##
+        return float(values[0])
+
+
+class MasterRefreshScheduler(object):
+    '''
+    Drain the queue of TO_PROCESS submissions across every document,
+    instead of one batch of the first document per run of the cron job.
+
+    The documents are visited in turn and each batch is run by a
+    MasterRefresh in its own transaction.  The number of location codes in
+    a batch is adjusted after every batch so that a batch takes about
+    target_seconds: it grows while batches are fast and shrinks when they
+    are slow, between min_batch_size and max_batch_size.
+
+    A document is done when a batch finds nothing to process ( either the
+    queue is empty or the remaining location codes are not mapped ).  If
+    max_seconds is passed no new batch is started after that much time
+    ( the cron job passes MASTER_REFRESH_MAX_SECONDS ).
+
+    Each batch holds a transaction level advisory lock on its document, so
+    if runs overlap, a document that another run is working on is skipped.
+
+    from rhizome.etl_tasks.refresh_master import MasterRefreshScheduler
+    results = MasterRefreshScheduler(user_id).main()
+    '''
+
+    def __init__(self, user_id, target_seconds = None, max_seconds = None,
+        batch_size = 50, min_batch_size = 1, max_batch_size = 5000):
+
+        self.user_id = user_id
+        self.target_seconds = target_seconds or getattr(settings,\
+            'MASTER_REFRESH_BATCH_SECONDS', None) or 10
+        self.max_seconds = max_seconds
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+
+    def main(self):
+        '''
+        Returns a dictionary of document_id -> number of submissions processed.
+        '''
+
+        start_time = time.time()
+        results, drained_document_ids = defaultdict(int), set()
+
+        while True:
+
+            document_ids = SourceSubmission.objects\
+                .filter(process_status = 'TO_PROCESS')\
+                .exclude(document_id__in = drained_document_ids)\
+                .values_list('document_id', flat = True).distinct()
+
+            if len(document_ids) == 0:
+                break
+
+            for document_id in document_ids:
+
+                if self.max_seconds is not None and \
+                    time.time() - start_time > self.max_seconds:
+                    return dict(results)
 
-        locale.setlocale( locale.LC_ALL, 'en_US.UTF-8' )
+                ss_count = self.process_batch(document_id)
 
-        try:
-            cleaned_val = locale.atoi(val) # 100,000 -> 100000.oo
-        except AttributeError:
-            cleaned_val = float(val)
-        except ValueError:
+                if ss_count == 0:
+                    drained_document_ids.add(document_id)
+
+                results[document_id] += ss_count
+
+        return dict(results)
+
+    def process_batch(self, document_id):
+        '''
+        Run one MasterRefresh batch for document_id, commit it, and resize
+        the next batch based on how long this one took.  Returns the number
+        of submissions that were processed, which is 0 if another process
+        holds the lock on the document.
+        '''
+
+        batch_start_time = time.time()
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)',\
+                [document_id])
+
+            if not cursor.fetchone()[0]:
+                return 0
+
+            mr = MasterRefresh(self.user_id, document_id,\
+                self.batch_size)
+            mr.main()
+
+        ss_count = len(mr.ss_ids_to_process)
+
+        if ss_count > 0:
+            ## once the batch has committed ( see AggRefresh.__init__ ) ##
+            bump_data_version()
+            self.resize_batch(time.time() - batch_start_time)
+
+        return ss_count
+
+    def resize_batch(self, elapsed_seconds):
+        '''
+        Scale the batch size by how far the last batch was from
+        target_seconds.  The change is capped at a factor of two either way
+        so that one odd batch does not throw the size off.
+        '''
 
-            try:
-                cleaned_val = str_lookup[val.lower()]
-            except KeyError:
-                raise ValueError('Bad Value!')
+        ratio = self.target_seconds / max(elapsed_seconds, 0.001)
+        ratio = min(max(ratio, 0.5), 2.0)
 
-        return cleaned_val
+        self.batch_size = int(min(max(self.batch_size * ratio,\
+            self.min_batch_size), self.max_batch_size))
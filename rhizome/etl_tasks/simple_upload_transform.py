@@ -3,11 +3,17 @@ import math
 
 from pandas import read_csv
 from pandas import notnull
+from pandas import DataFrame
+from pandas import melt
 from django.conf import settings
 
 from rhizome.models import *
 from rhizome.api.exceptions import DatapointsException
-from rhizome.etl_tasks.transform_upload import DocTransform
+from rhizome.etl_tasks.transform_upload import DocTransform, source_code_str
+from rhizome.etl_tasks.clean_values import clean_values
+from rhizome.pg_utils import merge_model_df
+from rhizome.agg_tasks import refresh_datapoint_abstracted
+from rhizome.api.custom_cache import bump_data_version
 from django.db import IntegrityError
 
 
@@ -22,6 +28,9 @@ class SimpleDocTransform(DocTransform):
         self.location_column, self.campaign_column, self.uq_id_column = \
             ['geocode', 'campaign', 'unique_key']
 
+        self.dwc_columns = ['location_id', 'indicator_id', 'campaign_id',\
+            'value', 'cache_job_id', 'document_id']
+
         self.document = Document.objects.get(id=document_id)
         self.file_path = str(self.document.docfile)
 
@@ -79,12 +88,63 @@ class SimpleDocTransform(DocTransform):
     def main(self):
 
         self.file_to_source_submissions()
+        self.collect_source_codes(self.csv_df)
         self.upsert_source_object_map()
 
-        for row in SourceSubmission.objects.filter(document_id = \
-            self.document.id):
+        dwc_df = self.csv_df_to_dwc_df()
+
+        ## the new values replace any stored for the same keys ##
+        merge_model_df(DataPointComputed, dwc_df)
+
+        for campaign_id, campaign_df in dwc_df.groupby('campaign_id'):
+            refresh_datapoint_abstracted(int(campaign_id),\
+                campaign_df['location_id'].unique().tolist())
+
+        bump_data_version()
+
+    def csv_df_to_dwc_df(self):
+        '''
+        Turn the file in to DataPointComputed rows in one pass.  The location
+        and campaign of every row are looked up in meta_lookup, and the frame
+        is melted in to one row per location, campaign and mapped indicator.
+        The values are then cleaned all at once ( see clean_values ), and
+        the blank and rejected ones are dropped.
+        '''
+
+        indicator_columns = [c for c in self.csv_df.columns \
+            if self.meta_lookup['indicator'].get(c, -1) > 0]
+
+        doc_df = self.csv_df[indicator_columns].copy()
+        doc_df['location_id'] = self.csv_df[self.location_column]\
+            .map(source_code_str).map(self.meta_lookup['location'])
+        doc_df['campaign_id'] = self.csv_df[self.campaign_column]\
+            .map(source_code_str).map(self.meta_lookup['campaign'])
+
+        ## rows without a mapped location and campaign can not be stored ##
+        doc_df = doc_df[(doc_df['location_id'] > 0) & \
+            (doc_df['campaign_id'] > 0)]
+
+        if len(indicator_columns) == 0 or len(doc_df) == 0:
+            return DataFrame(columns = self.dwc_columns)
+
+        long_df = melt(doc_df, id_vars = ['location_id', 'campaign_id'],\
+            value_vars = indicator_columns, var_name = 'indicator_code',\
+            value_name = 'raw_value')
+
+        values, rejected = clean_values(long_df['raw_value'])
+        long_df['value'] = values
+        long_df = long_df[~rejected & notnull(long_df['value'])].copy()
+
+        long_df['indicator_id'] = long_df['indicator_code']\
+            .map(self.meta_lookup['indicator'])
+        long_df['cache_job_id'] = -1
+        long_df['document_id'] = self.document.id
 
-            self.process_source_submission(row)
+        dwc_df = long_df[self.dwc_columns].copy()
+        for c in ['location_id', 'indicator_id', 'campaign_id']:
+            dwc_df[c] = dwc_df[c].astype(int)
+
+        return dwc_df
 
     def process_raw_source_submission(self, submission):
 
@@ -112,92 +172,6 @@ class SimpleDocTransform(DocTransform):
         return submission_dict, instance_guid
 
 
-    def process_source_submission(self,row):
-
-        dwc_batch, dwc_list_of_lists = [], []
-        submission  = row.submission_json
-
-
-        try:
-            location_id = self.meta_lookup['location'][row.location_code]
-            campaign_id = self.meta_lookup['campaign'][row.campaign_code]
-        except KeyError:
-            # raise RowMapErrorException -- ## no mapping for campaign/location
-            return
-
-        for k,v in submission.iteritems():
-
-            dwc_obj, indicator_id = self.process_submission_cell(location_id, campaign_id, k, v)
-
-            if dwc_obj:
-                dwc_batch.append(dwc_obj)
-                dwc_list_of_lists.append([location_id,indicator_id,campaign_id])
-
-        dwc_ids_to_delete = self.get_dwc_ids_to_delete(dwc_list_of_lists)
-        DataPointComputed.objects.filter(id__in=dwc_ids_to_delete).delete()
-        DataPointComputed.objects.bulk_create(dwc_batch)
-
-    def process_submission_cell(self, location_id, campaign_id, k,v):
-
-        value_lookup = {'yes': 1, 'no':0, 'Yes':1, 'No': 0, '': None}
-
-        try:
-            looked_up_val = value_lookup[v]
-        except KeyError:
-            looked_up_val = v
-
-        try:
-            indicator_id = self.meta_lookup['indicator'][k]
-        except KeyError:
-            return None, None
-
-        if indicator_id == -1:
-            return None, None
-
-        if v is None:
-            return None, None
-
-        try:
-            float_val = float(v)
-        except ValueError:
-            return None, None
-
-        if indicator_id:
-
-            dwc_obj = DataPointComputed(**{
-                    'location_id': location_id,
-                    'indicator_id' : indicator_id,
-                    'campaign_id': campaign_id,
-                    'value': float_val,
-                    'cache_job_id': -1,
-                    'document_id': self.document.id
-                })
-
-            return dwc_obj, indicator_id
-
-    def get_dwc_ids_to_delete(self, dwc_list_of_lists):
-
-        df = DataFrame(dwc_list_of_lists, columns=['location_id', \
-            'indicator_id', 'campaign_id'])
-
-        uq_location_id_list = list(df['location_id'].unique())
-        uq_indicator_id_list = list(df['indicator_id'].unique())
-        uq_campaign_id_list = list(df['campaign_id'].unique())
-
-        dwc_location_ids = DataPointComputed.objects.filter(location_id__in=
-            uq_location_id_list).values_list('id',flat=True)
-
-        dwc_indicator_ids = DataPointComputed.objects.filter(indicator_id__in=
-            uq_indicator_id_list).values_list('id',flat=True)
-
-        dwc_campaign_ids = DataPointComputed.objects.filter(campaign_id__in=
-            uq_campaign_id_list).values_list('id',flat=True)
-
-        ids_to_delete = set.intersection(*map(set,\
-            [dwc_location_ids,dwc_indicator_ids,dwc_campaign_ids]))
-
-        return ids_to_delete
-
     def file_to_source_submissions(self):
 
         batch = {}
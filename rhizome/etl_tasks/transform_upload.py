@@ -1,18 +1,29 @@
 from pandas import read_csv
 from pandas import notnull
 from pandas import to_datetime
-import json
+from pandas import DataFrame
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 
 from rhizome.models import *
+from rhizome.pg_utils import merge_model_df
 
 class BadFileHeaderException(Exception):
     defaultMessage = "Your Header Has Commas in it, please fix and re-upload"
     defaultCode = -2
 
 
+def source_code_str(code):
+    '''
+    The source_object_code for a value read from a file.  Codes are stored
+    as strings, but read_csv can give us numbers.
+    '''
+
+    return code if isinstance(code, basestring) else str(code)
+
+
 class DocTransform(object):
 
     def __init__(self, user_id, document_id):
@@ -22,75 +33,85 @@ class DocTransform(object):
         self.source_datapoints = []
         self.user_id = user_id
 
-        self.existing_submission_keys = SourceSubmission.objects.filter(
-            document_id = self.document.id).values_list('instance_guid',flat=True)
+        ## loaded once in to a set, so that checking every row of the file
+        ## against it is a hash lookup and not a scan of the whole list ##
+        self.existing_submission_keys = set(SourceSubmission.objects.filter(
+            document_id = self.document.id).values_list('instance_guid',flat=True))
 
         self.file_path = str(self.document.docfile)
 
-    def source_submission_meta_upsert(self, content_type, source_object_code):
+        ## the location and campaign codes in the file ( or in the chunk of
+        ## it that is being loaded ), collected while it is parsed.  see
+        ## collect_source_codes ##
+        self.source_codes = {'location': set(), 'campaign': set()}
+
+    def collect_source_codes(self, df):
         '''
-        Create new metadata if not exists
-        Add a record tying this document to the newly inserted metadata
+        Add the location and campaign codes in a frame of the file to
+        self.source_codes, so that upsert_source_object_map does not have to
+        read them back out of the submission_json.
         '''
 
-        config_columns = [self.location_column, self.uq_id_column, \
-            self.campaign_column,'District', 'DCODE', 'District.Name', \
-            'DCODE', 'level', 'PCODE', 'Province']
+        code_columns = [('location', self.location_column),
+            ('campaign', self.campaign_column)]
 
-        if content_type == 'indicator' and source_object_code in config_columns:
-            return ## so we dont think that "campaign" is an indicator
+        for content_type, column in code_columns:
 
-        ## this is sketchy, but since there is no user when we do the initial
-        ## data migration, we have to set mapped_by_id = None
-        upload_user_id = None
-        if self.user_id > 0:
-            upload_user_id = self.user_id
-
-        sm_obj, created = SourceObjectMap.objects.get_or_create(\
-            content_type = content_type\
-           ,source_object_code = str(source_object_code)\
-           ,defaults = {
-            'master_object_id':-1,
-            'mapped_by_id':upload_user_id
-            })
+            if not column or column not in df.columns:
+                continue
 
-        sm_obj, created = DocumentSourceObjectMap.objects.get_or_create\
-            (document_id = self.document.id,source_object_map_id = sm_obj.id)
-
-        return sm_obj.id
+            self.source_codes[content_type].update(df[column].dropna()\
+                .map(source_code_str))
 
     def upsert_source_object_map(self):
         '''
-        TODO: save the source_strings so i dont have to iterate through
-        the source_submission json.
+        Create a source_object_map for every code in the file that does not
+        have one yet, and tie all of them to this document.  Each table is
+        upserted with one set based statement ( see pg_utils.merge_model_df ).
 
         endpoint: api/v2/doc_mapping/?document=66
         '''
 
-        source_dp_json = SourceSubmission.objects.filter(
-            document_id = self.document.id).values_list('submission_json')
-
-        if len(source_dp_json) == 0:
+        if getattr(self, 'file_header', None) is None or \
+            len(self.source_codes['location']) == 0:
             return
 
-        all_codes = [('indicator',k) for k,v in json.loads(source_dp_json[0][0]).iteritems()]
-        rg_codes, cp_codes = [],[]
+        config_columns = [self.location_column, self.uq_id_column, \
+            self.campaign_column,'District', 'DCODE', 'District.Name', \
+            'DCODE', 'level', 'PCODE', 'Province']
 
-        for row in source_dp_json:
-            row_dict = json.loads(row[0])
-            rg_codes.append(row_dict[self.location_column])
-            if self.campaign_column and self.campaign_column in row_dict:
-                cp_codes.append(row_dict[self.campaign_column])
+        ## so we dont think that "campaign" is an indicator ##
+        all_codes = [('indicator', str(c)) for c in self.file_header \
+            if c not in config_columns]
 
-        for r in list(set(rg_codes)):
-            all_codes.append(('location',r))
+        for content_type in ['location', 'campaign']:
+            all_codes.extend([(content_type, c) for c in \
+                self.source_codes[content_type]])
 
-        for c in list(set(cp_codes)):
-            all_codes.append(('campaign',c))
+        ## this is sketchy, but since there is no user when we do the initial
+        ## data migration, we have to set mapped_by_id = None
+        upload_user_id = None
+        if self.user_id > 0:
+            upload_user_id = self.user_id
+
+        som_df = DataFrame(all_codes, columns = ['content_type',\
+            'source_object_code'])
+        som_df['master_object_id'] = -1
+        som_df['mapped_by_id'] = upload_user_id
 
-        for content_type, source_object_code in all_codes:
-            self.source_submission_meta_upsert(content_type, source_object_code)
+        merge_model_df(SourceObjectMap, som_df, update = False)
 
+        all_codes = set(all_codes)
+        som_ids = [som_id for som_id, content_type, source_object_code in \
+            SourceObjectMap.objects.filter(source_object_code__in = \
+                som_df['source_object_code'].unique().tolist())\
+            .values_list('id', 'content_type', 'source_object_code')
+            if (content_type, source_object_code) in all_codes]
+
+        doc_som_df = DataFrame({'source_object_map_id': som_ids})
+        doc_som_df['document_id'] = self.document.id
+
+        merge_model_df(DocumentSourceObjectMap, doc_som_df, update = False)
 
 
 class ComplexDocTransform(DocTransform):
@@ -126,10 +147,15 @@ class ComplexDocTransform(DocTransform):
 
         self.campaign_column = 'campaign'
 
+        ## the file is read csv_chunk_size rows at a time.  If set,
+        ## progress_callback is called with the number of rows read and the
+        ## number of submissions loaded so far after every chunk ##
+        self.csv_chunk_size = 10000
+        self.progress_callback = None
+
     def main(self):
 
         self.process_file()
-        self.upsert_source_object_map()
 
     def process_raw_source_submission(self, submission):
 
@@ -138,7 +164,9 @@ class ComplexDocTransform(DocTransform):
         submission_data = dict(zip(self.file_header,submission_data))
         instance_guid = submission_data[self.uq_id_column]
 
-        if instance_guid == '' or instance_guid in self.existing_submission_keys:
+        ## a blank uq_id cell is read as None ##
+        if instance_guid in (None, '') or \
+            instance_guid in self.existing_submission_keys:
             return None, None
 
         submission_dict = {
@@ -192,34 +220,79 @@ class ComplexDocTransform(DocTransform):
         '''
         Takes a file and dumps the data into the source submission table.
 
+        The file is read and loaded csv_chunk_size rows at a time so that
+        memory does not grow with the size of the file.  When an instance_guid
+        is in the file more than once the first row is kept.
+
+        Each chunk is loaded in one transaction along with the source object
+        maps for its codes, so if the upload fails part way through, every
+        submission that was loaded has its mappings.
+
         Returns a list of source_submission_ids
         '''
 
         full_file_path = settings.MEDIA_ROOT + self.file_path
-        raw_csv_df = read_csv(full_file_path)
-        csv_df = raw_csv_df.where((notnull(raw_csv_df)), None)
 
-        ## transform the raw data based on the documents configurations ##
-        doc_df = self.apply_doc_config_to_csv_df(csv_df)
-        doc_df = self.process_date_column(doc_df)
+        ## read the id columns as strings so that they are parsed the same
+        ## way in every chunk ( 1234 and not 1234.0 when a chunk has blanks ) ##
+        csv_reader = read_csv(full_file_path, chunksize = self.csv_chunk_size,
+            dtype = {self.location_column: object, self.uq_id_column: object})
+
+        self.file_header = None
+        ss_ids, rows_read = [], 0
+
+        for raw_csv_df in csv_reader:
+
+            csv_df = raw_csv_df.where((notnull(raw_csv_df)), None)
 
-        doc_obj = Document.objects.get(id = self.document.id)
-        doc_obj.file_header = list(doc_df.columns.values)
-        doc_obj.save()
+            ## transform the raw data based on the documents configurations ##
+            doc_df = self.apply_doc_config_to_csv_df(csv_df)
+            doc_df = self.process_date_column(doc_df)
 
-        self.file_header = doc_obj.file_header
+            self.source_codes = {'location': set(), 'campaign': set()}
+            self.collect_source_codes(doc_df)
 
-        batch = {}
+            if self.file_header is None:
+                doc_obj = Document.objects.get(id = self.document.id)
+                doc_obj.file_header = list(doc_df.columns.values)
+                doc_obj.save()
 
-        for submission in doc_df.itertuples():
+                self.file_header = doc_obj.file_header
 
-            ss, instance_guid = self.process_raw_source_submission(submission)
+            batch = []
 
-            if ss is not None and instance_guid is not None:
-                ss['instance_guid'] = instance_guid
-                batch[instance_guid] = ss
+            for submission in doc_df.itertuples():
 
-        object_list = [SourceSubmission(**v) for k,v in batch.iteritems()]
-        ss = SourceSubmission.objects.bulk_create(object_list)
+                ss, instance_guid = self.process_raw_source_submission(submission)
 
-        return [x.id for x in ss]
+                if ss is not None:
+                    self.existing_submission_keys.add(instance_guid)
+                    batch.append(SourceSubmission(**ss))
+
+            with transaction.atomic():
+                ss_ids.extend(self.load_submission_batch(batch))
+                self.upsert_source_object_map()
+
+            rows_read += len(raw_csv_df)
+
+            if self.progress_callback is not None:
+                self.progress_callback(rows_read, len(ss_ids))
+
+        return ss_ids
+
+    def load_submission_batch(self, batch):
+        '''
+        bulk_create a list of SourceSubmission objects and return their ids.
+        bulk_create does not set the ids, so they are looked up by
+        instance_guid.
+        '''
+
+        if len(batch) == 0:
+            return []
+
+        SourceSubmission.objects.bulk_create(batch)
+
+        return list(SourceSubmission.objects.filter(
+            document_id = self.document.id,
+            instance_guid__in = [ss.instance_guid for ss in batch])\
+            .values_list('id', flat = True))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import jsonfield.fields
+import django.db.models.deletion
+from django.db import models, migrations
+
+## the pivot in refresh_datapoint_abstracted as of this migration, for every
+## campaign at once, so that the rows do not depend on the live code ##
+POPULATE_DATAPOINT_ABSTRACTED_SQL = '''
+    SET LOCAL extra_float_digits = 3;
+
+    INSERT INTO datapoint_abstracted
+    (location_id, campaign_id, indicator_json, cache_job_id)
+    SELECT
+        location_id
+        , campaign_id
+        , '{' || string_agg(
+            '"' || indicator_id || '":[' ||
+            CASE WHEN value IN ('NaN', 'Infinity', '-Infinity')
+                THEN 'null' ELSE value::text END
+            || ',' || id || ']'
+        , ',') || '}'
+        , -1
+    FROM datapoint_with_computed
+    GROUP BY location_id, campaign_id;
+
+    INSERT INTO datapoint_abstracted_campaign
+    (campaign_id, cache_job_id)
+    SELECT id, -1 FROM campaign;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rhizome', '0005_reset_sql_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataPointAbstracted',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('indicator_json', jsonfield.fields.JSONField()),
+                ('cache_job', models.ForeignKey(default=-1, to='rhizome.CacheJob')),
+                ('campaign', models.ForeignKey(to='rhizome.Campaign')),
+                ('location', models.ForeignKey(to='rhizome.Location')),
+            ],
+            options={
+                'db_table': 'datapoint_abstracted',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='datapointabstracted',
+            unique_together=set([('location', 'campaign')]),
+        ),
+        migrations.CreateModel(
+            name='DataPointAbstractedCampaign',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('cache_job', models.ForeignKey(default=-1, to='rhizome.CacheJob')),
+                ('campaign', models.OneToOneField(to='rhizome.Campaign')),
+            ],
+            options={
+                'db_table': 'datapoint_abstracted_campaign',
+            },
+        ),
+        migrations.RunSQL(POPULATE_DATAPOINT_ABSTRACTED_SQL),
+    ]
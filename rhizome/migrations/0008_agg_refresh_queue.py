@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rhizome', '0007_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggRefreshQueue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_at', models.DateTimeField(auto_now=True)),
+                ('campaign', models.ForeignKey(to='rhizome.Campaign')),
+                ('indicator', models.ForeignKey(to='rhizome.Indicator')),
+                ('location', models.ForeignKey(to='rhizome.Location')),
+            ],
+            options={
+                'db_table': 'agg_refresh_queue',
+            },
+        ),
+    ]
@@ -1,7 +1,11 @@
 import hashlib
 import random
 
+from django.conf import settings
+from django.core.cache import caches
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from pandas import DataFrame
@@ -25,6 +29,81 @@ class CacheJob(models.Model):
         db_table = 'cache_job'
         ordering = ('-date_attempted',)
 
+class DataVersion(models.Model):
+    '''
+    A counter that is bumped every time the data behind the API changes
+    ( after an AggRefresh, an upload, a meta data refresh or a write through
+    the API ).  Cached API responses are keyed on the version, so a bump
+    invalidates all of them at once.  See api/custom_cache.py.
+
+    There is one row for each kind of version:
+        - DATA: the data behind the API.
+        - LOCATION_TREE: the parents, types and lpd_status of the locations,
+          which is what the LocationTreeIndex is built from.  It is bumped
+          when a location is saved and by the LocationTreeCache.
+    '''
+
+    DATA = 1
+    LOCATION_TREE = 2
+
+    version = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'data_version'
+
+    @classmethod
+    def get_version(cls, version_id = DATA):
+
+        try:
+            return cls.objects.get(id=version_id).version
+        except ObjectDoesNotExist:
+            return 0
+
+    @classmethod
+    def get_version_key(cls, version_id = DATA):
+        '''
+        The version along with the time that it was bumped.  Unlike the
+        version alone, this does not repeat if a bump is rolled back and
+        then made again.
+        '''
+
+        try:
+            return cls.objects.filter(id=version_id)\
+                .values_list('version', 'updated_at')[0]
+        except IndexError:
+            return (0, None)
+
+    @classmethod
+    def get_cached_version_key(cls, version_id = DATA):
+        '''
+        get_version_key, read from the database at most once every
+        DATA_VERSION_CACHE_SECONDS per process.  A bump in this process is
+        seen right away, a bump in another one within that many seconds.
+        '''
+
+        cache = caches['default']
+        cache_key = 'rhizome_version_key:%s' % version_id
+        version_key = cache.get(cache_key)
+
+        if version_key is None:
+            version_key = cls.get_version_key(version_id)
+            cache.set(cache_key, version_key, getattr(settings,\
+                'DATA_VERSION_CACHE_SECONDS', 5))
+
+        return version_key
+
+    @classmethod
+    def bump(cls, version_id = DATA):
+
+        updated = cls.objects.filter(id=version_id).update(
+            version=F('version') + 1, updated_at=timezone.now())
+
+        if updated == 0:
+            cls.objects.get_or_create(id=version_id, defaults={'version': 1})
+
+        caches['default'].delete('rhizome_version_key:%s' % version_id)
+
 class UserGroup(models.Model):
     '''
     auth_user_groups is how django handels user group membership by default.
@@ -112,6 +191,19 @@ class Location(models.Model):
     def __unicode__(self):
         return unicode(self.name)
 
+    def save(self, **kwargs):
+
+        super(Location, self).save(**kwargs)
+
+        ## the LocationTreeIndex needs to be rebuilt ##
+        DataVersion.bump(DataVersion.LOCATION_TREE)
+
+    def delete(self, **kwargs):
+
+        super(Location, self).delete(**kwargs)
+
+        DataVersion.bump(DataVersion.LOCATION_TREE)
+
     class Meta:
         db_table = 'location'
 
@@ -384,8 +476,11 @@ class Campaign(models.Model):
 
     def get_raw_datapoint_ids(self):
 
-        flat_location_id_list = LocationTree.objects.filter(parent_location_id=\
-            self.top_lvl_location_id).values_list('location_id',flat=True)
+        ## imported here, as cache_meta depends on this module ##
+        from rhizome.cache_meta import LocationTreeIndex
+
+        flat_location_id_list = LocationTreeIndex.get_index()\
+            .get_descendant_ids([self.top_lvl_location_id])
 
         # indicator_id_list = CampaignToIndicator.objects.filter(campaign_id = \
         #     self.id).values_list('indicator_id',flat=True)
@@ -649,3 +744,59 @@ class AggDataPoint(models.Model):
     class Meta:
         db_table = 'agg_datapoint'
         unique_together = ('location', 'campaign', 'indicator')
+
+class AggRefreshQueue(models.Model):
+    '''
+    The (location, indicator) keys of a campaign whose aggregated and
+    calculated values are out of date.  The incremental AggRefresh for a
+    campaign refreshes the keys queued for it, and removes them from the
+    queue in the same transaction.
+
+    A deleted datapoint can not be found with cache_job_id = -1, so its keys
+    are queued here before it is deleted.  See agg_tasks.queue_datapoint_keys.
+    '''
+
+    campaign = models.ForeignKey(Campaign)
+    location = models.ForeignKey(Location)
+    indicator = models.ForeignKey(Indicator)
+    created_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'agg_refresh_queue'
+
+class DataPointAbstracted(models.Model):
+    '''
+    The DataPointComputed table pivoted, with one row per location and
+    campaign.  indicator_json holds the value and the datapoint_with_computed
+    id of every indicator for that location and campaign, in the form:
+
+        {"<indicator_id>": [value, computed_id], ...}
+
+    This is what the /api/v1/datapoint endpoint returns, so a request is a
+    keyed fetch instead of a pivot.  The rows are refreshed from the
+    DataPointComputed table by refresh_datapoint_abstracted in agg_tasks.
+    '''
+
+    location = models.ForeignKey(Location)
+    campaign = models.ForeignKey(Campaign)
+    indicator_json = JSONField()
+    cache_job = models.ForeignKey(CacheJob, default=-1)
+
+    class Meta:
+        db_table = 'datapoint_abstracted'
+        unique_together = ('location', 'campaign')
+
+
+class DataPointAbstractedCampaign(models.Model):
+    '''
+    The campaigns whose DataPointAbstracted rows have been built for every
+    location.  Refreshing only some locations of a campaign leaves the others
+    as they were, so the datapoint endpoint only reads a campaign from the
+    datapoint_abstracted table once it is in here.
+    '''
+
+    campaign = models.OneToOneField(Campaign)
+    cache_job = models.ForeignKey(CacheJob, default=-1)
+
+    class Meta:
+        db_table = 'datapoint_abstracted_campaign'
@@ -0,0 +1,245 @@
+from StringIO import StringIO
+
+from django.db import connection, transaction
+from django.utils import timezone
+from pandas import isnull
+
+## characters that have a meaning in the COPY text format ##
+COPY_ESCAPES = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]
+
+
+def copy_value(value):
+    '''
+    Format one python value for the COPY text format.  None and NaN are
+    written as NULL, and floats are written with repr so that no precision
+    is lost.
+    '''
+
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, float):
+        return '\\N' if isnull(value) else repr(value)
+
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+
+    if not isinstance(value, basestring):
+        return '\\N' if isnull(value) else str(value)
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    for char, escaped in COPY_ESCAPES:
+        value = value.replace(char, escaped)
+
+    return value
+
+
+def df_to_rows(df, columns):
+    '''
+    The rows of a DataFrame as tuples of python values.  This is done column
+    by column, as calling .values on a frame with mixed types would turn the
+    integer ids in to floats.  Going through object keeps dates as
+    Timestamps rather than the integers numpy would give us.
+    '''
+
+    return zip(*[df[c].astype(object).tolist() for c in columns])
+
+
+def copy_rows(table_name, columns, rows, cursor = None):
+    '''
+    Load an iterable of row tuples in to table_name with COPY FROM STDIN.
+    This is much faster than bulk_create, which has to build a model
+    instance for every row and then send an INSERT with all of their values.
+
+    The rows are written to the table as is, so any default ( i.e. an id
+    sequence ) only applies to the columns that are not passed.
+    '''
+
+    if cursor is None:
+        cursor = connection.cursor()
+
+    copy_buffer = StringIO()
+    for row in rows:
+        copy_buffer.write('\t'.join([copy_value(v) for v in row]) + '\n')
+
+    copy_buffer.seek(0)
+
+    cursor.copy_from(copy_buffer, table_name, columns = columns)
+
+
+def copy_df(table_name, df, columns = None, cursor = None):
+    '''
+    Load the columns of a DataFrame in to table_name with COPY.  The column
+    names of the frame need to match the columns of the table.
+    '''
+
+    if columns is None:
+        columns = list(df.columns)
+
+    copy_rows(table_name, columns, df_to_rows(df, columns), cursor)
+
+
+def get_model_rows(model, df):
+    '''
+    The columns and rows needed to load df in to the table for model.  Django
+    sets defaults in python and not in the database, so any concrete column
+    that is missing from df is filled in with the model default, or the
+    current time for auto_now fields.
+    '''
+
+    columns = [c for c in df.columns]
+    default_columns, default_values = [], []
+
+    for field in model._meta.concrete_fields:
+
+        if field.primary_key or field.column in columns:
+            continue
+
+        if getattr(field, 'auto_now', False) or \
+            getattr(field, 'auto_now_add', False):
+            default_columns.append(field.column)
+            default_values.append(timezone.now())
+
+        elif field.has_default():
+            default_columns.append(field.column)
+            default_values.append(field.get_default())
+
+    rows = [row + tuple(default_values) for row in df_to_rows(df, columns)]
+
+    return columns + default_columns, rows
+
+
+def copy_model_df(model, df, cursor = None):
+    '''
+    Append the rows of df to the table for model with COPY.
+
+    from rhizome.pg_utils import copy_model_df
+    copy_model_df(DataPoint, dp_df)
+    '''
+
+    if len(df) == 0:
+        return
+
+    columns, rows = get_model_rows(model, df)
+    copy_rows(model._meta.db_table, columns, rows, cursor)
+
+
+def merge_model_df(model, df, key_columns = None, replace_qs = None,
+    update = True):
+    '''
+    Upsert the rows of df in to the table for model.  The rows are loaded
+    with COPY in to a temporary staging table, and then merged in to the
+    table with one set based UPDATE for the keys that exist and one INSERT
+    for the keys that do not.
+
+    key_columns defaults to the unique_together of the model.  If the same
+    key is in df more than once the last row wins.
+
+    If passed, the rows of replace_qs whose key is not in df are deleted, so
+    that replace_qs ends up holding exactly the rows in df, while the rows
+    that did not change keep their ids.
+
+    With update = False the rows that already exist are left as they are,
+    and only the keys that are missing are inserted.
+
+    from rhizome.pg_utils import merge_model_df
+    merge_model_df(AggDataPoint, agg_df, replace_qs = AggDataPoint.objects\\
+        .filter(campaign_id = campaign_id))
+    '''
+
+    if len(df) == 0 and replace_qs is None:
+        return
+
+    table_name = model._meta.db_table
+    staging_table_name = '_staging_' + table_name
+
+    if key_columns is None:
+        key_columns = [model._meta.get_field(f).column for f in \
+            model._meta.unique_together[0]]
+
+    df = df.drop_duplicates(subset = key_columns, take_last = True)
+    columns, rows = get_model_rows(model, df)
+    update_columns = [c for c in columns if c not in key_columns] \
+        if update else []
+
+    column_sql = ', '.join(columns)
+    key_match_sql = ' AND '.join(['t.%s = s.%s' % (c, c) for c in key_columns])
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+
+        cursor.execute('''
+            DROP TABLE IF EXISTS %(stg)s;
+            CREATE TEMP TABLE %(stg)s ON COMMIT DROP AS
+            SELECT %(columns)s FROM %(table)s WITH NO DATA;
+        ''' % {'stg': staging_table_name, 'columns': column_sql,
+            'table': table_name})
+
+        copy_rows(staging_table_name, columns, rows, cursor)
+
+        ## temp tables have no statistics until they are analyzed.  with
+        ## them the planner knows the staging table is small, and joins it to
+        ## the table through the unique index on the key instead of scanning
+        ## the whole table, so the cost follows the rows being merged ##
+        cursor.execute('ANALYZE %s;' % staging_table_name)
+
+        if replace_qs is not None:
+            replace_sql, replace_params = replace_qs.values_list('id')\
+                .query.sql_with_params()
+
+            cursor.execute('''
+                DELETE FROM %(table)s t
+                WHERE t.id IN (%(replace_sql)s)
+                AND NOT EXISTS (
+                    SELECT 1 FROM %(stg)s s WHERE %(key_match)s
+                );
+            ''' % {'table': table_name, 'replace_sql': replace_sql,
+                'stg': staging_table_name, 'key_match': key_match_sql},
+                replace_params)
+
+        if update_columns:
+            cursor.execute('''
+                UPDATE %(table)s t
+                SET %(set_columns)s
+                FROM %(stg)s s
+                WHERE %(key_match)s;
+            ''' % {'table': table_name, 'stg': staging_table_name,
+                'key_match': key_match_sql, 'set_columns': ', '.join(\
+                    ['%s = s.%s' % (c, c) for c in update_columns])})
+
+        cursor.execute('''
+            INSERT INTO %(table)s (%(columns)s)
+            SELECT %(columns)s FROM %(stg)s s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM %(table)s t WHERE %(key_match)s
+            );
+        ''' % {'table': table_name, 'columns': column_sql,
+            'stg': staging_table_name, 'key_match': key_match_sql})
+
+
+def iter_queryset(qs, itersize = 2000):
+    '''
+    Yield the rows of a values_list queryset from a server side ( named )
+    cursor, fetching itersize rows at a time.  Django's .iterator() still
+    pulls the whole result over to the client before the first row comes
+    back, so memory grows with the size of the result.
+
+    The cursor is declared WITH HOLD, so it can be read outside of a
+    transaction, for instance while a StreamingHttpResponse is being sent.
+    '''
+
+    sql, params = qs.query.sql_with_params()
+
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(name = 'iter_%s' % id(qs),\
+        withhold = True)
+    cursor.itersize = itersize
+
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
@@ -91,6 +91,40 @@ CRON_CLASSES = [
 
 ANONYMOUS_USER_ID = -1
 
+# Number of worker processes used to refresh campaigns in parallel.
+# Defaults to the number of CPUs.
+AGG_REFRESH_PROCESSES = None
+
+# About how many seconds one MasterRefresh batch should take.  The number
+# of location codes in a batch is adjusted to hit this.
+MASTER_REFRESH_BATCH_SECONDS = 10
+
+# No new MasterRefresh batch is started after this many seconds of a run of
+# the cron job, so that one run is done before the next one starts.
+MASTER_REFRESH_MAX_SECONDS = 50
+
+# How long an api process trusts the data version it read before reading it
+# from the database again.  Cached api responses can be this many seconds
+# out of date.  See rhizome/api/custom_cache.py
+DATA_VERSION_CACHE_SECONDS = 5
+
+# How long api responses are cached for the resources that set
+# cache_responses in their Meta.  0 turns the response cache off.
+API_RESPONSE_CACHE_SECONDS = 0
+
+# The longest that a process keeps the top level location and the allowed
+# locations of a user.  See rhizome/api/permission_context.py
+PERMISSION_CONTEXT_SECONDS = 300
+
+# 'default' is local to each process, and holds what it is fine for one
+# process to have out of date for a few seconds ( the data version and the
+# api responses keyed on it ).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
 ROOT_URLCONF = 'rhizome.urls'
 WSGI_APPLICATION = 'rhizome.wsgi.application'
 
@@ -168,6 +202,8 @@ TEMPLATES = [
 
 TASTYPIE_DEFAULT_FORMATS = ['json']
 API_LIMIT_PER_PAGE = 0
+## the largest page a client can ask for with ?cursor= / ?limit= ##
+API_MAX_PAGE_SIZE = 1000
 TASTYPIE_FULL_DEBUG = True
 
 INTERNAL_IPS=('127.0.0.1',)
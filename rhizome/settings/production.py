@@ -2,6 +2,10 @@ DEBUG = False
 
 TEMPLATE_DEBUG = False
 
+## cached responses are invalidated when the data version is bumped, so
+## they can be kept for a long time ##
+API_RESPONSE_CACHE_SECONDS = 60 * 60 * 24
+
 ALLOWED_HOSTS = [
 
 ]
@@ -5,7 +5,9 @@ from django.test import TestCase
 
 from rhizome.models import *
 
-from rhizome.agg_tasks import AggRefresh
+from rhizome.agg_tasks import AggRefresh, IndicatorCalcGraph,\
+    CalculationCycleException, AggRefreshScheduler, \
+    get_campaign_ids_to_process, queue_datapoint_keys
 from rhizome.cache_meta import LocationTreeCache
 
 
@@ -273,6 +275,229 @@ class AggRefreshTestCase(TestCase):
         self.assertTrue(error_ocurred)
 
 
+    def test_incremental_refresh(self):
+        '''
+        After a full refresh, change one raw datapoint and run an incremental
+        refresh.  The changed value and the aggregate of its parent should be
+        updated, while the rows for keys that were not touched are left alone.
+
+        python manage.py test rhizome.tests.test_agg.AggRefreshTestCase.test_incremental_refresh --settings=rhizome.settings.test
+        '''
+
+        self.set_up()
+        self.create_raw_datapoints()
+
+        indicator_id, raw_location_id, agg_location_id, other_indicator_id = \
+            22, 12910, 12907, 55
+
+        AggRefresh(self.campaign_id)
+
+        untouched_adp = AggDataPoint.objects.get(
+            campaign_id = self.campaign_id,
+            indicator_id = other_indicator_id,
+            location_id = raw_location_id
+        )
+
+        changed_dp = DataPoint.objects.get(
+            indicator_id = indicator_id,
+            location_id = raw_location_id
+        )
+        old_agg_value = AggDataPoint.objects.get(
+            campaign_id = self.campaign_id,
+            indicator_id = indicator_id,
+            location_id = agg_location_id
+        ).value
+
+        new_value = changed_dp.value + 1000
+        DataPoint.objects.filter(id = changed_dp.id)\
+            .update(value = new_value, cache_job_id = -1)
+
+        ar = AggRefresh(self.campaign_id, incremental = True)
+
+        new_raw_value = DataPointComputed.objects.get(
+            campaign_id = self.campaign_id,
+            indicator_id = indicator_id,
+            location_id = raw_location_id
+        ).value
+
+        new_agg_value = AggDataPoint.objects.get(
+            campaign_id = self.campaign_id,
+            indicator_id = indicator_id,
+            location_id = agg_location_id
+        ).value
+
+        self.assertEqual(new_raw_value, new_value)
+        self.assertEqual(new_agg_value, old_agg_value + 1000)
+
+        ## the datapoint was marked when it was queued, and the queued keys
+        ## were consumed by the refresh ##
+        self.assertNotEqual(DataPoint.objects.get(id = changed_dp.id)\
+            .cache_job_id, -1)
+        self.assertEqual(0, AggRefreshQueue.objects.count())
+
+        ## a key that was not in scope was not rewritten ##
+        self.assertEqual(untouched_adp.id, AggDataPoint.objects.get(
+            campaign_id = self.campaign_id,
+            indicator_id = other_indicator_id,
+            location_id = raw_location_id
+        ).id)
+
+    def test_incremental_refresh_after_delete(self):
+        '''
+        Deleted datapoints are queued with queue_datapoint_keys, so an
+        incremental refresh removes the raw value and the aggregate that
+        was built from them.
+
+        python manage.py test rhizome.tests.test_agg.AggRefreshTestCase.test_incremental_refresh_after_delete --settings=rhizome.settings.test
+        '''
+
+        self.set_up()
+        self.create_raw_datapoints()
+
+        indicator_id, raw_location_id, agg_location_id = 55, 12910, 12907
+
+        AggRefresh(self.campaign_id)
+
+        adp_qs = AggDataPoint.objects.filter(campaign_id = self.campaign_id,\
+            indicator_id = indicator_id)
+        dwc_qs = DataPointComputed.objects.filter(campaign_id = \
+            self.campaign_id, indicator_id = indicator_id)
+
+        self.assertEqual(1, adp_qs.filter(location_id = agg_location_id)\
+            .count())
+
+        dp_qs = DataPoint.objects.filter(indicator_id = indicator_id)
+        queue_datapoint_keys(dp_qs)
+        dp_qs.delete()
+
+        self.assertEqual(get_campaign_ids_to_process(), [self.campaign_id])
+
+        ar = AggRefresh(self.campaign_id, incremental = True)
+
+        self.assertEqual(ar.response_msg, 'SUCCESS')
+        self.assertEqual(0, adp_qs.filter(location_id = agg_location_id)\
+            .count())
+        self.assertEqual(0, dwc_qs.filter(location_id = raw_location_id)\
+            .count())
+        self.assertEqual(0, AggRefreshQueue.objects.count())
+
+    def test_refresh_keeps_unchanged_rows(self):
+        '''
+        Refreshing a campaign twice merges the second result in to the first,
+        so the rows for keys that are still there are updated in place and
+        keep their ids, and a key that no longer has data is removed.
+
+        python manage.py test rhizome.tests.test_agg.AggRefreshTestCase.test_refresh_keeps_unchanged_rows --settings=rhizome.settings.test
+        '''
+
+        self.set_up()
+        self.create_raw_datapoints()
+
+        AggRefresh(self.campaign_id)
+
+        dwc_qs = DataPointComputed.objects.filter(campaign_id=self.campaign_id)
+        first_run = dict(((dwc.location_id, dwc.indicator_id), dwc.id) \
+            for dwc in dwc_qs)
+
+        removed_dp = DataPoint.objects.filter(indicator_id = 55)[0]
+        DataPoint.objects.filter(id = removed_dp.id).delete()
+
+        ar = AggRefresh(self.campaign_id)
+        second_run = dict(((dwc.location_id, dwc.indicator_id), dwc.id) \
+            for dwc in dwc_qs)
+
+        self.assertFalse((removed_dp.location_id, 55) in second_run)
+        for key, dwc_id in second_run.iteritems():
+            self.assertEqual(first_run[key], dwc_id)
+
+        self.assertEqual(dwc_qs.exclude(cache_job_id = ar.cache_job.id)\
+            .count(), 0)
+
+    def test_refresh_scheduler(self):
+        '''
+        The scheduler picks up every campaign with datapoints to process and
+        refreshes each one with its own cache job.  Campaigns without any new
+        data are left alone.
+
+        python manage.py test rhizome.tests.test_agg.AggRefreshTestCase.test_refresh_scheduler --settings=rhizome.settings.test
+        '''
+
+        self.set_up()
+        self.create_raw_datapoints()
+
+        campaign = Campaign.objects.get(id = self.campaign_id)
+        empty_campaign_id = Campaign.objects.create(
+            start_date = '2015-01-01',
+            end_date = '2015-01-02',
+            campaign_type_id = campaign.campaign_type_id,
+            top_lvl_location_id = campaign.top_lvl_location_id,
+            top_lvl_indicator_tag_id = campaign.top_lvl_indicator_tag_id,
+            office_id = campaign.office_id,
+        ).id
+
+        self.assertEqual(get_campaign_ids_to_process(), [self.campaign_id])
+
+        results = AggRefreshScheduler(processes = 1).main()
+        self.assertEqual(results, {self.campaign_id: 'SUCCESS'})
+
+        ## every datapoint was processed, so there is nothing left to do ##
+        self.assertEqual(get_campaign_ids_to_process(), [])
+        self.assertEqual(AggRefreshScheduler(processes = 1).main(), {})
+
+        self.assertEqual(DataPointComputed.objects\
+            .filter(campaign_id = empty_campaign_id).count(), 0)
+
+        ## a datapoint without a value does not start a refresh by itself ##
+        self.create_datapoint(12910, '2016-01-01', 22, None)
+        self.assertEqual(get_campaign_ids_to_process(), [])
+
+    def test_refresh_scheduler_overlapping_campaigns(self):
+        '''
+        Two campaigns with overlapping dates and the same top level location
+        share their datapoints.  A change to one of those datapoints is
+        queued for both of them, so both campaigns are refreshed with it,
+        and not only the first one to run.
+
+        python manage.py test rhizome.tests.test_agg.AggRefreshTestCase.test_refresh_scheduler_overlapping_campaigns --settings=rhizome.settings.test
+        '''
+
+        self.set_up()
+        self.create_raw_datapoints()
+
+        indicator_id, raw_location_id = 22, 12910
+
+        campaign = Campaign.objects.get(id = self.campaign_id)
+        overlapping_campaign_id = Campaign.objects.create(
+            start_date = '2015-12-31',
+            end_date = '2016-01-02',
+            campaign_type_id = campaign.campaign_type_id,
+            top_lvl_location_id = campaign.top_lvl_location_id,
+            top_lvl_indicator_tag_id = campaign.top_lvl_indicator_tag_id,
+            office_id = campaign.office_id,
+        ).id
+
+        campaign_ids = sorted([self.campaign_id, overlapping_campaign_id])
+
+        results = AggRefreshScheduler(processes = 1).main()
+        self.assertEqual(sorted(results.keys()), campaign_ids)
+
+        changed_dp = DataPoint.objects.get(indicator_id = indicator_id,\
+            location_id = raw_location_id)
+        new_value = changed_dp.value + 1000
+        DataPoint.objects.filter(id = changed_dp.id)\
+            .update(value = new_value, cache_job_id = -1)
+
+        results = AggRefreshScheduler(processes = 1).main()
+        self.assertEqual(results, dict([(c_id, 'SUCCESS') for c_id in \
+            campaign_ids]))
+
+        for campaign_id in campaign_ids:
+            self.assertEqual(new_value, DataPointComputed.objects.get(
+                campaign_id = campaign_id,
+                indicator_id = indicator_id,
+                location_id = raw_location_id
+            ).value)
+
     def test_raw_data_to_computed(self):
         '''
         This just makes sure that any data in the datapoint table, gets into the
@@ -545,7 +770,7 @@ class AggRefreshTestCase(TestCase):
         target_value = (x-y) / x
         self.assertEqual(round(calc_value,4),round(target_value,4))
 
-    def _recursive_sum(self):
+    def test_recursive_sum(self):
         '''
         Consider the case in which we have "number of missed children" which is
         the sum of "missed children due to absence", "missed children due to
@@ -557,6 +782,10 @@ class AggRefreshTestCase(TestCase):
         http://rhizome.work/manage_system/manage/indicator/264).
 
         There are two levels here and this test aims to cover this use case.
+        On top of that, a percentage uses the recursive sum as its
+        denominator, so the three levels have to be calculated in order.
+
+        python manage.py test rhizome.tests.test_agg.AggRefreshTestCase.test_recursive_sum --settings=rhizome.settings.test
         '''
 
         self.set_up()
@@ -681,6 +910,23 @@ class AggRefreshTestCase(TestCase):
         )
 
 
+        ## 3rd layer, a percentage of the top level sum ##
+        pct_indicator = Indicator.objects.create(
+            name = 'pct of Deaths due to Hunger',
+            short_name = 'pct of Deaths due to Hunger',
+            data_format = 'pct'
+        )
+        CalculatedIndicatorComponent.objects.create(
+            indicator_id = pct_indicator.id,
+            indicator_component_id = sub_indicator_3.id,
+            calculation = 'NUMERATOR'
+        )
+        CalculatedIndicatorComponent.objects.create(
+            indicator_id = pct_indicator.id,
+            indicator_component_id = parent_indicator.id,
+            calculation = 'DENOMINATOR'
+        )
+
         ## create all the datapoints ##
 
         values_to_insert = {
@@ -698,11 +944,19 @@ class AggRefreshTestCase(TestCase):
 
         ar = AggRefresh(self.campaign_id)
 
-        parent_indicator_target_value = sum(values_to_insert.values())
+        ## sub_indicator_1 is the sum of its three parts, but sub_indicator_2
+        ## has a stored value, which is used instead of the sum of its parts ##
+        sub_1_target_val = values_to_insert[sub_sub_indicator_1.id] + \
+            values_to_insert[sub_sub_indicator_2.id] + \
+            values_to_insert[sub_sub_indicator_3.id]
+
+        parent_indicator_target_value = sub_1_target_val + \
+            values_to_insert[sub_indicator_2.id] + \
+            values_to_insert[sub_indicator_3.id]
         parent_indicator_1_actual_value = DataPointComputed.objects.get(
             location_id = location_id,
-            data_date = data_date,
-            indicator_id = parent_indicator,
+            campaign_id = self.campaign_id,
+            indicator_id = parent_indicator.id,
         ).value
 
         self.assertEqual(parent_indicator_1_actual_value,\
@@ -713,8 +967,38 @@ class AggRefreshTestCase(TestCase):
         sub_2_target_val = values_to_insert[sub_indicator_2.id]
         sub_2_actual_val = DataPointComputed.objects.get(
             location_id = location_id,
-            data_date = data_date,
+            campaign_id = self.campaign_id,
             indicator_id = sub_indicator_2.id,
         ).value
 
         self.assertEqual(sub_2_target_val,sub_2_actual_val)
+
+        ## the percentage is calculated from the recursive sum ##
+        pct_target_val = values_to_insert[sub_indicator_3.id] / \
+            float(parent_indicator_target_value)
+        pct_actual_val = DataPointComputed.objects.get(
+            location_id = location_id,
+            campaign_id = self.campaign_id,
+            indicator_id = pct_indicator.id,
+        ).value
+
+        self.assertEqual(pct_target_val,pct_actual_val)
+
+    def test_calculation_cycle(self):
+        '''
+        An indicator that is ( indirectly ) calculated from itself can not be
+        evaluated, so building the calculation graph raises an exception.
+        '''
+
+        edge_list = [
+            (1, 2, 'PART_TO_BE_SUMMED'),
+            (2, 3, 'PART_TO_BE_SUMMED'),
+            (3, 1, 'NUMERATOR'),
+            (4, 5, 'PART_TO_BE_SUMMED'),
+        ]
+
+        with self.assertRaises(CalculationCycleException):
+            IndicatorCalcGraph(edge_list)
+
+        graph = IndicatorCalcGraph(edge_list[1:])
+        self.assertEqual(graph.levels, [[3, 4], [2]])
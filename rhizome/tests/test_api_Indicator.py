@@ -225,3 +225,44 @@ class IndicatorResourceTest(ResourceTestCase):
             ,sorted(objects[0]['tag_json']))
         self.assertEqual(sorted(target_bound_json)\
             ,sorted(objects[0]['bound_json']))
+
+    def test_indicator_keyset_pagination(self):
+
+        for i in range(3):
+            Indicator.objects.create(short_name='Page %s' % i, \
+                                     name='Page Indicator %s' % i, \
+                                     data_format='int')
+
+        indicator_ids = list(Indicator.objects.all().order_by('id')\
+            .values_list('id', flat=True))
+
+        resp = self.api_client.get('/api/v1/indicator/', format='json'\
+            , data={'limit': 2}, authentication=self.get_credentials())
+
+        ## json pages are streamed ##
+        data = json.loads(''.join(resp.streaming_content))
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(indicator_ids[:2], \
+            [obj['id'] for obj in data['objects']])
+        self.assertEqual(indicator_ids[1], data['meta']['next_cursor'])
+        self.assertEqual(len(indicator_ids), data['meta']['total_count'])
+
+        resp = self.api_client.get('/api/v1/indicator/', format='json'\
+            , data={'limit': 2, 'cursor': data['meta']['next_cursor']}\
+            , authentication=self.get_credentials())
+
+        data = json.loads(''.join(resp.streaming_content))
+
+        self.assertEqual(indicator_ids[2:], \
+            [obj['id'] for obj in data['objects']])
+        self.assertEqual(None, data['meta']['next_cursor'])
+
+        ## limit=0 turns pagination off ##
+        resp = self.api_client.get('/api/v1/indicator/', format='json'\
+            , data={'limit': 0}, authentication=self.get_credentials())
+
+        data = self.deserialize(resp)
+
+        self.assertEqual(indicator_ids,\
+            sorted([obj['id'] for obj in data['objects']]))
@@ -1,8 +1,13 @@
 from tastypie.test import ResourceTestCase
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test.utils import override_settings
 from rhizome.models import Office, LocationType, Location, \
     LocationPermission, Campaign, CampaignType, IndicatorTag
 from rhizome.cache_meta import LocationTreeCache
+from rhizome.api.custom_cache import bump_data_version
+from rhizome.api.permission_context import get_permission_context,\
+    clear_permission_context
 
 
 class CampaignResourceTest(ResourceTestCase):
@@ -83,3 +88,71 @@ class CampaignResourceTest(ResourceTestCase):
         response_data = self.deserialize(resp)
 
         self.assertEqual(len(response_data['objects']), 1)
+
+    @override_settings(API_RESPONSE_CACHE_SECONDS = 60)
+    def test_get_campaign_cached(self):
+        '''
+        The response is served from the cache until the data version is
+        bumped, and a request with the ETag of the cached response gets a 304.
+        '''
+
+        caches['default'].clear()
+
+        resp = self.api_client.get('/api/v1/campaign/', format='json', \
+                                    authentication=self.get_credentials())
+        self.assertHttpOK(resp)
+        etag = resp['ETag']
+
+        Campaign.objects.create(
+            start_date = '2016-03-01',
+            end_date = '2016-03-01',
+            office_id = self.o.id,
+            campaign_type_id = self.ct.id,
+            top_lvl_location_id = self.top_lvl_location.id,
+            top_lvl_indicator_tag_id = self.it.id
+        )
+
+        ## the new campaign is not in the cached response ##
+        resp = self.api_client.get('/api/v1/campaign/', format='json', \
+                                    authentication=self.get_credentials())
+        self.assertEqual(len(self.deserialize(resp)['objects']), 1)
+        self.assertEqual(etag, resp['ETag'])
+
+        resp = self.api_client.get('/api/v1/campaign/', format='json', \
+            authentication=self.get_credentials(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        bump_data_version()
+
+        resp = self.api_client.get('/api/v1/campaign/', format='json', \
+                                    authentication=self.get_credentials())
+        self.assertEqual(len(self.deserialize(resp)['objects']), 2)
+        self.assertNotEqual(etag, resp['ETag'])
+
+    def test_permission_context(self):
+        '''
+        The permission context of a user is cached until it is cleared, which
+        happens when their LocationPermission is changed through the api.
+        '''
+
+        clear_permission_context(self.user.id)
+
+        permission_context = get_permission_context(self.user.id)
+        self.assertEqual(self.top_lvl_location.id,\
+            permission_context['top_lvl_location_id'])
+        self.assertEqual(sorted([self.top_lvl_location.id,\
+            self.sub_location.id]), sorted(permission_context['location_ids']))
+
+        LocationPermission.objects.filter(user_id = self.user.id)\
+            .update(top_lvl_location = self.not_allowed_to_see_location)
+
+        self.assertEqual(self.top_lvl_location.id,\
+            get_permission_context(self.user.id)['top_lvl_location_id'])
+
+        clear_permission_context(self.user.id)
+
+        permission_context = get_permission_context(self.user.id)
+        self.assertEqual(self.not_allowed_to_see_location.id,\
+            permission_context['top_lvl_location_id'])
+        self.assertEqual([self.not_allowed_to_see_location.id],\
+            permission_context['location_ids'])
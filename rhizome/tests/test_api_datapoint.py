@@ -4,9 +4,12 @@ from tastypie.models import ApiKey
 from django.contrib.auth.models import User
 from rhizome.models import CacheJob, Office, Indicator, Location,\
     LocationType, DataPointComputed, CampaignType, Campaign, IndicatorTag,\
-    LocationPermission, Document
+    LocationPermission, Document, DataPointAbstracted,\
+    DataPointAbstractedCampaign
 
 from rhizome.cache_meta import LocationTreeCache
+from rhizome.agg_tasks import refresh_datapoint_abstracted
+from rhizome.api.resources.datapoint import ResultObjectList
 
 class DataPointResourceTest(ResourceTestCase):
     def setUp(self):
@@ -43,7 +46,7 @@ class DataPointResourceTest(ResourceTestCase):
                                               password=self.password)
         return result
 
-    def test_get_list(self):
+    def create_computed_datapoint(self):
         # Create the data, need input value to the DataPointComputed model.
         # 1. The CacheJob value
         cache_job = CacheJob.objects.create(
@@ -80,6 +83,14 @@ class DataPointResourceTest(ResourceTestCase):
             cache_job=cache_job,indicator=indicator, location=location,\
             campaign=campaign, document=document)
 
+        return indicator, campaign, datapoint
+
+    def test_get_list(self):
+
+        indicator, campaign, datapoint = self.create_computed_datapoint()
+        location, value = self.top_lvl_location, datapoint.value
+        start_date, end_date = '2016-01-01', '2016-01-01'
+
         # 6 Request To The API
         get_parameter = 'indicator__in={0}&campaign_start={1}&campaign_end={2}&parent_location_id__in={3}'\
             .format(indicator.id, start_date,end_date, location.id)
@@ -101,3 +112,147 @@ class DataPointResourceTest(ResourceTestCase):
         self.assertEqual(len(response_data['objects'][0]['indicators']), 1)
         self.assertEqual(int(response_data['objects'][0]['indicators'][0]['indicator']), indicator.id)
         self.assertEqual(response_data['objects'][0]['indicators'][0]['value'], value)
+
+    def test_get_list_from_abstracted(self):
+        '''
+        Once the campaign is in the datapoint_abstracted table, the response
+        is read from there and not pivoted from datapoint_with_computed.
+        '''
+
+        indicator, campaign, datapoint = self.create_computed_datapoint()
+        location = self.top_lvl_location
+
+        refresh_datapoint_abstracted(campaign.id)
+
+        ## the stored row is what the API returns ##
+        DataPointComputed.objects.filter(id = datapoint.id).delete()
+
+        get_parameter = 'indicator__in={0}&campaign__in={1}&location_id__in={2}'\
+            .format(indicator.id, campaign.id, location.id)
+
+        resp = self.api_client.get('/api/v1/datapoint/?' + get_parameter, \
+            format='json', authentication=self.get_credentials())
+
+        self.assertHttpOK(resp)
+        response_data = self.deserialize(resp)
+
+        self.assertEqual(len(response_data['objects']), 1)
+        indicator_data = response_data['objects'][0]['indicators'][0]
+
+        self.assertEqual(int(indicator_data['indicator']), indicator.id)
+        self.assertEqual(indicator_data['value'], datapoint.value)
+        self.assertEqual(indicator_data['computed'], datapoint.id)
+
+    def test_partial_refresh_builds_campaign(self):
+        '''
+        Refreshing some locations of a campaign that has not been built yet
+        builds every location, so that the endpoint does not lose the rows
+        of the locations that were not refreshed.
+        '''
+
+        indicator, campaign, datapoint = self.create_computed_datapoint()
+        location = self.top_lvl_location
+
+        refresh_datapoint_abstracted(campaign.id, [])
+
+        self.assertTrue(DataPointAbstractedCampaign.objects\
+            .filter(campaign_id = campaign.id).exists())
+        self.assertEqual(list(DataPointAbstracted.objects\
+            .filter(campaign_id = campaign.id)\
+            .values_list('location_id', flat=True)), [location.id])
+
+        ## once built, only the locations asked for are refreshed ##
+        DataPointComputed.objects.filter(id = datapoint.id).delete()
+        refresh_datapoint_abstracted(campaign.id, [])
+
+        get_parameter = 'indicator__in={0}&campaign__in={1}&location_id__in={2}'\
+            .format(indicator.id, campaign.id, location.id)
+
+        resp = self.api_client.get('/api/v1/datapoint/?' + get_parameter, \
+            format='json', authentication=self.get_credentials())
+
+        self.assertHttpOK(resp)
+        response_data = self.deserialize(resp)
+
+        self.assertEqual(len(response_data['objects']), 1)
+        self.assertEqual(response_data['objects'][0]['indicators'][0]\
+            ['computed'], datapoint.id)
+
+    def test_result_object_list(self):
+        '''
+        Every requested indicator is in the result, with the value and id of
+        the ones that have data and None for the others.
+        '''
+
+        row_data = {(2, 1): {}, (1, 1): {5: (1.5, 10), 7: (0.0, 11)}}
+        result_list = ResultObjectList(row_data, [7, 6, 5, 6])
+
+        self.assertEqual(len(result_list), 2)
+
+        r = result_list[0:1][0]
+        self.assertEqual((r.location, r.campaign), (1, 1))
+        self.assertEqual(r.indicators, [
+            {'indicator': u'5', 'computed': 10, 'value': 1.5},
+            {'indicator': u'7', 'computed': 11, 'value': 0.0},
+            {'indicator': 6, 'value': None, 'computed_id': None},
+        ])
+
+        self.assertEqual([i['value'] for i in result_list[1].indicators],\
+            [None, None, None])
+
+    def test_get_csv(self):
+        '''
+        The csv download is streamed, with a row for each location and
+        campaign and a column for each indicator.
+        '''
+
+        indicator, campaign, datapoint = self.create_computed_datapoint()
+        location = self.top_lvl_location
+
+        get_parameter = 'indicator__in={0}&campaign__in={1}&location_id__in={2}&format=csv'\
+            .format(indicator.id, campaign.id, location.id)
+
+        resp = self.api_client.get('/api/v1/datapoint/?' + get_parameter, \
+            format='json', authentication=self.get_credentials())
+
+        self.assertHttpOK(resp)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp['Content-Disposition'],\
+            'attachment; filename=polio_data.csv')
+
+        csv_lines = ''.join(resp.streaming_content).splitlines()
+
+        self.assertEqual(csv_lines, [
+            'campaign,location,%s' % indicator.name,
+            '%s,%s,%s' % (campaign.name, location.name, repr(datapoint.value)),
+        ])
+
+    def test_get_csv_no_data(self):
+        '''
+        With no data for the campaign there is an empty row for the location,
+        and without indicator__in the response is a bad request.
+        '''
+
+        indicator, campaign, datapoint = self.create_computed_datapoint()
+        location = self.top_lvl_location
+        DataPointComputed.objects.filter(id=datapoint.id).delete()
+
+        get_parameter = 'indicator__in={0}&campaign__in={1}&location_id__in={2}&format=csv'\
+            .format(indicator.id, campaign.id, location.id)
+
+        resp = self.api_client.get('/api/v1/datapoint/?' + get_parameter, \
+            format='json', authentication=self.get_credentials())
+
+        self.assertHttpOK(resp)
+        self.assertEqual(''.join(resp.streaming_content).splitlines(), [
+            'campaign,location,%s' % indicator.name,
+            '%s,%s,' % (campaign.name, location.name),
+        ])
+
+        resp = self.api_client.get('/api/v1/datapoint/?campaign__in={0}&format=csv'\
+            .format(campaign.id), format='json',\
+            authentication=self.get_credentials())
+
+        self.assertHttpBadRequest(resp)
+        self.assertEqual(resp.content,\
+            "'indicator__in' is a required parameter!")
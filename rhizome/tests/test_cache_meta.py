@@ -5,8 +5,9 @@ from numpy import nan,isnan
 from django.test import TestCase
 
 from rhizome.models import LocationType, Location, LocationTree, Office,\
-    Indicator, IndicatorBound, IndicatorToTag, IndicatorTag
-from rhizome.cache_meta import LocationTreeCache
+    Indicator, IndicatorBound, IndicatorToTag, IndicatorTag, DataVersion
+from rhizome.cache_meta import LocationTreeCache, LocationTreeIndex,\
+    cache_all_meta
 
 class CacheMetaTestCase(TestCase):
     '''
@@ -97,3 +98,169 @@ class CacheMetaTestCase(TestCase):
         self.assertTrue((8,3) in location_tree_in_db)
         self.assertTrue((8,2) in location_tree_in_db)
         self.assertTrue((8,1) in location_tree_in_db)
+
+        ## lvl is the depth of the location, starting from 0 at the top ##
+        lvl_in_db = dict(((l_id, p_id), lvl) for l_id, p_id, lvl in \
+            LocationTree.objects.values_list('location_id',\
+                'parent_location_id', 'lvl'))
+
+        self.assertEqual(lvl_in_db[(1,1)], 0)
+        self.assertEqual(lvl_in_db[(2,1)], 1)
+        self.assertEqual(lvl_in_db[(7,6)], 2)
+        self.assertEqual(lvl_in_db[(8,1)], 3)
+        self.assertEqual(len(lvl_in_db), 12)
+
+    def test_location_tree_index(self):
+        '''
+        The in memory index should return the same relationships as the
+        LocationTree table, without querying it.
+
+        python manage.py test rhizome.tests.test_cache_meta.CacheMetaTestCase.test_location_tree_index --settings=rhizome.settings.test
+        '''
+
+        ## same tree as above: U.S.A. -> NY State -> NYC -> Brooklyn, etc. ##
+        location_list = [(1,None),(2,1),(3,2),(4,1),(5,1),(6,1),(7,6),(8,3)]
+        lti = LocationTreeIndex(location_list)
+
+        ## U.S.A. is in its own tree, NY State is not ##
+        self.assertEqual(lti.get_descendant_ids([1]), range(1,9))
+        self.assertEqual(lti.get_descendant_ids([2]), [3,8])
+        self.assertEqual(lti.get_descendant_ids([2,6]), [3,7,8])
+        self.assertEqual(lti.get_descendant_ids([8]), [])
+
+        self.assertTrue(lti.is_ancestor(1,8))
+        self.assertTrue(lti.is_ancestor(2,8))
+        self.assertFalse(lti.is_ancestor(6,8))
+        self.assertFalse(lti.is_ancestor(8,8))
+
+        ## Brooklkyn has, NYC, NYState and USA as parents ##
+        self.assertEqual(lti.get_ancestor_ids([8]), set([1,2,3]))
+
+        ancestor_df = lti.get_ancestor_df([1,7])
+        self.assertEqual(sorted(ancestor_df[['location_id',\
+            'parent_location_id','lvl']].values.tolist()),\
+            [[1,1,0],[7,1,2],[7,6,2]])
+
+    def test_location_tree_index_mask(self):
+        '''
+        The descendants can be filtered by location type and lpd status
+        without going back to the location table.
+        '''
+
+        location_list = [(1,None),(2,1),(3,2),(4,1),(5,1),(6,1),(7,6),(8,3)]
+        location_attributes = {
+            1: (1, 'Country', None),
+            2: (2, 'Province', None),
+            3: (3, 'District', 1),
+            4: (2, 'Province', None),
+            5: (3, 'District', None),
+            6: (3, 'District', 2),
+            7: (4, 'Settlement', 1),
+            8: (4, 'Settlement', None),
+        }
+        lti = LocationTreeIndex(location_list, location_attributes)
+
+        lpd_district_mask = lti.get_mask(location_type_ids = [3],\
+            lpd_statuses = [1,2])
+        self.assertEqual(lti.get_descendant_ids([1],\
+            mask = lpd_district_mask), [3,6])
+        self.assertEqual(lti.get_descendant_ids([2],\
+            mask = lpd_district_mask), [3])
+
+        prov_country_and_district_mask = lti.get_mask(\
+            location_type_names = ['Province','Country']) | \
+            lti.get_mask(lpd_statuses = [1,2])
+        self.assertEqual(lti.get_descendant_ids([1],\
+            mask = prov_country_and_district_mask), [1,2,3,4,6,7])
+
+        ## limited to what a user with a top_lvl_location_id of 2 can see ##
+        self.assertEqual(lti.get_descendant_ids([1],\
+            mask = prov_country_and_district_mask & lti.get_tree_mask(2)),\
+            [2,3])
+
+    def test_location_tree_index_version(self):
+        '''
+        The cached index is rebuilt when a location is saved, and when the
+        LocationTreeCache runs after a change made with .update(), which
+        does not go through Location.save.
+        '''
+
+        office = Office.objects.create(name='not important')
+        country = LocationType.objects.create(name='Country', admin_level=0)
+        state = LocationType.objects.create(name='State', admin_level=1)
+
+        usa = Location.objects.create(name='U.S.A.', location_code='USA',\
+            office_id=office.id, location_type_id=country.id)
+        canada = Location.objects.create(name='Canada', location_code='CAN',\
+            office_id=office.id, location_type_id=country.id)
+        maine = Location.objects.create(name='Maine', location_code='ME',\
+            office_id=office.id, location_type_id=state.id,\
+            parent_location_id=usa.id)
+
+        self.assertEqual(LocationTreeIndex.get_index()\
+            .get_descendant_ids([usa.id]), sorted([usa.id, maine.id]))
+
+        Location.objects.filter(id=maine.id)\
+            .update(parent_location_id=canada.id)
+        LocationTreeCache().main()
+
+        lti = LocationTreeIndex.get_index()
+        self.assertEqual(lti.get_descendant_ids([usa.id]), [usa.id])
+        self.assertEqual(lti.get_descendant_ids([canada.id]),\
+            sorted([canada.id, maine.id]))
+
+        ## the mask sees the new location type after a save ##
+        maine.location_type_id = country.id
+        maine.save()
+
+        lti = LocationTreeIndex.get_index()
+        self.assertEqual(lti.get_descendant_ids([canada.id],\
+            mask = lti.get_mask(location_type_ids = [state.id])), [])
+
+    def test_location_tree_cache_no_change(self):
+        '''
+        Running the LocationTreeCache again without any location changing
+        does not re-write the table or bump the LOCATION_TREE version.
+        '''
+
+        office = Office.objects.create(name='not important')
+        country = LocationType.objects.create(name='Country', admin_level=0)
+
+        Location.objects.create(name='U.S.A.', location_code='USA',\
+            office_id=office.id, location_type_id=country.id)
+
+        self.assertTrue(LocationTreeCache().main())
+        version = DataVersion.get_version(DataVersion.LOCATION_TREE)
+
+        self.assertFalse(LocationTreeCache().main())
+        self.assertEqual(version,\
+            DataVersion.get_version(DataVersion.LOCATION_TREE))
+
+    def test_cache_all_meta_no_change(self):
+        '''
+        The data version is bumped when one of the meta caches changes, and
+        left alone when cache_all_meta runs again with nothing to change, so
+        that the cached api responses stay valid.
+        '''
+
+        office = Office.objects.create(name='not important')
+        country = LocationType.objects.create(name='Country', admin_level=0)
+
+        Location.objects.create(name='U.S.A.', location_code='USA',\
+            office_id=office.id, location_type_id=country.id)
+
+        ind = Indicator.objects.create(name='test name',\
+            short_name='test short name', data_format='int',\
+            description='test description')
+        ind_tag = IndicatorTag.objects.create(tag_name='tag1')
+        IndicatorToTag.objects.create(indicator=ind, indicator_tag=ind_tag)
+        IndicatorBound.objects.create(indicator_id=ind.id, mn_val=10,\
+            mx_val=None, bound_name='Good')
+
+        version = DataVersion.get_version()
+        cache_all_meta()
+        self.assertNotEqual(version, DataVersion.get_version())
+
+        version = DataVersion.get_version()
+        cache_all_meta()
+        self.assertEqual(version, DataVersion.get_version())
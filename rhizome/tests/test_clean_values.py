@@ -0,0 +1,30 @@
+import numpy as np
+from django.test import TestCase
+
+from rhizome.etl_tasks.clean_values import clean_values
+
+class CleanValuesTestCase(TestCase):
+
+    def __init__(self, *args, **kwargs):
+
+        super(CleanValuesTestCase, self).__init__(*args, **kwargs)
+
+    def test_clean_values(self):
+
+        raw_values = ['100,000', ' 12.5 ', '-3', 'Yes', 'no', 7, None,
+            '', 'n/a', '1,00', {'a': 1}]
+
+        values, rejected = clean_values(raw_values)
+
+        self.assertEqual([100000.0, 12.5, -3.0, 1.0, 0.0, 7.0],\
+            values[:6].tolist())
+        self.assertTrue(np.isnan(values[6:]).all())
+
+        self.assertEqual([False] * 7 + [True] * 4, rejected.tolist())
+
+    def test_clean_no_values(self):
+
+        values, rejected = clean_values([])
+
+        self.assertEqual(0, len(values))
+        self.assertEqual(0, len(rejected))
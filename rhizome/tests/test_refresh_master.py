@@ -5,7 +5,8 @@ from django.contrib.auth.models import User
 from pandas import read_csv, notnull, to_datetime
 
 from rhizome.etl_tasks.transform_upload import ComplexDocTransform
-from rhizome.etl_tasks.refresh_master import MasterRefresh
+from rhizome.etl_tasks.refresh_master import MasterRefresh,\
+    MasterRefreshScheduler
 from rhizome.models import *
 
 class RefreshMasterTestCase(TestCase):
@@ -209,6 +210,104 @@ class RefreshMasterTestCase(TestCase):
         self.assertEqual(1,len(dp_result))
         self.assertEqual(good_val, dp_result[0].value)
 
+        ## syncing the old submission again does not override the new data
+        ## and syncing the new one again replaces, and does not duplicate it
+        mr.sync_datapoint([ss_old.id])
+        mr.sync_datapoint([ss_new.id])
+
+        self.assertEqual(1,len(dp_result.all()))
+        self.assertEqual(good_val, dp_result.all()[0].value)
+
+    def test_latest_data_in_campaign_gets_synced(self):
+        '''
+        Two values for the same location and indicator in one campaign are
+        counted together by the aggregation, so a newer upload replaces the
+        older value even if the data_date within the campaign is different.
+
+        python manage.py test rhizome.tests.test_refresh_master\
+        .RefreshMasterTestCase.test_latest_data_in_campaign_gets_synced \
+        --settings=rhizome.settings.test
+        '''
+
+        self.set_up()
+
+        location_obj = Location.objects.all()[0]
+        test_ind_id = Indicator.objects.all()[0].id
+
+        Campaign.objects.create(
+            start_date = '2017-06-01',
+            end_date = '2017-06-30',
+            name = 'june_campaign',
+            top_lvl_location = location_obj,
+            top_lvl_indicator_tag = IndicatorTag.objects.all()[0],
+            office_id = location_obj.office_id,
+            campaign_type = CampaignType.objects.all()[0]
+        )
+
+        ss_old = SourceSubmission.objects\
+            .filter(document_id = self.document.id)[0]
+        ss_new = SourceSubmission.objects.create(
+            document_id = self.document.id,
+            instance_guid = 'in_campaign',
+            row_number = 1,
+            data_date = '2017-06-20',
+            location_code = 'IN_CAMPAIGN',
+            location_display = 'IN_CAMPAIGN',
+            submission_json = '',
+            process_status = 1
+        )
+
+        for ss_id, data_date, value in [(ss_old.id, '2017-06-02', 10),\
+            (ss_new.id, '2017-06-20', 20)]:
+
+            DocDataPoint.objects.create(
+                document_id = self.document.id,
+                indicator_id = test_ind_id,
+                location_id = location_obj.id,
+                data_date = data_date,
+                value = value,
+                source_submission_id = ss_id,
+                agg_on_location = True,
+            )
+
+        mr = MasterRefresh(self.user.id, self.document.id)
+        mr.sync_datapoint([ss_old.id])
+        mr.sync_datapoint([ss_new.id])
+
+        dp_result = DataPoint.objects.filter(location_id = location_obj.id,
+            indicator_id = test_ind_id)
+
+        self.assertEqual(1, len(dp_result))
+        self.assertEqual(20, dp_result[0].value)
+
+        ## re-syncing the older submission does not bring its value back ##
+        mr.sync_datapoint([ss_old.id])
+
+        self.assertEqual([20], [dp.value for dp in dp_result.all()])
+
+    def test_refresh_scheduler(self):
+        '''
+        The scheduler keeps running batches until every submission with a
+        mapped location is processed, whatever the batch size.
+        '''
+
+        self.set_up()
+
+        SourceObjectMap.objects.filter(content_type = 'location')\
+            .update(master_object_id = Location.objects.all()[0].id)
+        SourceObjectMap.objects.filter(content_type = 'indicator')\
+            .update(master_object_id = Indicator.objects.all()[0].id)
+
+        ss_count = SourceSubmission.objects.filter(document_id = \
+            self.document.id, process_status = 'TO_PROCESS').count()
+
+        results = MasterRefreshScheduler(self.user.id, batch_size = 1,\
+            max_batch_size = 2).main()
+
+        self.assertEqual(ss_count, results[self.document.id])
+        self.assertEqual(0, SourceSubmission.objects.filter(document_id = \
+            self.document.id, process_status = 'TO_PROCESS').count())
+
     def test_submission_to_datapoint(self):
         '''
         This simulates the following use case:
@@ -281,6 +380,8 @@ class RefreshMasterTestCase(TestCase):
 
         ## Test Case 2 ##
         self.assertEqual(first_submission_detail.get_location_id(), map_location_id)
+        self.assertEqual(mr_with_new_meta.get_master_object_id('location',\
+            location_code), map_location_id)
 
         ## now that we have created the mappign, "refresh_master" ##
         ##         should create the relevant datapoints          ##
@@ -292,6 +393,14 @@ class RefreshMasterTestCase(TestCase):
         ## Test Case #3
         self.assertEqual(1,len(doc_dp_ids))
 
+        ## re-running with the smallest chunks replaces the doc datapoints ##
+        ## for the batch rather than adding to them ##
+        doc_dp_count = DocDataPoint.objects.count()
+        mr_with_new_meta.ss_chunk_size = 1
+        mr_with_new_meta.doc_dp_chunk_size = 1
+        mr_with_new_meta.submissions_to_doc_datapoints()
+        self.assertEqual(doc_dp_count, DocDataPoint.objects.count())
+
         mr_with_new_meta.sync_datapoint()
         dps = DataPoint.objects.all()
 
@@ -0,0 +1,29 @@
+import json
+
+from django.test import TestCase
+
+from rhizome.api.serialize import RawJSON, dumps_json
+
+class DumpsJsonTestCase(TestCase):
+
+    def __init__(self, *args, **kwargs):
+
+        super(DumpsJsonTestCase, self).__init__(*args, **kwargs)
+
+    def test_raw_json_passthrough(self):
+
+        data = {'id': 1, 'bound_json': RawJSON('[{"mn_val": 0.5}]'),
+            'tag_json': RawJSON('[]')}
+
+        json_str = dumps_json(data)
+
+        self.assertIn('[{"mn_val": 0.5}]', json_str)
+        self.assertEqual({'id': 1, 'bound_json': [{'mn_val': 0.5}],
+            'tag_json': []}, json.loads(json_str))
+
+    def test_nan_fallback(self):
+
+        data = {'value': float('nan'), 'tag_json': RawJSON('[1, 2]')}
+
+        self.assertEqual({'value': None, 'tag_json': [1, 2]},\
+            json.loads(dumps_json(data)))
@@ -1,7 +1,7 @@
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.conf import settings
-from pandas import read_csv, notnull, to_datetime
+from pandas import read_csv, notnull, to_datetime, DataFrame
 
 from rhizome.etl_tasks.simple_upload_transform import SimpleDocTransform
 from rhizome.models import *
@@ -50,6 +50,91 @@ class TransformUploadTestCase(TestCase):
             self.assertEqual(cell_val_from_file, the_value_from_the_database)
 
 
+    def test_csv_df_to_dwc_df(self):
+        '''
+        yes / no cells and numbers with thousands separators are stored as
+        numbers.  Blank and unreadable cells, and the rows whose location is
+        not mapped, are left out.
+
+        python manage.py test rhizome.tests.test_simple_transform_upload\
+        .TransformUploadTestCase.test_csv_df_to_dwc_df \
+        --settings=rhizome.settings.test
+        '''
+
+        second_location_id = Location.objects\
+            .exclude(id = self.mapped_location_id)[0].id
+        SourceObjectMap.objects.create(
+            source_object_code = 'AF001039006000000000',
+            content_type = 'location',
+            mapped_by_id = self.user_id,
+            master_object_id = second_location_id
+        )
+
+        sdt = SimpleDocTransform(self.user.id,\
+            self.create_document('eoc_post_campaign.csv').id)
+
+        ind_columns = ['Percent missed due to other reasons',\
+            'Percent missed children_PCA', 'Percent missed due to not visited']
+        sdt.csv_df = DataFrame([
+            ['AF001039003000000000', '2016 March NID OPV', 'yes', '1,000', None],
+            ['AF001039006000000000', '2016 March NID OPV', 'No', '', 'n/a'],
+            ['NOT_MAPPED', '2016 March NID OPV', '1', '2', '3'],
+        ], columns = [sdt.location_column, sdt.campaign_column] + ind_columns)
+
+        dwc_df = sdt.csv_df_to_dwc_df()
+
+        self.assertEqual(sdt.dwc_columns, list(dwc_df.columns))
+        self.assertEqual(set([self.mapped_campaign_id]),\
+            set(dwc_df['campaign_id']))
+
+        dwc_values = dict(((location_id, indicator_id), value) for \
+            location_id, indicator_id, value in zip(dwc_df['location_id'],\
+                dwc_df['indicator_id'], dwc_df['value']))
+        self.assertEqual({
+            (self.mapped_location_id, self.mapped_indicator_with_data): 1.0,
+            (self.mapped_location_id, self.mapped_indicator_id_0): 1000.0,
+            (second_location_id, self.mapped_indicator_with_data): 0.0,
+        }, dwc_values)
+
+    def test_reupload_overwrites_computed(self):
+        '''
+        A value in the file replaces the one stored for the same location,
+        campaign and indicator, keeping its id, and the pivoted row that the
+        datapoint endpoint reads is refreshed along with it.
+
+        python manage.py test rhizome.tests.test_simple_transform_upload\
+        .TransformUploadTestCase.test_reupload_overwrites_computed \
+        --settings=rhizome.settings.test
+        '''
+
+        old_document = self.create_document('old_upload.csv')
+        existing_dwc = DataPointComputed.objects.create(
+            location_id = self.mapped_location_id,
+            campaign_id = self.mapped_campaign_id,
+            indicator_id = self.mapped_indicator_with_data,
+            document_id = old_document.id,
+            value = 99.0
+        )
+
+        self.ingest_file('eoc_post_campaign.csv')
+
+        dwc_qs = DataPointComputed.objects.filter(
+            location_id = self.mapped_location_id,
+            campaign_id = self.mapped_campaign_id,
+            indicator_id = self.mapped_indicator_with_data
+        )
+        self.assertEqual([(existing_dwc.id, 0.082670906)],\
+            list(dwc_qs.values_list('id', 'value')))
+
+        abstracted = DataPointAbstracted.objects.get(
+            location_id = self.mapped_location_id,
+            campaign_id = self.mapped_campaign_id
+        )
+        self.assertEqual([0.082670906, existing_dwc.id], \
+            abstracted.indicator_json[str(self.mapped_indicator_with_data)])
+        self.assertTrue(DataPointAbstractedCampaign.objects\
+            .filter(campaign_id = self.mapped_campaign_id).exists())
+
     def create_metadata(self):
         '''
         Creating the Indicator, location, Campaign, meta data needed for the
@@ -134,6 +219,12 @@ class TransformUploadTestCase(TestCase):
         return meta_ids
 
     def ingest_file(self, file_name):
+
+        document = self.create_document(file_name)
+        sdt = SimpleDocTransform(self.user.id, document.id)
+        sdt.main()
+
+    def create_document(self, file_name):
         ## create one doc ##
         document = Document.objects.create(
         doc_title = file_name,
@@ -142,6 +233,6 @@ class TransformUploadTestCase(TestCase):
         guid = 'test')
         document.docfile = file_name
         document.save()
-        sdt = SimpleDocTransform(self.user.id, document.id)
-        sdt.main()
+
+        return document
 
@@ -59,6 +59,92 @@ class TransformUploadTestCase(TestCase):
 
         self.assertEqual(len(source_submissions),file_line_count)
 
+    def test_process_file_in_chunks(self):
+        '''
+        Reading the file a few rows at a time loads the same submissions, and
+        reports the progress after every chunk.
+        '''
+
+        self.set_up()
+
+        progress = []
+
+        dt = ComplexDocTransform(self.user.id, self.document.id)
+        dt.csv_chunk_size = 3
+        dt.progress_callback = lambda rows_read, ss_count: \
+            progress.append((rows_read, ss_count))
+
+        source_submissions = dt.process_file()
+
+        test_file = open(settings.MEDIA_ROOT + self.test_file_location ,'r')
+        file_line_count = sum(1 for line in test_file) - 1 # for the header!
+
+        self.assertEqual(len(set(source_submissions)),file_line_count)
+        self.assertEqual(SourceSubmission.objects.filter(document_id = \
+            self.document.id).count(), file_line_count)
+        self.assertEqual((file_line_count, file_line_count), progress[-1])
+
+        ## the codes of every chunk are mapped along with it ##
+        location_codes = set(SourceSubmission.objects.filter(document_id = \
+            self.document.id).values_list('location_code', flat=True))\
+            .difference([None])
+        self.assertEqual(len(location_codes), SourceObjectMap.objects\
+            .filter(content_type = 'location', source_object_code__in = \
+                location_codes, id__in = DocumentSourceObjectMap.objects\
+                .filter(document_id = self.document.id)\
+                .values_list('source_object_map_id', flat=True)).count())
+
+        ## uploading the same file again does not add any submissions ##
+        dt_again = ComplexDocTransform(self.user.id, self.document.id)
+        self.assertEqual(file_line_count, len(dt_again.existing_submission_keys))
+        self.assertEqual([], dt_again.process_file())
+
+    def test_blank_uq_id(self):
+        '''
+        A row with no uq_id is skipped, instead of being loaded without an
+        instance_guid.
+        '''
+
+        self.set_up()
+
+        self.document.docfile = 'ebola_data_blank_uq_id.csv'
+        self.document.save()
+
+        dt = ComplexDocTransform(self.user.id, self.document.id)
+        source_submissions = dt.process_file()
+
+        self.assertEqual(len(source_submissions), 2)
+        self.assertEqual(SourceSubmission.objects.filter(document_id = \
+            self.document.id, instance_guid__isnull = True).count(), 0)
+
+    def test_upsert_source_object_map(self):
+        '''
+        Every location code in the file gets a source_object_map, and all of
+        them are tied to the document.  Running it again adds nothing.
+        '''
+
+        self.set_up()
+
+        dt = ComplexDocTransform(self.user.id, self.document.id)
+        dt.main()
+
+        csv_df = read_csv(settings.MEDIA_ROOT + self.test_file_location,\
+            dtype = {dt.location_column: object})
+        location_codes = set(csv_df[dt.location_column].dropna())
+
+        som_qs = SourceObjectMap.objects.filter(content_type = 'location',\
+            source_object_code__in = location_codes)
+        self.assertEqual(len(location_codes), len(som_qs))
+
+        doc_som_qs = DocumentSourceObjectMap.objects\
+            .filter(document_id = self.document.id)
+        self.assertEqual(len(location_codes), len(doc_som_qs\
+            .filter(source_object_map_id__in = som_qs)))
+
+        doc_som_count = doc_som_qs.count()
+        dt.upsert_source_object_map()
+        self.assertEqual(doc_som_count, doc_som_qs.count())
+
     # def test_boolean_transform(self):
 
     #     location_code_column = 'SettlementCode'